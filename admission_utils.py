@@ -0,0 +1,108 @@
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Optional
+
+# Admission control settings, overridable through the environment
+# Analyses (decode, X-ray check and inference) running at once in this process
+MAX_INFLIGHT_ANALYSES = int(os.environ.get("DIAGNOAI_MAX_INFLIGHT", str(max(2, os.cpu_count() or 1))))
+# Analyses allowed to wait for a slot; beyond this, new ones are shed at once
+ADMISSION_QUEUE_SIZE = int(os.environ.get("DIAGNOAI_ADMISSION_QUEUE", "16"))
+# Waiting analyses per user, so one user's batch cannot fill the queue
+ADMISSION_QUEUE_PER_USER = int(os.environ.get("DIAGNOAI_ADMISSION_QUEUE_PER_USER", "2"))
+# Seconds an analysis waits for a slot before it is shed
+ADMISSION_TIMEOUT = float(os.environ.get("DIAGNOAI_ADMISSION_TIMEOUT", "3"))
+
+class _Waiter:
+    __slots__ = ("event", "granted")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+class AdmissionController:
+    """
+    Bounded admission for analyses, shared by all sessions in the process.
+
+    At most max_inflight analyses run at once. Others wait in per-user FIFO
+    queues for up to timeout seconds, and freed slots are granted to the
+    waiting users in round-robin order, so a user with a multi-file batch
+    gets one slot per turn like everyone else. When the queue (or the user's
+    share of it) is full, or the wait times out, the analysis is shed and
+    the caller should answer "busy, retry" without charging usage.
+    """
+
+    def __init__(self, max_inflight: int = MAX_INFLIGHT_ANALYSES, max_queued: int = ADMISSION_QUEUE_SIZE,
+                 max_queued_per_user: int = ADMISSION_QUEUE_PER_USER, timeout: float = ADMISSION_TIMEOUT):
+        """
+        Args:
+            max_inflight (int): Analyses running at once
+            max_queued (int): Analyses waiting at once, across all users
+            max_queued_per_user (int): Analyses waiting at once for one user
+            timeout (float): Longest wait for a slot, in seconds
+        """
+        self.max_inflight = max(1, max_inflight)
+        self.max_queued = max(0, max_queued)
+        self.max_queued_per_user = max(0, max_queued_per_user)
+        self.timeout = timeout
+        self.inflight = 0
+        self.admitted = 0
+        self.shed = 0
+        self._queued = 0
+        self._waiters = OrderedDict()  # user -> deque of _Waiter, in round-robin order
+        self._lock = threading.Lock()
+
+    def acquire(self, user: Optional[str], timeout: Optional[float] = None) -> bool:
+        """Take a slot for user, waiting up to timeout seconds; False if the analysis is shed"""
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            if self.inflight < self.max_inflight and not self._queued:
+                self.inflight += 1
+                self.admitted += 1
+                return True
+            user_queue = self._waiters.get(user)
+            if (self._queued >= self.max_queued or timeout <= 0 or
+                    (user_queue is not None and len(user_queue) >= self.max_queued_per_user)):
+                self.shed += 1
+                return False
+            waiter = _Waiter()
+            if user_queue is None:
+                user_queue = self._waiters[user] = deque()
+            user_queue.append(waiter)
+            self._queued += 1
+
+        waiter.event.wait(timeout)
+
+        with self._lock:
+            if waiter.granted:
+                return True
+            # Timed out: leave the queue
+            user_queue = self._waiters.get(user)
+            if user_queue is not None and waiter in user_queue:
+                user_queue.remove(waiter)
+                self._queued -= 1
+                if not user_queue:
+                    del self._waiters[user]
+            self.shed += 1
+            return False
+
+    def release(self):
+        """Free a slot and grant it to the next waiting user in round-robin order"""
+        with self._lock:
+            self.inflight -= 1
+            while self.inflight < self.max_inflight and self._waiters:
+                user, user_queue = next(iter(self._waiters.items()))
+                waiter = user_queue.popleft()
+                self._queued -= 1
+                # Move the user to the back of the rotation (or drop them if done)
+                del self._waiters[user]
+                if user_queue:
+                    self._waiters[user] = user_queue
+                waiter.granted = True
+                self.inflight += 1
+                self.admitted += 1
+                waiter.event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"inflight": self.inflight, "queued": self._queued, "admitted": self.admitted, "shed": self.shed}
@@ -1,10 +1,6 @@
 import streamlit as st
-import tensorflow as tf
-from tensorflow.keras.preprocessing import image
-import numpy as np
-import pydicom
 import os
-import io
+import time
 import urllib.parse
 import jwt
 import webbrowser  # Add this import
@@ -14,11 +10,12 @@ from auth_utils import (
     init_session_state, 
     handle_signout, 
     create_subscription_url, 
-    check_usage_limit, 
+    consume_usage,
+    check_premium_subscription,
     get_premium_status,
+    resume_session,
     handle_token_authentication
 )
-from db_utils import increment_usage, ensure_user_exists
 from ui_utils import (
     apply_custom_styles, 
     blue_button, 
@@ -27,6 +24,21 @@ from ui_utils import (
     render_sidebar_user_info,
     is_xray_image
 )
+from inference_utils import (
+    load_lazy_models,
+    decode_image,
+    decode_preview,
+    prescreen,
+    model_version
+)
+from scheduler_utils import InferenceScheduler
+from model_server_utils import ModelServerClient, MODEL_SERVER_ADDRESS
+from pipeline_utils import PreprocessPipeline
+from cache_utils import PredictionCache, prediction_cache_key
+from ledger_utils import UsageLedger, ledger_row
+from metrics_utils import span, increment, start_metrics_server
+from profile_utils import PROFILE_QUERY_PARAM, profile_request, should_profile
+from admission_utils import AdmissionController
 
 # Import AWS Secrets Manager utility
 from aws_secrets_utils import get_secret
@@ -39,19 +51,68 @@ except Exception as e:
     st.error(f"Failed to retrieve secrets: {e}")
     SECRET_KEY = None
 
-# Define the image size and class names
-IMAGE_SIZE = (224, 224)
-MULTI_CLASS_NAMES = ['Edema', 'Normal', 'Pneumonia', 'Tuberculosis','Effusion']
-BINARY_CLASS_NAMES = ['NotEdema', 'Edema']
-
-# Load both of our trained models
+# Load both of our trained models: the multi-class model loads in a background
+# thread so pages render immediately, the Edema model on its first prediction
 @st.cache_resource
 def load_models():
-    multi_model = tf.keras.models.load_model('disease_classifier_model.h5')
-    edema_model = tf.keras.models.load_model('edema_classifier_model.h5')
-    return multi_model, edema_model
+    return load_lazy_models()
+
+# Share one micro-batching scheduler across all sessions in this process. With
+# DIAGNOAI_MODEL_SERVER set, inference runs in the node's shared model server
+# instead and this process never loads the models
+@st.cache_resource
+def get_inference_scheduler():
+    if MODEL_SERVER_ADDRESS:
+        return ModelServerClient(MODEL_SERVER_ADDRESS)
+    multi_model, edema_model = load_models()
+    return InferenceScheduler(multi_model, edema_model)
+
+inference_scheduler = get_inference_scheduler()
+
+# Share one prediction cache across all sessions so repeat uploads skip the models
+@st.cache_resource
+def get_prediction_cache():
+    return PredictionCache()
+
+prediction_cache = get_prediction_cache()
+
+# Decode multi-file uploads in a thread pool shared by all sessions. Worker
+# processes are not safe here: forking copies a server that is running many
+# threads, and Streamlit runs this script as __main__, so spawned (or
+# forkserver) workers would re-run it, and load the models, on start-up
+@st.cache_resource
+def get_preprocess_pipeline():
+    return PreprocessPipeline(start_method="thread")
+
+# Files per batch of a multi-file upload: metered with one DB operation, run
+# through the models together, and added to the results table together
+UPLOAD_BATCH_SIZE = int(os.environ.get("DIAGNOAI_UPLOAD_BATCH_SIZE", "8"))
+
+# Record every analysis in the usage ledger, written behind in batches
+@st.cache_resource
+def get_usage_ledger():
+    return UsageLedger()
+
+usage_ledger = get_usage_ledger()
+
+# Bound the analyses running at once in this process; when saturated, uploads
+# wait briefly in a per-user round-robin queue and are then shed uncharged
+@st.cache_resource
+def get_admission_controller():
+    return AdmissionController()
 
-multi_model, edema_model = load_models()
+admission_controller = get_admission_controller()
+
+BUSY_MESSAGE = "⏳ The service is busy right now. Your upload was not charged; please retry in a few seconds."
+
+# Longest wait for the models per upload, or per batch of a multi-file upload;
+# an analysis that times out is reported to the user and frees its slot
+INFERENCE_TIMEOUT = float(os.environ.get("DIAGNOAI_INFERENCE_TIMEOUT", "60"))
+TIMEOUT_MESSAGE = "⏳ The analysis took too long and was stopped. Please upload the image again in a moment."
+
+# Per-stage latency histograms and counters on a local /metrics endpoint
+# (only when DIAGNOAI_METRICS=1; started once per process)
+start_metrics_server()
 
 # Initialize session state
 init_session_state()
@@ -116,8 +177,9 @@ def render_sidebar():
 
 # Main Streamlit app
 def main():
-    # Check if user is authenticated
-    if not st.session_state.get("authenticated", False):
+    # Check if user is authenticated; a new browser session (reconnect, or
+    # another replica) resumes the logged-in session through the handoff in the URL
+    if not st.session_state.get("authenticated", False) and not resume_session():
         # Add a session state variable to control link visibility
         if 'hide_unauthorized_link' not in st.session_state:
             st.session_state.hide_unauthorized_link = False
@@ -140,84 +202,376 @@ def main():
         st.stop()
 
     st.title("🩺 DiagnoAI")
-    st.write("Upload a chest X-ray image (JPG, JPEG, PNG, or DICOM) to get a disease prediction.")
+    st.write("Upload a chest X-ray image (JPG, JPEG, PNG, or DICOM) to get a disease prediction. "
+             "Select several files to analyze a whole study at once.")
 
     # Render sidebar
     render_sidebar()
 
     # File Upload Section
-    uploaded_file = blue_file_uploader("Choose an image...", type=["jpg", "jpeg", "png", "dcm"])
+    uploaded_files = blue_file_uploader("Choose an image...", type=["jpg", "jpeg", "png", "dcm"],
+                                        accept_multiple_files=True)
+
+    if len(uploaded_files) > 1:
+        render_batch_analysis(uploaded_files)
+        return
 
+    uploaded_file = uploaded_files[0] if uploaded_files else None
     if uploaded_file is not None:
-        # Check usage limits
-        if not check_usage_limit():
-            st.error("You have reached your usage limit. Please upgrade to premium to continue.")
+        # Streamlit reruns the script on every widget interaction while the upload
+        # stays set; redraw the stored result instead of re-running the models and
+        # re-charging usage for the same file
+        file_key = upload_identity(uploaded_file)
+        last_analysis = st.session_state.get("last_analysis")
+        if last_analysis and last_analysis["file_key"] == file_key:
+            prediction, preview = last_analysis["prediction"], last_analysis["preview"]
+        else:
+            prediction, preview = analyze_upload(uploaded_file)
+            if prediction is None:
+                return
+            st.session_state.last_analysis = {"file_key": file_key, "prediction": prediction, "preview": preview}
+
+        # Display the downscaled preview rather than sending the original file to the browser;
+        # uploads rejected by the pre-screen were never fully decoded and have none
+        if preview is not None:
+            st.image(preview, caption='Uploaded Image.', use_container_width=True, output_format="JPEG")
+
+        if prediction.get("error"):
+            st.error(prediction["error"])
             return
 
-        # Increment usage
-        if not increment_usage():
-            st.error("Failed to track usage. Please try again.")
+        if not prediction["is_xray"]:
+            st.error("⚠️ The uploaded image does not appear to be an X-ray image. Please upload a valid chest X-ray image.")
             return
 
-        # Handle DICOM files
-        if uploaded_file.name.endswith('.dcm'):
-            dicom_data = pydicom.dcmread(io.BytesIO(uploaded_file.getvalue()))
-            img = dicom_data.pixel_array
-            img = (np.maximum(img, 0) / img.max()) * 255.0 
-            img = np.uint8(img)
-            if len(img.shape) == 2:
-                img = np.stack((img,)*3, axis=-1)
-            img_for_model = tf.image.resize(img, IMAGE_SIZE)
-            
-        # Handle normal image files (JPG, PNG)
+        render_prediction(prediction)
+
+def upload_identity(uploaded_file) -> tuple:
+    """Identify an upload across reruns by the uploader's file id, name and size"""
+    return (getattr(uploaded_file, "file_id", None), uploaded_file.name, uploaded_file.size)
+
+def upload_cache_key(uploaded_file) -> str:
+    """Prediction cache key of an upload, hashed from a view of its bytes rather than a copy"""
+    with uploaded_file.getbuffer() as data:
+        return prediction_cache_key(data, model_version())
+
+def analyze_upload(uploaded_file):
+    """
+    Pre-screen the upload, then charge usage and run the X-ray check and models.
+
+    Returns (prediction, preview), or (None, None) if the upload was refused.
+    Uploads the pre-screen rejects are not charged and have no preview, nor
+    are uploads shed because the process is busy. An analysis that timed out
+    was charged and returns an {"error": message} prediction.
+    """
+    # Reject obvious non-X-rays from a thumbnail (or the DICOM header) before
+    # charging usage or decoding the full image. Formats with no reduced-size
+    # decode (PNG) are screened once the upload holds an analysis slot, so
+    # their full decode is bounded by admission control too
+    start = time.perf_counter()
+    increment("requests", mode="single")
+    with span("prescreen"):
+        plausible, decoded = prescreen(uploaded_file, name=uploaded_file.name, full_decode=False)
+    if plausible is False:
+        increment("rejections", reason="prescreen")
+        return {"is_xray": False}, None
+
+    # Take an analysis slot before charging usage, so shed uploads are never charged
+    with span("admission"):
+        slot = admission_controller.acquire(st.session_state.user_email)
+    if not slot:
+        render_busy()
+        return None, None
+    try:
+        if plausible is None:
+            with span("prescreen"):
+                plausible, decoded = prescreen(uploaded_file, name=uploaded_file.name)
+            if not plausible:
+                increment("rejections", reason="prescreen")
+                return {"is_xray": False}, None
+        return analyze_admitted_upload(uploaded_file, decoded, start)
+    finally:
+        admission_controller.release()
+
+def render_busy(amount: int = 1):
+    """Tell the user the upload was shed, with a button to try again"""
+    increment("rejections", amount=amount, reason="busy")
+    st.warning(BUSY_MESSAGE)
+    # Shed results are not stored, so the rerun from the click analyzes again
+    blue_button("🔄 Retry", key="retry_busy")
+
+def analyze_admitted_upload(uploaded_file, decoded, start: float):
+    """Charge usage for an upload holding an analysis slot, then decode it and run the models on a cache miss"""
+    # Check usage limits and count this analysis in one atomic DB operation
+    with span("usage_check"):
+        premium = check_premium_subscription()
+        admitted = consume_usage()
+    if admitted is None:
+        st.error("Failed to track usage. Please try again.")
+        return None, None
+    if not admitted:
+        increment("rejections", reason="usage_limit")
+        st.error("You have reached your usage limit. Please upgrade to premium to continue.")
+        return None, None
+
+    # Look up the upload by content first, so repeat uploads skip the full decode,
+    # the X-ray check and the models
+    source = decoded if decoded is not None else uploaded_file
+    cache_key = upload_cache_key(uploaded_file)
+    prediction = prediction_cache.get(cache_key)
+    cached = prediction is not None
+    increment("cache_hits" if cached else "cache_misses")
+    if cached:
+        # Only the display preview is decoded
+        with span("preview"):
+            preview = decode_preview(source, name=uploaded_file.name)
+    else:
+        # Decode the upload (DICOM, JPG or PNG) once into the model input and a display preview
+        with span("decode"):
+            img_for_model, preview = decode_image(source, name=uploaded_file.name)
+
+        # Check if the image is an X-ray, then make a Prediction with the
+        # Multi-Class Model (and the Edema cascade if needed)
+        with span("xray_check"):
+            is_xray = is_xray_image(img_for_model)
+        if is_xray:
+            try:
+                with span("inference"):
+                    prediction = {"is_xray": True, **inference_scheduler.predict(img_for_model,
+                                                                                  timeout=INFERENCE_TIMEOUT)}
+            except TimeoutError:
+                # Charged already, so final like any other result: reruns redraw it instead of charging again
+                increment("inference_timeouts")
+                return {"error": TIMEOUT_MESSAGE}, preview
         else:
-            img_for_model = image.load_img(uploaded_file, target_size=IMAGE_SIZE)
-            img_for_model = image.img_to_array(img_for_model)
-        
-        # Display the uploaded image
-        st.image(uploaded_file, caption='Uploaded Image.', use_container_width=True)
-        
-        # Check if the image is an X-ray
-        if not is_xray_image(img_for_model):
-            st.error("⚠️ The uploaded image does not appear to be an X-ray image. Please upload a valid chest X-ray image.")
+            prediction = {"is_xray": False}
+        prediction_cache.put(cache_key, prediction)
+    if not prediction["is_xray"]:
+        increment("rejections", reason="not_xray")
+
+    # Append to the ledger without waiting on the database
+    usage_ledger.record(ledger_row(
+        st.session_state.user_email, prediction, premium=premium,
+        latency_ms=(time.perf_counter() - start) * 1000, cached=cached
+    ))
+    return prediction, preview
+
+def render_batch_analysis(uploaded_files: list):
+    """
+    Analyze several uploads in batches of UPLOAD_BATCH_SIZE, adding each
+    batch's results to a table as soon as the batch completes.
+
+    Progress is saved after every batch, so a rerun in the middle of an upload
+    (any widget interaction) picks up where it stopped instead of charging
+    finished batches again. Uploads that were not analyzed because the
+    process was busy, usage could not be tracked or an earlier batch timed
+    out are retried on the next run.
+    """
+    batch_key = tuple(upload_identity(uploaded_file) for uploaded_file in uploaded_files)
+    table = st.empty()
+    last_batch = st.session_state.get("last_batch_analysis")
+    results = [None] * len(uploaded_files)
+    if last_batch and last_batch["batch_key"] == batch_key:
+        if last_batch["complete"]:
+            table.dataframe(last_batch["rows"], use_container_width=True, hide_index=True)
             return
+        results = list(last_batch["rows"])
 
-        # Preprocess the image for the models
-        img_array = np.expand_dims(img_for_model, axis=0) 
-        img_array = img_array / 255.0 
+    def save(complete: bool):
+        st.session_state.last_batch_analysis = {"batch_key": batch_key, "rows": results, "complete": complete}
 
-        # Make a Prediction with the Multi-Class Model
-        multi_prediction = multi_model.predict(img_array)
-        predicted_class_index = np.argmax(multi_prediction)
-        predicted_class_name = MULTI_CLASS_NAMES[predicted_class_index]
-        confidence = multi_prediction[0][predicted_class_index]
+    def show(pending_reason: str):
+        table.dataframe([row or batch_result_row(f.name, {"error": pending_reason})
+                         for f, row in zip(uploaded_files, results)], use_container_width=True, hide_index=True)
 
-        # Use the Binary Classifier for Edema if needed
-        edema_prediction = None
-        if predicted_class_name == 'Edema':
-            edema_prediction = edema_model.predict(img_array)[0][0]
-        
-        # Display the Results
-        st.write("")
-        st.write("### Prediction")
-        
-        if predicted_class_name == 'Normal':
-            st.success(f"The model predicts: **{predicted_class_name}** with {confidence*100:.2f}% confidence.")
-            st.info("No signs of disease detected based on the analysis.")
+    pending = [index for index, row in enumerate(results) if row is None]
+    done = len(uploaded_files) - len(pending)
+    progress = st.progress(done / len(uploaded_files), text=f"Analyzing {len(uploaded_files)} images...")
+    for start in range(0, len(pending), UPLOAD_BATCH_SIZE):
+        indices = pending[start:start + UPLOAD_BATCH_SIZE]
+        batch_rows, status = analyze_upload_batch([uploaded_files[index] for index in indices])
+        if status == "busy":
+            # Keep the finished batches; the rest wait for a retry
+            progress.empty()
+            show("Waiting (service busy)")
+            render_busy(len(pending) - start)
+            return
+        for index, row in zip(indices, batch_rows):
+            results[index] = row
+        save(complete=False)
+        if status == "limit":
+            st.error("You have reached your usage limit. Please upgrade to premium to continue.")
+            for index in pending[start + len(indices):]:
+                results[index] = batch_result_row(uploaded_files[index].name, {"error": "Usage limit reached"})
+            break
+        if status != "ok":
+            break
+        done = sum(1 for row in results if row is not None)
+        show("Waiting")
+        progress.progress(done / len(uploaded_files), text=f"Analyzed {done} of {len(uploaded_files)} images")
+    progress.empty()
+    show("Not analyzed")
+    save(complete=all(row is not None for row in results))
+
+def analyze_upload_batch(batch: list):
+    """
+    Analyze a batch of uploads, charging usage only for the ones that pass the
+    pre-screen (or are already in the prediction cache).
+
+    Returns (one table row per upload, status), where status is "ok", "limit"
+    if the usage limit was reached, "error" if usage could not be tracked or
+    the models timed out, or "busy" if the batch was shed uncharged (rows are
+    then empty). Uploads that were not charged, other than at the usage limit,
+    have None rows.
+    """
+    start = time.perf_counter()
+    increment("requests", amount=len(batch), mode="batch")
+    # Each batch takes one analysis slot, so a long upload queues behind other
+    # users' analyses between batches instead of holding the process
+    with span("admission"):
+        slot = admission_controller.acquire(st.session_state.user_email)
+    if not slot:
+        return [], "busy"
+    try:
+        return analyze_admitted_batch(batch, start)
+    finally:
+        admission_controller.release()
+
+def analyze_admitted_batch(batch: list, start: float):
+    """Analyze a batch of uploads holding an analysis slot (see analyze_upload_batch)"""
+    premium = check_premium_subscription()
+    pipeline = get_preprocess_pipeline()
+
+    # Repeat uploads come from the prediction cache; they passed the pre-screen when first analyzed
+    cache_keys = [upload_cache_key(f) for f in batch]
+    predictions = [prediction_cache.get(cache_key) for cache_key in cache_keys]
+    cached = [prediction is not None for prediction in predictions]
+    increment("cache_hits", amount=sum(cached))
+    increment("cache_misses", amount=len(batch) - sum(cached))
+
+    # Pre-screen the rest in the pool before anything is charged
+    misses = [row for row, was_cached in enumerate(cached) if not was_cached]
+    sources = {}
+    with span("prescreen"):
+        screened = pipeline.prescreen([batch[row] for row in misses])
+    for row, (plausible, decoded, error) in zip(misses, screened):
+        if error is not None:
+            predictions[row] = {"error": f"Could not read file: {error}"}
+        elif not plausible:
+            # Rejected by the pre-screen; not charged, and cheap to repeat, so not cached
+            increment("rejections", reason="prescreen")
+            predictions[row] = {"is_xray": False}
         else:
-            if predicted_class_name == 'Edema' and edema_prediction is not None:
-                edema_confidence = edema_prediction * 100
-                if edema_prediction >= 0.5:
-                    st.error(f"The model predicts: **Edema** with {edema_confidence:.2f}% confidence (specialist opinion).")
-                    st.warning("Please consult a medical professional for an accurate diagnosis.")
-                else:
-                    st.error(f"The model predicts: **{predicted_class_name}** with {confidence*100:.2f}% confidence.")
-                    st.info("A second opinion suggests this is likely not Edema.")
+            sources[row] = decoded if decoded is not None else batch[row]
+
+    # Charge the hits and the plausible misses with one DB operation, admitting them in upload order
+    status = "ok"
+    chargeable = [row for row in range(len(batch)) if cached[row] or row in sources]
+    admitted = 0
+    if chargeable:
+        with span("usage_check"):
+            admitted = consume_usage(len(chargeable))
+        if admitted is None:
+            st.error("Failed to track usage. Please try again.")
+            status, admitted = "error", 0
+        elif admitted < len(chargeable):
+            increment("rejections", amount=len(chargeable) - admitted, reason="usage_limit")
+            status = "limit"
+    charged = chargeable[:admitted]
+    for row in chargeable[admitted:]:
+        # Final at the usage limit; None (retried on the next run) if usage could not be tracked
+        predictions[row] = {"error": "Usage limit reached"} if status == "limit" else None
+
+    # Charged hits are done; charged misses are decoded in the pool and run through the models as one batch
+    for row in charged:
+        if cached[row] and not predictions[row]["is_xray"]:
+            # Counted like a fresh rejection, as in single-file mode
+            increment("rejections", reason="not_xray")
+    to_run = [row for row in charged if not cached[row]]
+    results = []
+    if to_run:
+        try:
+            with span("batch_pipeline"):
+                results = list(pipeline.run(
+                    [sources[row] for row in to_run],
+                    lambda images: inference_scheduler.predict_many(images, timeout=INFERENCE_TIMEOUT),
+                    batch_size=len(to_run), screened=True
+                ))
+        except TimeoutError:
+            # Charged already, so final rather than retried; the remaining batches wait for the next run
+            increment("inference_timeouts", amount=len(to_run))
+            st.error(TIMEOUT_MESSAGE)
+            status = "error"
+            for row in to_run:
+                predictions[row] = {"error": "Analysis timed out"}
+        for row, result in zip(to_run, results):
+            if result.get("error"):
+                predictions[row] = {"error": f"Could not read file: {result['error']}"}
+                continue
+            prediction = {"is_xray": result["is_xray"]}
+            if result["is_xray"]:
+                prediction.update({key: result[key] for key in
+                                   ("predicted_class", "confidence", "probabilities", "edema_prediction")})
             else:
-                st.error(f"The model predicts: **{predicted_class_name}** with {confidence*100:.2f}% confidence.")
+                increment("rejections", reason="not_xray")
+            prediction_cache.put(cache_keys[row], prediction)
+            predictions[row] = prediction
+
+    latency_ms = (time.perf_counter() - start) * 1000
+    for row in charged:
+        # A file that passed the pre-screen but could not be decoded was charged but has no prediction
+        if not predictions[row].get("error"):
+            usage_ledger.record(ledger_row(
+                st.session_state.user_email, predictions[row], premium=premium, latency_ms=latency_ms,
+                cached=cached[row]
+            ))
+
+    return [batch_result_row(f.name, prediction) if prediction is not None else None
+            for f, prediction in zip(batch, predictions)], status
+
+def batch_result_row(file_name: str, prediction: dict) -> dict:
+    """One row of the multi-file results table"""
+    row = {"File": file_name, "Result": "", "Confidence": "", "Edema specialist": ""}
+    if prediction.get("error"):
+        row["Result"] = prediction["error"]
+    elif not prediction["is_xray"]:
+        row["Result"] = "Not an X-ray image"
+    else:
+        row["Result"] = prediction["predicted_class"]
+        row["Confidence"] = f"{prediction['confidence']*100:.2f}%"
+        if prediction["edema_prediction"] is not None:
+            row["Edema specialist"] = f"{prediction['edema_prediction']*100:.2f}%"
+    return row
+
+def render_prediction(prediction: dict):
+    """Display the multi-class prediction and the Edema second opinion"""
+    predicted_class_name = prediction["predicted_class"]
+    confidence = prediction["confidence"]
+    edema_prediction = prediction["edema_prediction"]
+
+    # Display the Results
+    st.write("")
+    st.write("### Prediction")
+    
+    if predicted_class_name == 'Normal':
+        st.success(f"The model predicts: **{predicted_class_name}** with {confidence*100:.2f}% confidence.")
+        st.info("No signs of disease detected based on the analysis.")
+    else:
+        if predicted_class_name == 'Edema' and edema_prediction is not None:
+            edema_confidence = edema_prediction * 100
+            if edema_prediction >= 0.5:
+                st.error(f"The model predicts: **Edema** with {edema_confidence:.2f}% confidence (specialist opinion).")
                 st.warning("Please consult a medical professional for an accurate diagnosis.")
+            else:
+                st.error(f"The model predicts: **{predicted_class_name}** with {confidence*100:.2f}% confidence.")
+                st.info("A second opinion suggests this is likely not Edema.")
+        else:
+            st.error(f"The model predicts: **{predicted_class_name}** with {confidence*100:.2f}% confidence.")
+            st.warning("Please consult a medical professional for an accurate diagnosis.")
 
-# Run the main function
+# Run the main function, profiled when sampled or requested by an admin (?profile=1)
 if __name__ == "__main__":
-    main()
+    profiled = should_profile(st.session_state.get("user_email"), st.query_params.get(PROFILE_QUERY_PARAM) == "1")
+    with profile_request("main", enabled=profiled):
+        main()
 
@@ -1,6 +1,10 @@
 import os
 import jwt
-from datetime import datetime, timedelta
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from typing import Dict, Optional
 import streamlit as st
 import urllib.parse
@@ -8,9 +12,18 @@ from jwt import ExpiredSignatureError, InvalidTokenError
 
 # Import database utilities
 from db_utils import (
-    get_user_usage_from_db, 
-    ensure_user_exists, 
-    init_user_session
+    bootstrap_user,
+    consume_usage_in_db
+)
+from state_utils import (
+    QUOTA_FIELDS,
+    session_ttl,
+    save_session,
+    load_session,
+    delete_session,
+    issue_handoff,
+    take_handoff,
+    delete_handoff
 )
 
 # Constants for subscription
@@ -18,6 +31,11 @@ FREE_USAGE_LIMIT = 6
 PREMIUM_USAGE_LIMIT = 20
 SUBSCRIPTION_DURATION_DAYS = 1
 
+# Verified JWT payloads remembered per process, keyed by a hash of the token
+VERIFIED_TOKEN_CACHE_SIZE = 1024
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
 def init_session_state():
     """Initialize session state with authentication and usage tracking variables"""
     if "_auth_session_initialized" not in st.session_state:
@@ -52,38 +70,134 @@ def init_session_state():
         if "payment_processed" not in st.session_state:
             st.session_state.payment_processed = False
             
+        if "session_id" not in st.session_state:
+            st.session_state.session_id = None
+            
+        if "session_expires_at" not in st.session_state:
+            st.session_state.session_expires_at = None
+            
+        if "session_handoff" not in st.session_state:
+            st.session_state.session_handoff = None
+            
         st.session_state._auth_session_initialized = True
 
+def resume_session() -> bool:
+    """
+    Resume a logged-in session in a new browser session (reconnect, or another
+    replica) through the one-time handoff in the URL, if there is one
+    """
+    handoff = st.query_params.get("sid", "")
+    if not handoff:
+        return False
+    if restore_session(handoff):
+        return True
+    del st.query_params["sid"]
+    return False
+
+def restore_session(handoff: str) -> bool:
+    """Restore identity from the shared state store, and quota from the database"""
+    session_id = take_handoff(handoff)
+    if session_id is None:
+        return False
+    record = load_session(session_id)
+    if not record or not record.get("authenticated"):
+        return False
+    # The record's lifetime is capped at the token's expiry; check it again
+    # in case the record was cached or the clock moved
+    if session_ttl(record.get("session_expires_at")) <= 0:
+        delete_session(session_id)
+        return False
+    
+    for field, value in record.items():
+        st.session_state[field] = value
+    st.session_state.session_id = session_id
+    
+    quota = bootstrap_user(record["user_email"], record["user_name"])
+    if quota is None:
+        st.session_state.authenticated = False
+        return False
+    for field in QUOTA_FIELDS:
+        st.session_state[field] = quota[field]
+    publish_handoff()
+    return True
+
+def publish_handoff():
+    """Replace the handoff in the URL with a fresh one for this session"""
+    previous = st.session_state.get("session_handoff")
+    handoff = issue_handoff(st.session_state.session_id, st.session_state.get("session_expires_at"))
+    if previous:
+        delete_handoff(previous)
+    st.session_state.session_handoff = handoff
+    if handoff:
+        st.query_params["sid"] = handoff
+    elif "sid" in st.query_params:
+        del st.query_params["sid"]
+
+def decode_token(token: str, secret_key: str) -> Dict:
+    """
+    Verify a JWT and return its payload, verifying each token only once.
+
+    Verified payloads are remembered per process until the token expires, so
+    reruns and repeated logins with the same token skip signature checks.
+    Raises ExpiredSignatureError / InvalidTokenError like jwt.decode.
+    """
+    cache_key = hashlib.sha256(f"{secret_key}:{token}".encode("utf-8")).hexdigest()
+    with _verified_tokens_lock:
+        decoded = _verified_tokens.get(cache_key)
+        if decoded is not None:
+            _verified_tokens.move_to_end(cache_key)
+    
+    if decoded is not None:
+        if "exp" in decoded and decoded["exp"] <= datetime.now(timezone.utc).timestamp():
+            raise ExpiredSignatureError("Signature has expired")
+        return decoded
+    
+    decoded = jwt.decode(token, secret_key, algorithms=["HS256"])
+    with _verified_tokens_lock:
+        _verified_tokens[cache_key] = decoded
+        while len(_verified_tokens) > VERIFIED_TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+    return decoded
+
 def handle_token_authentication(token: str, secret_key: str):
     """Handle token authentication similar to test.py"""
     try:
-        # Decode token
-        decoded = jwt.decode(token, secret_key, algorithms=["HS256"])
+        # Decode token (verified once per token)
+        decoded = decode_token(token, secret_key)
         
         # Extract user information
         email = decoded.get("email", "")
         user_name = decoded.get("name") or email.split("@")[0]
         
-        # Ensure user exists in database
-        if not ensure_user_exists(email, user_name):
+        # Create the user if needed and load their status in one query
+        user_status = bootstrap_user(email, user_name)
+        if user_status is None:
             st.error("Failed to create/verify user account")
             st.stop()
-        
-        # Get usage count from database
-        db_usage_count = get_user_usage_from_db(email)
+        if user_status["created"]:
+            st.info(f"Created new user account for {email}")
         
         # Store in session state
         st.session_state.user_token = token
         st.session_state.user_name = user_name
         st.session_state.user_email = email
         st.session_state.authenticated = True
-        st.session_state.usage_count = db_usage_count
+        st.session_state.usage_count = user_status["usage_count"]
+        st.session_state.paid_user = user_status["paid_user"]
+        st.session_state.premium_usage_count = user_status["premium_usage_count"]
+        st.session_state.subscription_expires_at = user_status["subscription_expires_at"]
         
-        # Initialize user session from database
-        init_user_session(email)
+        # Share the session through the state store so any replica can resume
+        # it. The session lives no longer than the token; the token itself
+        # stays in this browser session only
+        st.session_state.session_expires_at = decoded.get("exp")
+        st.session_state.session_id = secrets.token_urlsafe(32)
+        save_session(st.session_state.session_id, st.session_state)
         
-        # Clear the URL parameters
+        # Replace the token in the URL with a one-time handoff; the session id
+        # never leaves the server
         st.query_params.clear()
+        publish_handoff()
         st.rerun()
         
     except ExpiredSignatureError:
@@ -109,7 +223,7 @@ def generate_token(email: str, name: str, secret_key: str, expires_delta: Option
 def validate_token(token: str, secret_key: str) -> Optional[Dict]:
     """Validate JWT token and return decoded payload"""
     try:
-        decoded = jwt.decode(token, secret_key, algorithms=["HS256"])
+        decoded = decode_token(token, secret_key)
         return decoded
     except jwt.ExpiredSignatureError:
         st.error("Session expired. Please log in again.")
@@ -148,20 +262,50 @@ def get_premium_status() -> Dict:
         }
     return {"active": False, "message": "Free account"}
 
-def check_usage_limit() -> bool:
-    """Check if user has reached usage limit"""
-    check_premium_subscription()
+def consume_usage(count: int = 1) -> Optional[int]:
+    """
+    Check the usage limit and count up to count analyses in a single atomic DB operation.
+
+    The database counters are authoritative, so stale session state (another
+    tab, another replica) cannot let a user exceed the limit.
+
+    Returns:
+        Number of analyses admitted (0 if the limit is reached, so a single
+        analysis is admitted when the result is truthy), or None if usage
+        could not be tracked
+    """
+    email = st.session_state.get("user_email")
+    if not email:
+        st.error("No user email found in session")
+        return None
     
-    if st.session_state.paid_user or st.session_state.get("premium_user", False):
-        return st.session_state.premium_usage_count < PREMIUM_USAGE_LIMIT
+    premium = check_premium_subscription()
+    limit = PREMIUM_USAGE_LIMIT if premium else FREE_USAGE_LIMIT
+    result = consume_usage_in_db(email, premium=premium, limit=limit, count=count)
+    if result is None:
+        return None
     
-    return st.session_state.usage_count < FREE_USAGE_LIMIT
+    if result["admitted"]:
+        st.session_state.usage_count = result["usage_count"]
+        st.session_state.premium_usage_count = result["premium_usage_count"]
+    elif premium:
+        st.session_state.premium_usage_count = max(st.session_state.premium_usage_count, PREMIUM_USAGE_LIMIT)
+    else:
+        st.session_state.usage_count = max(st.session_state.usage_count, FREE_USAGE_LIMIT)
+    return result["admitted_count"]
 
 def handle_signout():
     """Handle user sign out"""
     # Define the exact logout URL
     LOGOUT_URL = "http://bellblaze-dev.s3-website.ap-south-1.amazonaws.com/our-solutions"
     
+    # Forget the shared session so it can no longer be resumed
+    if st.session_state.get("session_id"):
+        delete_session(st.session_state.session_id)
+    if st.session_state.get("session_handoff"):
+        delete_handoff(st.session_state.session_handoff)
+    st.query_params.clear()
+    
     # Clear session state
     for key in list(st.session_state.keys()):
         del st.session_state[key]
@@ -1,27 +1,47 @@
+import os
+import time
 import boto3
 import json
+import threading
 
-def get_secret(secret_name, region_name="ap-south-1"):
-    """
-    Retrieve a secret from AWS Secrets Manager.
-    
-    :param secret_name: Name of the secret in AWS Secrets Manager
-    :param region_name: AWS region where the secret is stored
-    :return: Dictionary of secret key-value pairs
-    """
-    try:
-        # Create a Secrets Manager client
-        session = boto3.session.Session()
-        client = session.client(
-            service_name='secretsmanager',
-            region_name=region_name
-        )
-        
+from metrics_utils import span
+
+# Secrets backend selection, overridable through the environment:
+#   aws  - AWS Secrets Manager (default)
+#   env  - environment variables named DIAGNOAI_SECRET_<KEY>
+#   file - a local JSON file (DIAGNOAI_SECRETS_FILE)
+SECRETS_BACKEND = os.environ.get("DIAGNOAI_SECRETS_BACKEND", "aws")
+SECRETS_FILE = os.environ.get("DIAGNOAI_SECRETS_FILE", "secrets.json")
+SECRETS_ENV_PREFIX = "DIAGNOAI_SECRET_"
+# Cached secrets are served for SECRETS_TTL seconds; after SECRETS_REFRESH_AFTER
+# seconds they are refreshed in the background while the cached value is served
+SECRETS_TTL = float(os.environ.get("DIAGNOAI_SECRETS_TTL", "3600"))
+SECRETS_REFRESH_AFTER = float(os.environ.get("DIAGNOAI_SECRETS_REFRESH_AFTER", str(SECRETS_TTL * 0.8)))
+
+class AwsSecretsBackend:
+    """Reads secrets from AWS Secrets Manager through one shared client per region"""
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _client(self, region_name):
+        with self._lock:
+            if region_name not in self._clients:
+                # Create a Secrets Manager client
+                session = boto3.session.Session()
+                self._clients[region_name] = session.client(
+                    service_name='secretsmanager',
+                    region_name=region_name
+                )
+            return self._clients[region_name]
+
+    def fetch(self, secret_name, region_name):
         # Retrieve the secret
-        get_secret_value_response = client.get_secret_value(
+        get_secret_value_response = self._client(region_name).get_secret_value(
             SecretId=secret_name
         )
-        
+
         # Depending on which type of secret, parse accordingly
         if 'SecretString' in get_secret_value_response:
             secret = get_secret_value_response['SecretString']
@@ -30,7 +50,129 @@ def get_secret(secret_name, region_name="ap-south-1"):
             # For binary secrets (less common)
             decoded_binary_secret = get_secret_value_response['SecretBinary'].decode('utf-8')
             return json.loads(decoded_binary_secret)
-    
+
+class EnvSecretsBackend:
+    """Reads secrets from environment variables, e.g. DIAGNOAI_SECRET_DB_HOST -> DB_HOST"""
+
+    def __init__(self, prefix=SECRETS_ENV_PREFIX):
+        self.prefix = prefix
+
+    def fetch(self, secret_name, region_name):
+        return {
+            key[len(self.prefix):]: value
+            for key, value in os.environ.items()
+            if key.startswith(self.prefix)
+        }
+
+class JsonFileSecretsBackend:
+    """
+    Reads secrets from a local JSON file, for offline and test environments.
+
+    The file holds either one object per secret name, e.g.
+    {"diagnoai-secrets": {"SECRET_KEY": "..."}}, or a single flat object.
+    """
+
+    def __init__(self, path=SECRETS_FILE):
+        self.path = path
+
+    def fetch(self, secret_name, region_name):
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        secret = data.get(secret_name)
+        return secret if isinstance(secret, dict) else data
+
+SECRETS_BACKENDS = {
+    "aws": AwsSecretsBackend,
+    "env": EnvSecretsBackend,
+    "file": JsonFileSecretsBackend
+}
+
+class SecretsCache:
+    """
+    TTL cache in front of a secrets backend.
+
+    Fresh entries are served from memory. Entries older than refresh_after are
+    still served while one background thread refreshes them; entries older than
+    ttl are fetched synchronously. A failed background refresh keeps serving the
+    cached value until it expires. Ages are measured with clock (seconds,
+    time.monotonic by default).
+    """
+
+    def __init__(self, backend, ttl=SECRETS_TTL, refresh_after=SECRETS_REFRESH_AFTER, clock=time.monotonic):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_after = min(refresh_after, ttl)
+        self.clock = clock
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _fetch(self, secret_name, region_name):
+        secret = self.backend.fetch(secret_name, region_name)
+        with self._lock:
+            self._entries[(secret_name, region_name)] = (self.clock(), secret)
+        return secret
+
+    def _refresh_in_background(self, key):
+        def _refresh():
+            try:
+                self._fetch(*key)
+            except Exception as e:
+                print(f"Error refreshing secret {key[0]}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=_refresh, name=f"refresh-{key[0]}", daemon=True).start()
+
+    def get(self, secret_name, region_name):
+        key = (secret_name, region_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = self.clock() - entry[0]
+                if age < self.ttl:
+                    if age >= self.refresh_after and key not in self._refreshing:
+                        self._refreshing.add(key)
+                        self._refresh_in_background(key)
+                    return entry[1]
+        return self._fetch(secret_name, region_name)
+
+    def invalidate(self, secret_name=None):
+        """Drop one secret (or all) so the next get() fetches it again"""
+        with self._lock:
+            for key in list(self._entries):
+                if secret_name is None or key[0] == secret_name:
+                    del self._entries[key]
+
+_secrets_cache = None
+_secrets_cache_lock = threading.Lock()
+
+def get_secrets_cache():
+    """Return the process-wide secrets cache for the configured backend"""
+    global _secrets_cache
+    if _secrets_cache is None:
+        with _secrets_cache_lock:
+            if _secrets_cache is None:
+                if SECRETS_BACKEND not in SECRETS_BACKENDS:
+                    raise ValueError(f"Unknown secrets backend {SECRETS_BACKEND!r}")
+                _secrets_cache = SecretsCache(SECRETS_BACKENDS[SECRETS_BACKEND]())
+    return _secrets_cache
+
+def get_secret(secret_name, region_name="ap-south-1"):
+    """
+    Retrieve a secret from the configured backend (AWS Secrets Manager by default).
+
+    Results are cached per process; see SecretsCache for the refresh policy.
+
+    :param secret_name: Name of the secret in AWS Secrets Manager
+    :param region_name: AWS region where the secret is stored
+    :return: Dictionary of secret key-value pairs
+    """
+    try:
+        with span("get_secret"):
+            return get_secrets_cache().get(secret_name, region_name)
+
     except Exception as e:
         print(f"Error retrieving secret {secret_name}: {str(e)}")
         raise
@@ -0,0 +1,117 @@
+"""
+Peak memory and time of DICOM decoding for large synthetic studies.
+
+Generates 16-bit DICOMs (single-frame, windowed, multi-frame and RLE
+compressed) at the requested resolution and reports, per file, the
+tracemalloc peak of dicom_utils.decode_dicom next to the original
+dcmread/pixel_array/float64 pipeline. When TensorFlow is installed the
+original pipeline includes its tf.image.resize and the script also prints
+the max absolute difference between the two outputs (with windowing off).
+
+Usage:
+    python benchmarks/bench_dicom.py [--size 3000] [--frames 4]
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dicom_utils import decode_dicom
+
+def synthetic_dicom(size: int, frames: int = 1, window: bool = False, compressed: bool = False) -> bytes:
+    """Build a chest-X-ray-like 16-bit DICOM in memory"""
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, RLELossless, SecondaryCaptureImageStorage, generate_uid
+
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    body = np.exp(-((xx - 0.5) ** 2 / 0.08 + (yy - 0.5) ** 2 / 0.12))
+    lungs = np.exp(-((np.abs(xx - 0.5) - 0.18) ** 2 / 0.01 + (yy - 0.45) ** 2 / 0.05))
+    frame = ((body - 0.6 * lungs).clip(0, 1) * 4000).astype(np.uint16)
+    pixels = np.stack([frame] * frames) if frames > 1 else frame
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "DX"
+    ds.Rows = ds.Columns = size
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    if window:
+        ds.WindowCenter = 2000
+        ds.WindowWidth = 3000
+    ds.PixelData = pixels.tobytes()
+    if compressed:
+        ds.compress(RLELossless)
+
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+def legacy_decode(data: bytes) -> np.ndarray:
+    """The original app.py DICOM branch (resize skipped when TensorFlow is unavailable)"""
+    import pydicom
+    dicom_data = pydicom.dcmread(io.BytesIO(data))
+    img = dicom_data.pixel_array
+    img = (np.maximum(img, 0) / img.max()) * 255.0
+    img = np.uint8(img)
+    if len(img.shape) == 2:
+        img = np.stack((img,)*3, axis=-1)
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return None
+    return tf.image.resize(img, (224, 224)).numpy()
+
+def measure(fn):
+    """Return (result, seconds, peak traced bytes) for fn()"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark DICOM decoding memory")
+    parser.add_argument("--size", type=int, default=3000, help="Rows and columns of the synthetic images")
+    parser.add_argument("--frames", type=int, default=4, help="Frames in the multi-frame case")
+    args = parser.parse_args(argv)
+
+    cases = [
+        ("single-frame", dict()),
+        ("windowed", dict(window=True)),
+        (f"{args.frames}-frame", dict(frames=args.frames)),
+        ("RLE compressed", dict(compressed=True)),
+    ]
+    print(f"{'case':<16} {'file MB':>8} {'new ms':>8} {'new peak MB':>12} {'old ms':>8} {'old peak MB':>12} {'max diff':>9}")
+    for label, options in cases:
+        data = synthetic_dicom(args.size, **options)
+        new_img, new_time, new_peak = measure(lambda: decode_dicom(io.BytesIO(data)))
+        old_img, old_time, old_peak = measure(lambda: legacy_decode(data))
+
+        max_diff = "-"
+        if old_img is not None and old_img.shape == new_img.shape and not options.get("window"):
+            max_diff = f"{np.max(np.abs(old_img - decode_dicom(io.BytesIO(data), windowing=False))):.4f}"
+        print(f"{label:<16} {len(data) / 1e6:8.1f} {new_time * 1000:8.1f} {new_peak / 1e6:12.1f} "
+              f"{old_time * 1000:8.1f} {old_peak / 1e6:12.1f} {max_diff:>9}")
+
+if __name__ == "__main__":
+    main()
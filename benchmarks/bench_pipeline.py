@@ -0,0 +1,71 @@
+"""
+Batch classification throughput against the number of preprocessing processes.
+
+Runs inference_utils.predict_batch serially and pipeline_utils.PreprocessPipeline
+with 2, 4, ... up to --max-workers processes over the sample images (repeated
+to --images-count) and prints images per second and the speedup over the
+serial run. With --no-models the inference stage is skipped, which isolates
+the decode/resize/X-ray stage when TensorFlow or the model files are missing.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--images Images] [--images-count 256] [--max-workers 8] [--no-models]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_utils import DEFAULT_BATCH_SIZE, collect_image_paths, load_models, predict_batch
+from pipeline_utils import PreprocessPipeline, model_predictor
+
+def no_inference(images):
+    """Inference stage stand-in that only reports the batch back"""
+    return [{} for _ in images]
+
+def worker_counts(max_workers: int) -> list:
+    counts, workers = [], 2
+    while workers < max_workers:
+        counts.append(workers)
+        workers *= 2
+    return counts + [max_workers] if max_workers > 1 else counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing pipeline")
+    parser.add_argument("--images", default="Images", help="Directory of sample images")
+    parser.add_argument("--images-count", type=int, default=256, help="Images per run (samples are repeated)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Images per inference call")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1, help="Largest process pool tried")
+    parser.add_argument("--no-models", action="store_true", help="Skip inference and time preprocessing only")
+    args = parser.parse_args(argv)
+
+    samples = collect_image_paths([args.images])
+    paths = [samples[i % len(samples)] for i in range(args.images_count)]
+    if args.no_models:
+        predictor = no_inference
+    else:
+        multi_model, edema_model = load_models()
+        predictor = model_predictor(multi_model, edema_model)
+
+    start = time.perf_counter()
+    if args.no_models:
+        list(PreprocessPipeline(workers=1).run(paths, predictor, args.batch_size))
+    else:
+        predict_batch(paths, multi_model, edema_model, batch_size=args.batch_size)
+    serial = time.perf_counter() - start
+    print(f"cpus: {os.cpu_count()}, images: {len(paths)}, batch size: {args.batch_size}")
+    print(f"{'workers':>8} {'images/s':>10} {'speedup':>8}")
+    print(f"{'serial':>8} {len(paths) / serial:10.1f} {1.0:8.2f}")
+
+    for workers in worker_counts(args.max_workers):
+        with PreprocessPipeline(workers=workers) as pipeline:
+            # Warm the pool so process start-up is not counted
+            list(pipeline.run(paths[:workers], predictor, args.batch_size))
+            start = time.perf_counter()
+            list(pipeline.run(paths, predictor, args.batch_size))
+            elapsed = time.perf_counter() - start
+        print(f"{workers:>8} {len(paths) / elapsed:10.1f} {serial / elapsed:8.2f}")
+
+if __name__ == "__main__":
+    main()
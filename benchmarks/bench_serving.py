@@ -0,0 +1,65 @@
+"""
+Before/after latency of Keras predict() versus the compiled ServingModel.
+
+Runs every sample in Images/ through both paths one image at a time (the
+shape the Streamlit app sees) and prints per-call latency percentiles.
+
+Usage:
+    python benchmarks/bench_serving.py [--images Images] [--repeats 5] [--xla]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_utils import (
+    ServingModel,
+    collect_image_paths,
+    load_image_for_model,
+    load_models
+)
+
+def time_calls(predict, images, repeats: int) -> np.ndarray:
+    """Return per-call latencies in milliseconds for single-image predict calls"""
+    latencies = []
+    for _ in range(repeats):
+        for img in images:
+            batch = np.expand_dims(img, axis=0) / 255.0
+            start = time.perf_counter()
+            predict(batch)
+            latencies.append((time.perf_counter() - start) * 1000.0)
+    return np.array(latencies)
+
+def summarize(label: str, latencies: np.ndarray):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{label:<28} n={len(latencies):<5} mean={latencies.mean():7.2f} ms  "
+          f"p50={p50:7.2f}  p95={p95:7.2f}  p99={p99:7.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", default="Images", help="Directory of sample images")
+    parser.add_argument("--repeats", type=int, default=5, help="Passes over the image set")
+    parser.add_argument("--xla", action="store_true", help="Also time the XLA-compiled variant")
+    args = parser.parse_args(argv)
+
+    images = [load_image_for_model(path) for path in collect_image_paths([args.images])]
+    keras_model, _ = load_models(compiled=False)
+
+    # First call of each path is reported separately as the cold-start cost
+    start = time.perf_counter()
+    keras_model.predict(np.zeros((1, 224, 224, 3), dtype=np.float32), verbose=0)
+    print(f"Keras predict() first call: {(time.perf_counter() - start) * 1000.0:.1f} ms")
+    summarize("Keras predict()", time_calls(lambda x: keras_model.predict(x, verbose=0), images, args.repeats))
+
+    variants = [("ServingModel", False)] + ([("ServingModel (XLA)", True)] if args.xla else [])
+    for label, jit_compile in variants:
+        start = time.perf_counter()
+        serving = ServingModel(keras_model, jit_compile=jit_compile).warmup()
+        print(f"{label} warm-up: {(time.perf_counter() - start) * 1000.0:.1f} ms")
+        summarize(label, time_calls(serving.predict, images, args.repeats))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Cold-start timings for a fresh replica.
+
+Each measurement runs in a new Python process so nothing is already imported:
+  - import time of the modules app.py pulls in (and whether TensorFlow came with them)
+  - time to first render of app.py under Streamlit's AppTest harness
+  - time to first prediction through the lazily loaded models
+
+Usage:
+    python benchmarks/bench_startup.py [--image Images/IM-0003-0001.jpeg]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+import auth_utils, db_utils, ui_utils, inference_utils, scheduler_utils
+print(json.dumps({"import_seconds": time.perf_counter() - start,
+                  "tensorflow_imported": "tensorflow" in sys.modules}))
+"""
+
+RENDER_SNIPPET = """
+import time, json
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+at = AppTest.from_file("app.py", default_timeout=120).run()
+print(json.dumps({"first_render_seconds": time.perf_counter() - start,
+                  "rendered_errors": [e.value for e in at.error],
+                  "exceptions": [e.value for e in at.exception]}))
+"""
+
+PREDICT_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+from inference_utils import load_lazy_models, load_image_for_model, predict_arrays
+multi_model, edema_model = load_lazy_models()
+img = load_image_for_model(sys.argv[1])
+prediction = predict_arrays(img[None], multi_model, edema_model)[0]
+print(json.dumps({"first_prediction_seconds": time.perf_counter() - start,
+                  "multi_model_load_seconds": multi_model.load_seconds,
+                  "edema_model_loaded": edema_model.loaded,
+                  "predicted_class": prediction["predicted_class"]}))
+"""
+
+def run_snippet(stage: str, snippet: str, *args) -> dict:
+    """Run a snippet in a fresh interpreter from the repo root and parse its JSON output"""
+    completed = subprocess.run(
+        [sys.executable, "-c", snippet, *args],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        return {f"{stage}_error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure DiagnoAI cold-start timings")
+    parser.add_argument("--image", default=os.path.join("Images", "IM-0003-0001.jpeg"),
+                        help="Image used for the first prediction")
+    args = parser.parse_args(argv)
+
+    results = {}
+    results.update(run_snippet("import", IMPORT_SNIPPET))
+    results.update(run_snippet("render", RENDER_SNIPPET))
+    results.update(run_snippet("predict", PREDICT_SNIPPET, args.image))
+    print(json.dumps(results, indent=2, default=str))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Reproducible offline benchmark suite; writes one JSON file per run.
+
+Runs without AWS or Postgres (see benchmarks/offline.py) and measures:
+  - decode time per sample image in Images/ and per synthetic large DICOM
+  - is_xray_image time per sample image
+  - multi-class and Edema model latency at batch sizes 1, 8 and 32
+  - end-to-end main() time under Streamlit's AppTest harness, per sample
+    image, first upload (models run) and repeat upload (prediction cache)
+  - peak RSS after each section
+
+Model sections are skipped (and marked so in the JSON) with --no-models or
+when TensorFlow or the model files are unavailable. --fake-models runs the
+end-to-end section with offline.StandInModel instead (optionally sleeping
+--fake-model-ms per image) and skips the model latency section, which would
+only time the stand-ins. --compare prints the change in every median against
+an earlier results file.
+
+Usage:
+    python benchmarks/bench_suite.py [--images Images] [--repeats 5] [--dicom-size 3000]
+                                     [--output bench_results.json] [--compare baseline.json]
+                                     [--no-models | --fake-models [--fake-model-ms 30]]
+"""
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import offline
+
+USERS = offline.install(offline.InMemoryUsers(enforce_limits=False))
+
+from auth_utils import generate_token
+from inference_utils import collect_image_paths, decode_image, load_models
+from ui_utils import is_xray_image
+from bench_dicom import synthetic_dicom
+
+BATCH_SIZES = (1, 8, 32)
+BENCH_EMAIL = "bench@diagnoai.local"
+
+def summarize(seconds: list) -> dict:
+    """Latency summary in milliseconds"""
+    ms = np.asarray(seconds) * 1000.0
+    return {
+        "n": int(len(ms)),
+        "median_ms": round(float(np.median(ms)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "min_ms": round(float(ms.min()), 3),
+        "max_ms": round(float(ms.max()), 3)
+    }
+
+def time_repeats(fn, repeats: int) -> dict:
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds)
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def run_metadata(args) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = {}
+    for module in ("numpy", "PIL", "pydicom", "streamlit", "tensorflow"):
+        try:
+            versions[module] = __import__(module).__version__
+        except Exception:
+            versions[module] = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+        "repeats": args.repeats,
+        "dicom_size": args.dicom_size,
+        "fake_models": args.fake_models
+    }
+
+def bench_decode(paths: list, dicom_size: int, repeats: int) -> dict:
+    """Decode time (model input and preview) per sample image and synthetic DICOM"""
+    results = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        results[os.path.basename(path)] = time_repeats(
+            lambda: decode_image(io.BytesIO(data), name=path), repeats
+        )
+    for label, options in (("single-frame", {}), ("windowed", {"window": True}),
+                           ("4-frame", {"frames": 4}), ("rle-compressed", {"compressed": True})):
+        data = synthetic_dicom(dicom_size, **options)
+        results[f"synthetic-{dicom_size}px-{label}.dcm"] = time_repeats(
+            lambda: decode_image(io.BytesIO(data), name="synthetic.dcm"), repeats
+        )
+    return results
+
+def bench_xray_check(images: dict, repeats: int) -> dict:
+    return {name: time_repeats(lambda: is_xray_image(img), repeats) for name, img in images.items()}
+
+def bench_models(images: list, multi_model, edema_model, repeats: int) -> dict:
+    """Latency of each model at the standard batch sizes, sample images repeated to fill the batch"""
+    results = {}
+    for batch_size in BATCH_SIZES:
+        batch = np.stack([images[i % len(images)] for i in range(batch_size)]) / 255.0
+        # One untimed call so graph tracing for a new batch shape is not counted
+        multi_model.predict(batch, batch_size=batch_size, verbose=0)
+        edema_model.predict(batch, batch_size=batch_size, verbose=0)
+        results[f"batch_{batch_size}"] = {
+            "multi_model": time_repeats(lambda: multi_model.predict(batch, batch_size=batch_size, verbose=0), repeats),
+            "edema_model": time_repeats(lambda: edema_model.predict(batch, batch_size=batch_size, verbose=0), repeats)
+        }
+    return results
+
+def bench_end_to_end(paths: list) -> dict:
+    """main() time per upload under AppTest, signed in with a minted token"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=300)
+    at.query_params["token"] = generate_token(BENCH_EMAIL, "Bench", offline.BENCH_SECRET_KEY)
+    start = time.perf_counter()
+    at.run()
+    results = {"login": summarize([time.perf_counter() - start]), "images": {}}
+    if not at.session_state["authenticated"]:
+        results["error"] = "login failed"
+        return results
+
+    errors = []
+    for attempt in ("first_upload", "repeat_upload"):
+        for index, path in enumerate(paths):
+            upload = offline.OfflineUpload.from_path(path, file_id=f"{attempt}-{index}")
+            offline.set_uploads(BENCH_EMAIL, [upload])
+            start = time.perf_counter()
+            at.run()
+            elapsed = time.perf_counter() - start
+            results["images"].setdefault(os.path.basename(path), {})[attempt] = summarize([elapsed])
+            errors.extend(e.value for e in at.exception)
+    offline.set_uploads(BENCH_EMAIL, None)
+    if errors:
+        results["errors"] = sorted(set(str(e) for e in errors))
+    return results
+
+def collect_medians(node, prefix: str = "") -> dict:
+    """Flatten every median_ms in a results tree to {"path/to/metric": value}"""
+    medians = {}
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "median_ms":
+                medians[prefix] = value
+            else:
+                medians.update(collect_medians(value, f"{prefix}/{key}" if prefix else key))
+    return medians
+
+def compare(baseline: dict, current: dict, threshold: float) -> int:
+    """Print the ratio of every shared median; returns the number of regressions"""
+    old, new = collect_medians(baseline), collect_medians(current)
+    regressions = 0
+    print(f"{'metric':<70} {'base ms':>9} {'new ms':>9} {'ratio':>6}")
+    for metric in sorted(old.keys() & new.keys()):
+        ratio = new[metric] / old[metric] if old[metric] else float("inf")
+        flag = " <-- slower" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"{metric:<70} {old[metric]:9.2f} {new[metric]:9.2f} {ratio:6.2f}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline DiagnoAI benchmark suite")
+    parser.add_argument("--images", default=os.path.join(ROOT, "Images"), help="Directory of sample images")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repeats per measurement")
+    parser.add_argument("--dicom-size", type=int, default=3000, help="Rows and columns of the synthetic DICOMs")
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Ratio reported as a regression")
+    models_group = parser.add_mutually_exclusive_group()
+    models_group.add_argument("--no-models", action="store_true", help="Skip the model and end-to-end sections")
+    models_group.add_argument("--fake-models", action="store_true",
+                              help="Run the end-to-end section with stand-in models (no TensorFlow needed)")
+    parser.add_argument("--fake-model-ms", type=float, default=0.0,
+                        help="Time each stand-in model sleeps per image")
+    args = parser.parse_args(argv)
+
+    paths = collect_image_paths([args.images])
+    results = {"meta": run_metadata(args)}
+
+    results["decode"] = bench_decode(paths, args.dicom_size, args.repeats)
+    results["peak_rss_mb"] = {"decode": peak_rss_mb()}
+
+    images = {os.path.basename(path): decode_image(path, preview_size=None)[0] for path in paths}
+    results["xray_check"] = bench_xray_check(images, args.repeats)
+    results["peak_rss_mb"]["xray_check"] = peak_rss_mb()
+
+    models = None
+    if args.no_models:
+        results["models"] = results["end_to_end"] = {"skipped": "--no-models"}
+    elif args.fake_models:
+        offline.use_stand_in_models(args.fake_model_ms)
+        results["models"] = {"skipped": "--fake-models"}
+        results["end_to_end"] = bench_end_to_end(paths)
+        results["end_to_end"]["models"] = "stand-in"
+        results["peak_rss_mb"]["end_to_end"] = peak_rss_mb()
+    else:
+        try:
+            models = load_models()
+        except Exception as e:
+            results["models"] = results["end_to_end"] = {"skipped": f"models unavailable: {str(e)}"}
+
+    if models is not None:
+        results["models"] = bench_models(list(images.values()), *models, repeats=args.repeats)
+        results["peak_rss_mb"]["models"] = peak_rss_mb()
+        # The app loads its own copies of the models
+        models = None
+        results["end_to_end"] = bench_end_to_end(paths)
+        results["peak_rss_mb"]["end_to_end"] = peak_rss_mb()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
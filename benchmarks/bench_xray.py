@@ -0,0 +1,108 @@
+"""
+Per-image time and peak memory of the X-ray plausibility check, before and after.
+
+"before" is the original single-image is_xray_image (kept here verbatim as the
+reference); "after" is ui_utils.is_xray_batch over the whole batch. The script
+also confirms both give identical decisions on every image.
+
+Usage:
+    python benchmarks/bench_xray.py [--images Images] [--batch-size 32] [--repeats 5]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_utils import collect_image_paths, load_image_for_model
+from ui_utils import is_xray_batch
+
+def legacy_is_xray_image(img_array):
+    """The original per-image implementation, used as the baseline"""
+    if len(img_array.shape) == 3:
+        color_variation = np.std(img_array - np.mean(img_array, axis=2, keepdims=True))
+        if color_variation > 25:
+            return False
+        gray_img = np.mean(img_array, axis=2)
+    else:
+        gray_img = img_array
+
+    mean_intensity = np.mean(gray_img)
+    std_intensity = np.std(gray_img)
+
+    local_contrast = np.std([np.roll(gray_img, i) - gray_img for i in [1, -1, gray_img.shape[1], -gray_img.shape[1]]], axis=0)
+    local_contrast_mean = np.mean(local_contrast)
+
+    hist_range = (20, 235)
+    histogram = np.histogram(gray_img, bins=256, range=hist_range)[0]
+    smoothed_hist = np.convolve(histogram, np.ones(5)/5, mode='valid')
+
+    hist_peaks = np.where(smoothed_hist > np.mean(smoothed_hist) + 0.5 * np.std(smoothed_hist))[0]
+    peak_spread = np.max(hist_peaks) - np.min(hist_peaks) if len(hist_peaks) > 1 else 0
+
+    hist_midpoint = len(smoothed_hist) // 2
+    symmetry_score = np.corrcoef(smoothed_hist[:hist_midpoint], smoothed_hist[hist_midpoint:][::-1])[0,1]
+
+    conditions = [
+        20 < mean_intensity < 235,
+        15 < std_intensity < 80,
+        local_contrast_mean < 25,
+        len(hist_peaks) >= 2,
+        peak_spread > 30,
+        symmetry_score > -0.3,
+        np.max(histogram) < np.prod(gray_img.shape) * 0.3
+    ]
+
+    edges_x = np.diff(gray_img, axis=1)
+    edges_y = np.diff(gray_img, axis=0)
+    edge_intensity = np.mean(np.abs(edges_x)) + np.mean(np.abs(edges_y))
+    if edge_intensity > 30:
+        return False
+
+    return all(conditions)
+
+def measure(fn, repeats: int):
+    """Return (best wall time in seconds, peak traced bytes) for fn()"""
+    fn()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best, peak
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the X-ray plausibility check")
+    parser.add_argument("--images", default="Images", help="Directory of sample images")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per batch (samples are repeated to fill it)")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repetitions; the best is reported")
+    args = parser.parse_args(argv)
+
+    samples = [load_image_for_model(path) for path in collect_image_paths([args.images])]
+    images = np.stack([samples[i % len(samples)] for i in range(max(args.batch_size, len(samples)))])
+
+    legacy_decisions = np.array([legacy_is_xray_image(img) for img in images])
+    batch_decisions = is_xray_batch(images)
+    mismatches = int(np.sum(legacy_decisions != batch_decisions))
+
+    before_time, before_peak = measure(lambda: [legacy_is_xray_image(img) for img in images], args.repeats)
+    after_time, after_peak = measure(lambda: is_xray_batch(images), args.repeats)
+    single_time, single_peak = measure(lambda: is_xray_batch(images[:1]), args.repeats)
+
+    n = len(images)
+    print(f"images: {n}, accepted: {int(batch_decisions.sum())}, decision mismatches: {mismatches}")
+    print(f"before (per-image loop): {before_time / n * 1000:7.2f} ms/image, peak {before_peak / 1e6:7.1f} MB")
+    print(f"after  (batch of {n:>3}):  {after_time / n * 1000:7.2f} ms/image, peak {after_peak / 1e6:7.1f} MB")
+    print(f"after  (batch of   1):  {single_time * 1000:7.2f} ms/image, peak {single_peak / 1e6:7.1f} MB")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""
+Concurrent-session load test of app.py with latency percentiles.
+
+Signs in --sessions simulated users (JWTs minted with auth_utils.generate_token)
+under Streamlit's AppTest harness, then sends uploads at a Poisson arrival
+rate: each arrival takes the next idle session and uploads one file drawn
+from the --mix of JPEG, PNG and DICOM (the sample images in Images/ plus
+synthetic DICOMs). Arrivals that find every session busy wait for one, so
+latency is measured from the arrival time and includes that queueing.
+
+For each rate in --rates the script reports throughput, p50/p95/p99 latency
+and the error, rejection and shed ("busy") rates; the saturation point of the
+process is where throughput stops following the arrival rate and p95 climbs,
+or, with admission control, where uploads start being shed. The
+database is the in-memory stand-in from offline.py (optionally with
+--db-latency-ms per call), or a real Postgres with --database postgres.
+
+The models are the deployed Keras models, which need TensorFlow and the .h5
+files; without them every upload ends in an error. --fake-models runs
+offline.StandInModel instead (optionally sleeping --fake-model-ms per image),
+which measures everything around inference but not inference itself.
+
+Usage:
+    python benchmarks/load_test.py [--sessions 8] [--rates 1,2,4,8] [--requests 100]
+                                   [--mix jpeg=0.5,png=0.3,dicom=0.2] [--output load_results.json]
+                                   [--fake-models [--fake-model-ms 30]]
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import offline
+
+OUTCOMES = ("ok", "not_xray", "usage_limit", "busy", "error")
+
+# share_streamlit_runtime() patches Streamlit internals (Runtime.instance and
+# Runtime.exists, ScriptCache.get_bytecode). Checked against these versions:
+# 1.49.1 is the one pinned in pyproject.toml
+STREAMLIT_TESTED_VERSIONS = ("1.49.1", "1.65.0")
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"jpeg", "png", "dicom"}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown file types in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+def load_corpus(images_dir: str, dicom_size: int) -> dict:
+    """Upload payloads by type: (file name, bytes) pairs"""
+    from inference_utils import collect_image_paths
+    from bench_dicom import synthetic_dicom
+
+    corpus = {"jpeg": [], "png": [], "dicom": []}
+    for path in collect_image_paths([images_dir]):
+        extension = os.path.splitext(path)[1].lower()
+        kind = {".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png", ".dcm": "dicom"}[extension]
+        with open(path, "rb") as f:
+            corpus[kind].append((os.path.basename(path), f.read()))
+    corpus["dicom"].append((f"synthetic-{dicom_size}.dcm", synthetic_dicom(dicom_size)))
+    corpus["dicom"].append((f"synthetic-{dicom_size}-windowed.dcm", synthetic_dicom(dicom_size, window=True)))
+    return corpus
+
+def classify(at) -> str:
+    """Outcome of one script run from what the app rendered"""
+    if at.exception:
+        return "error"
+    messages = [element.value for element in at.error] + [element.value for element in at.success]
+    if any("The model predicts" in message for message in messages):
+        return "ok"
+    if any("does not appear to be an X-ray" in message for message in messages):
+        return "not_xray"
+    if any("usage limit" in message for message in messages):
+        return "usage_limit"
+    if any("service is busy" in element.value for element in at.warning):
+        return "busy"
+    return "error"
+
+def share_streamlit_runtime():
+    """
+    Let AppTest sessions run concurrently in this process.
+
+    AppTest installs a mock Runtime singleton for each script run and clears
+    it when the run ends, so a run that finishes while another is still
+    executing pulls the runtime out from under it. Keep serving the most
+    recent mock between runs instead; the sessions share its media and
+    cache managers, as sessions of a real server share its runtime. Each run
+    also compiles app.py afresh, and concurrent compiles are not safe, so
+    compilation is serialized.
+    """
+    import streamlit
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    if not (hasattr(Runtime, "_instance") and hasattr(ScriptCache, "get_bytecode")):
+        raise RuntimeError(f"Concurrent sessions are not supported with Streamlit {streamlit.__version__} "
+                           f"(tested with {', '.join(STREAMLIT_TESTED_VERSIONS)})")
+    if streamlit.__version__ not in STREAMLIT_TESTED_VERSIONS:
+        print(f"Warning: concurrent sessions were tested with Streamlit {', '.join(STREAMLIT_TESTED_VERSIONS)}, "
+              f"not {streamlit.__version__}")
+    last = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            last["runtime"] = cls._instance
+        runtime = cls._instance or last.get("runtime")
+        if runtime is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return runtime
+
+    def exists(cls):
+        return cls._instance is not None or "runtime" in last
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(exists)
+
+    get_bytecode = ScriptCache.get_bytecode
+    compile_lock = threading.Lock()
+
+    def locked_get_bytecode(self, script_path):
+        with compile_lock:
+            return get_bytecode(self, script_path)
+
+    ScriptCache.get_bytecode = locked_get_bytecode
+
+class Session:
+    """One signed-in simulated user driving app.py through AppTest"""
+
+    def __init__(self, index: int, secret_key: str, timeout: float):
+        from streamlit.testing.v1 import AppTest
+        from auth_utils import generate_token
+
+        self.email = f"load-{index}@diagnoai.local"
+        self.at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=timeout)
+        self.at.query_params["token"] = generate_token(self.email, f"Load {index}", secret_key)
+        self.at.run()
+        self.uploads = 0
+
+    def upload(self, name: str, data: bytes) -> str:
+        self.uploads += 1
+        offline.set_uploads(self.email, [offline.OfflineUpload(data, name, f"{self.email}-{self.uploads}")])
+        self.at.run()
+        return classify(self.at)
+
+def percentiles(seconds: list) -> dict:
+    if not seconds:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    ms = np.asarray(seconds) * 1000.0
+    return {f"p{q}_ms": round(float(np.percentile(ms, q)), 1) for q in (50, 95, 99)}
+
+def run_phase(sessions: list, corpus: dict, mix: dict, rate: float, requests: int, seed: int) -> dict:
+    """Send requests uploads at a Poisson rate per second and summarize them"""
+    rng = random.Random(seed)
+    kinds = [kind for kind in mix if corpus[kind]]
+    weights = [mix[kind] for kind in kinds]
+
+    idle = queue.Queue()
+    for session in sessions:
+        idle.put(session)
+    records = []
+    records_lock = threading.Lock()
+
+    def handle(arrival: float, name: str, data: bytes):
+        session = idle.get()
+        started = time.perf_counter()
+        try:
+            outcome = session.upload(name, data)
+        except Exception:
+            outcome = "error"
+        finished = time.perf_counter()
+        idle.put(session)
+        with records_lock:
+            records.append((outcome, finished - arrival, finished - started))
+
+    phase_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=requests) as executor:
+        arrival = phase_start
+        for _ in range(requests):
+            arrival += rng.expovariate(rate)
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = rng.choices(kinds, weights)[0]
+            name, data = rng.choice(corpus[kind])
+            executor.submit(handle, arrival, name, data)
+    elapsed = time.perf_counter() - phase_start
+
+    counts = {outcome: sum(1 for record in records if record[0] == outcome) for outcome in OUTCOMES}
+    answered = [record for record in records if record[0] != "error"]
+    return {
+        "rate": rate,
+        "requests": len(records),
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(len(records) / elapsed, 2),
+        "latency": percentiles([record[1] for record in answered]),
+        "service_time": percentiles([record[2] for record in answered]),
+        "outcomes": counts,
+        "error_rate": round(counts["error"] / max(1, len(records)), 4),
+        "rejection_rate": round((counts["usage_limit"] + counts["not_xray"]) / max(1, len(records)), 4),
+        "shed_rate": round(counts["busy"] / max(1, len(records)), 4)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test app.py with concurrent simulated sessions")
+    parser.add_argument("--sessions", type=int, default=8, help="Concurrent signed-in sessions")
+    parser.add_argument("--rates", default="1,2,4,8", help="Comma-separated arrival rates (uploads per second)")
+    parser.add_argument("--requests", type=int, default=100, help="Uploads sent at each rate")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("jpeg=0.5,png=0.3,dicom=0.2"),
+                        help="Relative weights of jpeg, png and dicom uploads")
+    parser.add_argument("--images", default=os.path.join(ROOT, "Images"), help="Directory of sample images")
+    parser.add_argument("--dicom-size", type=int, default=2048, help="Rows and columns of the synthetic DICOMs")
+    parser.add_argument("--free-limit", type=int, default=10 ** 6,
+                        help="Free analyses per user (the app's FREE_USAGE_LIMIT); lower it to exercise rejections")
+    parser.add_argument("--database", choices=("memory", "postgres"), default="memory",
+                        help="In-memory database stand-in, or the Postgres configured via DIAGNOAI_SECRET_DB_*")
+    parser.add_argument("--db-latency-ms", type=float, default=0.0, help="Simulated round trip of the in-memory database")
+    parser.add_argument("--fake-models", action="store_true",
+                        help="Use stand-in models instead of the Keras models (no TensorFlow needed)")
+    parser.add_argument("--fake-model-ms", type=float, default=0.0,
+                        help="Time each stand-in model sleeps per image")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds one script run may take")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for arrivals and file choice")
+    parser.add_argument("--output", help="Also write the results as JSON")
+    args = parser.parse_args(argv)
+
+    offline.install(offline.InMemoryUsers(db_latency_ms=args.db_latency_ms),
+                    replace_database=args.database == "memory")
+    if args.fake_models:
+        offline.use_stand_in_models(args.fake_model_ms)
+    import auth_utils
+    from aws_secrets_utils import get_secret
+    auth_utils.FREE_USAGE_LIMIT = args.free_limit
+    secret_key = get_secret("diagnoai-secrets").get("SECRET_KEY")
+
+    corpus = load_corpus(args.images, args.dicom_size)
+    share_streamlit_runtime()
+    print(f"Signing in {args.sessions} sessions...")
+    sessions = [Session(index, secret_key, args.timeout) for index in range(args.sessions)]
+    signed_in = [session for session in sessions if session.at.session_state["authenticated"]]
+    if len(signed_in) < len(sessions):
+        print(f"{len(sessions) - len(signed_in)} sessions failed to sign in")
+    if not signed_in:
+        return 1
+
+    phases = []
+    print(f"{'rate':>6} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'rejected':>9} {'shed':>6}")
+    for index, rate in enumerate(float(rate) for rate in args.rates.split(",")):
+        phase = run_phase(signed_in, corpus, args.mix, rate, args.requests, args.seed + index)
+        phases.append(phase)
+        latency = phase["latency"]
+        print(f"{rate:6.1f} {phase['throughput_rps']:7.2f} {latency['p50_ms'] or 0:8.1f} {latency['p95_ms'] or 0:8.1f} "
+              f"{latency['p99_ms'] or 0:8.1f} {phase['error_rate']:7.1%} {phase['rejection_rate']:9.1%} {phase['shed_rate']:6.1%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {"timestamp": datetime.now(timezone.utc).isoformat(), "cpu_count": os.cpu_count(),
+                         **{key: value for key, value in vars(args).items() if key != "mix"}, "mix": args.mix},
+                "phases": phases
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Offline stand-ins for the secrets backend and Postgres, shared by the benchmark
+and load test scripts.
+
+install() points the secrets lookup at environment variables, keeps session
+state in memory, and replaces the db_utils functions on the request
+path (user bootstrap, usage metering, ledger writes) with an in-memory users
+table that follows the same semantics. It must run before auth_utils,
+ledger_utils or app are imported, since they bind those functions at import.
+
+set_uploads() makes the app's file uploader return the given files for one
+signed-in user, so app.py can be driven end to end under Streamlit's AppTest
+harness (which runs the script on its own thread).
+
+use_stand_in_models() replaces the Keras models with StandInModel, for runs
+without TensorFlow or the .h5 files.
+"""
+import io
+import os
+import sys
+import time
+import threading
+
+import numpy as np
+from typing import Optional
+
+BENCH_SECRET_KEY = "diagnoai-offline-secret"
+
+class InMemoryUsers:
+    """
+    Stand-in for bbt_user_doctorai and bbt_usage_ledger_doctorai.
+
+    Optional db_latency_ms is slept on every call, to model the round trip
+    to a real database. With enforce_limits False every analysis is admitted,
+    so benchmarks can run more images than the free quota.
+    """
+
+    def __init__(self, db_latency_ms: float = 0.0, enforce_limits: bool = True):
+        self.db_latency = max(0.0, db_latency_ms) / 1000.0
+        self.enforce_limits = enforce_limits
+        self.users = {}
+        self.ledger_rows = 0
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        if self.db_latency:
+            time.sleep(self.db_latency)
+
+    def bootstrap_user(self, email: str, name: str) -> Optional[dict]:
+        self._round_trip()
+        with self._lock:
+            created = email not in self.users
+            user = self.users.setdefault(email, {
+                "usage_count": 0, "paid_user": False, "premium_usage_count": 0, "subscription_expires_at": None
+            })
+            return {**user, "created": created}
+
+    def consume_usage_in_db(self, email: str, premium: bool = False, limit: Optional[int] = None,
+                            count: int = 1) -> Optional[dict]:
+        self._round_trip()
+        column = "premium_usage_count" if premium else "usage_count"
+        with self._lock:
+            user = self.users.get(email)
+            if user is None:
+                return None
+            admitted = count if limit is None or not self.enforce_limits else min(count, max(limit - user[column], 0))
+            if not admitted:
+                return {"admitted": False, "admitted_count": 0, "usage_count": None, "premium_usage_count": None}
+            user[column] += admitted
+            return {"admitted": True, "admitted_count": admitted,
+                    "usage_count": user["usage_count"], "premium_usage_count": user["premium_usage_count"]}
+
+    def create_usage_ledger_table(self) -> bool:
+        return True
+
+    def insert_usage_ledger_rows(self, rows: list) -> bool:
+        self._round_trip()
+        with self._lock:
+            self.ledger_rows += len(rows)
+        return True
+
+# The db_utils functions install() replaces, and the originals it replaced (for tests of the real statements)
+DB_FUNCTIONS = ("bootstrap_user", "consume_usage_in_db", "create_usage_ledger_table", "insert_usage_ledger_rows")
+REAL_DB_FUNCTIONS = {}
+
+def install(users: Optional[InMemoryUsers] = None, replace_database: bool = True) -> Optional[InMemoryUsers]:
+    """
+    Route secrets, state and the request path's database calls to local stand-ins.
+
+    With replace_database False the real db_utils functions (and the
+    postgres state backend) are kept, e.g. to run against a local Postgres
+    configured through DIAGNOAI_SECRET_DB_* variables; users is then None.
+    """
+    already_bound = [name for name in ("auth_utils", "ledger_utils", "app") if name in sys.modules]
+    if already_bound:
+        raise RuntimeError(f"install() must run before importing {', '.join(already_bound)}")
+
+    os.environ.setdefault("DIAGNOAI_SECRETS_BACKEND", "env")
+    os.environ.setdefault("DIAGNOAI_SECRET_SECRET_KEY", BENCH_SECRET_KEY)
+    if not replace_database:
+        users = None
+    else:
+        os.environ.setdefault("DIAGNOAI_STATE_BACKEND", "memory")
+        users = users or InMemoryUsers()
+        import db_utils
+        for name in DB_FUNCTIONS:
+            REAL_DB_FUNCTIONS.setdefault(name, getattr(db_utils, name))
+            setattr(db_utils, name, getattr(users, name))
+
+    import ui_utils
+    original_uploader = ui_utils.blue_file_uploader
+
+    def file_uploader(*args, **kwargs):
+        import streamlit as st
+        uploads = _uploads.get(st.session_state.get("user_email"))
+        if uploads is None:
+            return original_uploader(*args, **kwargs)
+        return list(uploads) if kwargs.get("accept_multiple_files") else (uploads[0] if uploads else None)
+
+    ui_utils.blue_file_uploader = file_uploader
+    return users
+
+class StandInModel:
+    """
+    Deterministic stand-in for a Keras model with outputs columns.
+
+    Each image gets a 0.9 score in one column chosen from its pixel mean,
+    so results vary between images but are repeatable. latency_ms is slept
+    per image, so a run can model some inference cost; sleeping does not use
+    the CPU, so numbers from stand-in runs measure the app around the models,
+    not the models themselves.
+    """
+
+    def __init__(self, outputs: int, latency_ms: float = 0.0):
+        self.outputs = outputs
+        self.latency = max(0.0, latency_ms) / 1000.0
+
+    def predict(self, x, batch_size=None, verbose=0) -> np.ndarray:
+        x = np.asarray(x)
+        if self.latency:
+            time.sleep(self.latency * len(x))
+        scores = np.zeros((len(x), self.outputs), dtype=np.float32)
+        for row, image in enumerate(x):
+            scores[row, int(image.mean() * 1000) % self.outputs] = 0.9
+        return scores
+
+def use_stand_in_models(latency_ms: float = 0.0):
+    """Make inference_utils.load_model return StandInModels; must run before importing app"""
+    if "app" in sys.modules:
+        raise RuntimeError("use_stand_in_models() must run before importing app")
+    import inference_utils
+
+    def load_model(model_path: str, **kwargs):
+        edema = os.path.basename(model_path) == os.path.basename(inference_utils.EDEMA_MODEL_PATH)
+        outputs = 1 if edema else len(inference_utils.MULTI_CLASS_NAMES)
+        return StandInModel(outputs, latency_ms)
+
+    inference_utils.load_model = load_model
+
+class OfflineUpload(io.BytesIO):
+    """In-memory stand-in for Streamlit's UploadedFile"""
+
+    def __init__(self, data: bytes, name: str, file_id: str):
+        super().__init__(data)
+        self.name = name
+        self.file_id = file_id
+        self.size = len(data)
+
+    @classmethod
+    def from_path(cls, path: str, file_id: str):
+        with open(path, "rb") as f:
+            return cls(f.read(), os.path.basename(path), file_id)
+
+# Keyed by user email, so concurrent simulated sessions each see their own uploads
+_uploads = {}
+
+def set_uploads(email: str, files):
+    """Make the file uploader return files for email's sessions (None restores the real widget)"""
+    if files is None:
+        _uploads.pop(email, None)
+    else:
+        _uploads[email] = list(files)
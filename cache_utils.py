@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Cache defaults, overridable through the environment
+PREDICTION_CACHE_SIZE = int(os.environ.get("DIAGNOAI_CACHE_SIZE", "1024"))
+PREDICTION_CACHE_DIR = os.environ.get("DIAGNOAI_CACHE_DIR") or None
+
+def prediction_cache_key(data, model_version: str) -> str:
+    """Content address of an upload: SHA-256 over the model version and the raw bytes (any bytes-like object)"""
+    digest = hashlib.sha256(model_version.encode("utf-8"))
+    digest.update(data)
+    return digest.hexdigest()
+
+class PredictionCache:
+    """
+    Content-addressed cache of prediction results.
+
+    Entries hold the X-ray check verdict, the multi-class probability vector
+    and the Edema score for one upload. They live in a bounded in-memory LRU
+    and, when disk_dir is set, in a persistent tier of small JSON files that
+    survives restarts and is shared by processes on the same host.
+    """
+
+    def __init__(self, max_entries: int = PREDICTION_CACHE_SIZE, disk_dir: Optional[str] = PREDICTION_CACHE_DIR):
+        """
+        Args:
+            max_entries (int): Maximum number of entries kept in memory
+            disk_dir (str, optional): Directory for the on-disk tier
+        """
+        self.max_entries = max(1, max_entries)
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _remember(self, key: str, entry: dict):
+        """Insert into the LRU, evicting the least recently used entry when full"""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return the cached entry for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "r") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    self._remember(key, entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, entry: dict):
+        """Store an entry in memory and, if enabled, on disk"""
+        with self._lock:
+            self._remember(key, entry)
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(entry, f)
+                # Atomic so concurrent readers never see a partial file
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Error writing prediction cache entry {key}: {str(e)}")
+
+    def stats(self) -> dict:
+        """Hit and miss counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "entries": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -1,225 +1,602 @@
+import os
+import json
+import time
+import threading
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from contextlib import contextmanager
 from typing import Optional
 from datetime import datetime, timedelta
 
 # Import AWS Secrets Manager utility
 from aws_secrets_utils import get_secret
+from metrics_utils import span, increment
 
-def get_db_connection():
-    """Create and return a database connection"""
+# Connection pool settings, overridable through the environment
+DB_POOL_MIN_SIZE = int(os.environ.get("DIAGNOAI_DB_POOL_MIN", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DIAGNOAI_DB_POOL_MAX", "10"))
+# Seconds to wait for a free connection when the pool is exhausted
+DB_POOL_TIMEOUT = float(os.environ.get("DIAGNOAI_DB_POOL_TIMEOUT", "10"))
+# Connections idle for longer than this are checked with SELECT 1 before reuse
+DB_HEALTHCHECK_IDLE_SECONDS = float(os.environ.get("DIAGNOAI_DB_HEALTHCHECK_IDLE", "30"))
+
+def report_error(message: str):
+    """
+    Show a database error to the user, or print it when not on a script thread
+    (the usage ledger's writer thread, command-line tools), where Streamlit
+    elements cannot be shown.
+    """
+    if get_script_run_ctx(suppress_warning=True) is None:
+        print(message)
+    else:
+        st.error(message)
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+_connection_last_used = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    """Return the process-wide connection pool, creating it on first use"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                # Retrieve database secrets from AWS Secrets Manager
+                secrets = get_secret("diagnoai-secrets")
+                _db_pool = ThreadedConnectionPool(
+                    DB_POOL_MIN_SIZE,
+                    DB_POOL_MAX_SIZE,
+                    host=secrets.get("DB_HOST"),
+                    database=secrets.get("DB_NAME"),
+                    user=secrets.get("DB_USER"),
+                    password=secrets.get("DB_PASSWORD"),
+                    port=secrets.get("DB_PORT")
+                )
+    return _db_pool
+
+def _is_connection_healthy(conn) -> bool:
+    """Check a pooled connection, pinging it only if it has been idle for a while"""
+    if conn.closed:
+        return False
+    idle = time.monotonic() - _connection_last_used.get(id(conn), 0)
+    if idle < DB_HEALTHCHECK_IDLE_SECONDS:
+        return True
     try:
-        # Retrieve database secrets from AWS Secrets Manager
-        secrets = get_secret("diagnoai-secrets")
-        
-        conn = psycopg2.connect(
-            host=secrets.get("DB_HOST"),
-            database=secrets.get("DB_NAME"),
-            user=secrets.get("DB_USER"),
-            password=secrets.get("DB_PASSWORD"),
-            port=secrets.get("DB_PORT")
-        )
-        return conn
-    except Exception as e:
-        st.error(f"Failed to connect to database: {str(e)}")
-        return None
-
-def get_user_usage_from_db(email: str) -> int:
-    """Get user's usage count from database"""
-    conn = None
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _borrow_connection(pool: ThreadedConnectionPool):
+    """Take a healthy connection from the pool, replacing dead idle ones"""
+    conn = pool.getconn()
+    while not _is_connection_healthy(conn):
+        _connection_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def _release_connection(pool: ThreadedConnectionPool, conn):
+    """End any open transaction and return the connection to the pool"""
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _connection_last_used.pop(id(conn), None)
+    else:
+        _connection_last_used[id(conn)] = time.monotonic()
+    pool.putconn(conn, close=broken)
+
+@contextmanager
+def db_connection():
+    """
+    Borrow a warm connection from the process-wide pool.
+
+    Yields None (after reporting the error) if no connection can be obtained.
+    Waits up to DB_POOL_TIMEOUT seconds when every connection is in use.
+    Uncommitted work is rolled back when the connection is returned.
+    """
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        increment("db_errors", kind="connect")
+        report_error("Failed to connect to database: connection pool exhausted")
+        yield None
+        return
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return 0
-            
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        query = """
-            SELECT usage_count 
-            FROM bbt_user_doctorai 
-            WHERE email = %s
-        """
-        cursor.execute(query, (email,))
-        result = cursor.fetchone()
-        
-        if result:
-            return result['usage_count'] or 0
-        return 0
-        
-    except Exception as e:
-        st.error(f"Database error: {str(e)}")
-        return 0
+        try:
+            with span("db_connect"):
+                pool = get_db_pool()
+                conn = _borrow_connection(pool)
+        except Exception as e:
+            increment("db_errors", kind="connect")
+            report_error(f"Failed to connect to database: {str(e)}")
+            yield None
+            return
+
+        try:
+            yield conn
+        finally:
+            _release_connection(pool, conn)
     finally:
-        if conn:
-            conn.close()
+        _db_pool_slots.release()
 
-def update_user_usage_in_db(email: str, new_count: int) -> bool:
-    """Update user's usage count in database"""
-    conn = None
-    try:
-        conn = get_db_connection()
+# Whether bbt_user_doctorai.email has a unique index (None until checked), and when it was last checked
+_user_email_unique = None
+_user_email_unique_checked_at = 0.0
+# A missing index is looked for again after this many seconds, so the migration is picked up without a restart
+USER_EMAIL_INDEX_RECHECK_SECONDS = float(os.environ.get("DIAGNOAI_USER_EMAIL_INDEX_RECHECK", "300"))
+
+def has_unique_user_email() -> Optional[bool]:
+    """
+    Check whether bbt_user_doctorai.email has a unique index or constraint,
+    which bootstrap_user's ON CONFLICT (email) upsert requires.
+
+    Only the catalog is read; the index itself is created once, outside the
+    app, by migrations/bbt_user_doctorai_email_key.sql.
+
+    Returns:
+        bool: Whether the index exists, or None on a database error
+    """
+    with db_connection() as conn:
         if not conn:
-            return False
+            return None
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT 1 FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = 'bbt_user_doctorai'::regclass
+                  AND i.indisunique AND i.indisvalid AND i.indnatts = 1 AND a.attname = 'email'
+            """)
+            return cursor.fetchone() is not None
             
-        cursor = conn.cursor()
-        
-        # Check if user exists
-        check_query = "SELECT email FROM bbt_user_doctorai WHERE email = %s"
-        cursor.execute(check_query, (email,))
-        user_exists = cursor.fetchone()
-        
-        if user_exists:
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return None
+
+def _user_status(result, created: bool) -> dict:
+    """Shape a bbt_user_doctorai row into bootstrap_user's result"""
+    return {
+        "usage_count": result['usage_count'] or 0,
+        "paid_user": bool(result['paid_user']),
+        "premium_usage_count": result['premium_usage_count'] or 0,
+        "subscription_expires_at": result['subscription_expires_at'],
+        "created": created
+    }
+
+def bootstrap_user(email: str, name: str) -> Optional[dict]:
+    """
+    Create the user if missing and return their status in one statement, at login.
+
+    Existing users are only read: the insert runs only when no row was found,
+    so it neither writes nor draws a value from the id sequence. New users are
+    inserted and their defaults returned. Until the unique index on email
+    exists, the check-then-insert of _bootstrap_user_without_upsert is used
+    instead.
+
+    Returns:
+        dict: usage_count, paid_user, premium_usage_count, subscription_expires_at
+        and created, or None on a database error
+    """
+    global _user_email_unique, _user_email_unique_checked_at
+    now = time.monotonic()
+    if not _user_email_unique and now - _user_email_unique_checked_at >= USER_EMAIL_INDEX_RECHECK_SECONDS:
+        unique = has_unique_user_email()
+        if unique is None:
+            return None
+        _user_email_unique, _user_email_unique_checked_at = unique, now
+    if not _user_email_unique:
+        return _bootstrap_user_without_upsert(email, name)
+
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
             query = """
-                UPDATE bbt_user_doctorai 
-                SET usage_count = %s 
-                WHERE email = %s
-                RETURNING usage_count
+                WITH existing AS (
+                    SELECT usage_count, paid_user, premium_usage_count, subscription_expires_at, FALSE AS created
+                    FROM bbt_user_doctorai 
+                    WHERE email = %s
+                    LIMIT 1
+                ), inserted AS (
+                    INSERT INTO bbt_user_doctorai 
+                    (email, name, usage_count, premium_usage_count, paid_user, password_hash)
+                    SELECT %s, %s, 0, 0, 0, 'none'
+                    WHERE NOT EXISTS (SELECT 1 FROM existing)
+                    ON CONFLICT (email) DO NOTHING
+                    RETURNING usage_count, paid_user, premium_usage_count, subscription_expires_at, TRUE AS created
+                )
+                SELECT * FROM existing
+                UNION ALL
+                SELECT * FROM inserted
+                LIMIT 1
             """
-            cursor.execute(query, (new_count, email))
+            cursor.execute(query, (email, email, name))
+            result = cursor.fetchone()
+            if not result:
+                # A concurrent first login inserted the row after this statement's
+                # snapshot was taken; a new statement sees it
+                cursor.execute("""
+                    SELECT usage_count, paid_user, premium_usage_count, subscription_expires_at, FALSE AS created
+                    FROM bbt_user_doctorai 
+                    WHERE email = %s
+                """, (email,))
+                result = cursor.fetchone()
             conn.commit()
-            return True
-        else:
-            st.error(f"User with email {email} not found in database")
-            return False
-        
-    except Exception as e:
-        st.error(f"Database error: {str(e)}")
-        if conn:
+            
+            if not result:
+                return None
+            return _user_status(result, bool(result['created']))
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
             conn.rollback()
-        return False
-    finally:
-        if conn:
-            conn.close()
+            return None
 
-def ensure_user_exists(email: str, name: str) -> bool:
-    """Create user if not exists in database"""
-    conn = None
-    try:
-        conn = get_db_connection()
+def _bootstrap_user_without_upsert(email: str, name: str) -> Optional[dict]:
+    """
+    bootstrap_user for tables without the unique index on email: read the
+    user, and insert them if missing. Two racing first logins can both
+    insert, as before the index was introduced.
+    """
+    with db_connection() as conn:
         if not conn:
-            return False
+            return None
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("""
+                SELECT usage_count, paid_user, premium_usage_count, subscription_expires_at
+                FROM bbt_user_doctorai 
+                WHERE email = %s
+                LIMIT 1
+            """, (email,))
+            result = cursor.fetchone()
+            if result:
+                return _user_status(result, False)
             
-        cursor = conn.cursor()
-        
-        # Check if user exists
-        check_query = "SELECT email FROM bbt_user_doctorai WHERE email = %s"
-        cursor.execute(check_query, (email,))
-        user_exists = cursor.fetchone()
-        
-        if not user_exists:
-            insert_query = """
+            cursor.execute("""
                 INSERT INTO bbt_user_doctorai 
                 (email, name, usage_count, premium_usage_count, paid_user, password_hash)
                 VALUES (%s, %s, 0, 0, 0, 'none')
+                RETURNING usage_count, paid_user, premium_usage_count, subscription_expires_at
+            """, (email, name))
+            result = cursor.fetchone()
+            conn.commit()
+            return _user_status(result, True)
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return None
+
+def consume_usage_in_db(email: str, premium: bool = False, limit: Optional[int] = None, count: int = 1) -> Optional[dict]:
+    """
+    Atomically check the usage limit and count up to count analyses.
+
+    A single UPDATE ... RETURNING locks the user's row, admits as many of the
+    count analyses as fit under limit (all of them when limit is None) and adds
+    them to the free or premium counter, so concurrent requests from the same
+    user can neither lose increments nor overshoot. A multi-file batch is
+    metered with one call.
+
+    Returns:
+        dict: admitted flag, admitted_count, and the usage_count and
+        premium_usage_count after the update (None when nothing was admitted),
+        or None on a database error or if the user does not exist
+    """
+    column = "premium_usage_count" if premium else "usage_count"
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            query = f"""
+                UPDATE bbt_user_doctorai u
+                SET {column} = COALESCE(u.{column}, 0) + allowed.n
+                FROM (
+                    SELECT email,
+                           CASE WHEN %(limit)s IS NULL THEN %(count)s
+                                ELSE LEAST(%(count)s, GREATEST(%(limit)s - COALESCE({column}, 0), 0))
+                           END AS n
+                    FROM bbt_user_doctorai 
+                    WHERE email = %(email)s
+                    FOR UPDATE
+                ) AS allowed
+                WHERE u.email = allowed.email AND allowed.n > 0
+                RETURNING allowed.n AS admitted_count, u.usage_count, u.premium_usage_count
             """
-            cursor.execute(insert_query, (email, name))
+            cursor.execute(query, {"email": email, "limit": limit, "count": count})
+            result = cursor.fetchone()
+            if not result:
+                # Nothing admitted: tell a missing user apart from one at the limit
+                cursor.execute("SELECT 1 FROM bbt_user_doctorai WHERE email = %s", (email,))
+                if cursor.fetchone() is None:
+                    report_error(f"User with email {email} not found in database")
+                    return None
+            conn.commit()
+            
+            if result:
+                return {
+                    "admitted": True,
+                    "admitted_count": result['admitted_count'],
+                    "usage_count": result['usage_count'] or 0,
+                    "premium_usage_count": result['premium_usage_count'] or 0
+                }
+            return {"admitted": False, "admitted_count": 0, "usage_count": None, "premium_usage_count": None}
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return None
+
+# Append-only record of every analysis, written in batches by ledger_utils.UsageLedger
+USAGE_LEDGER_COLUMNS = (
+    "created_at", "email", "premium", "is_xray", "predicted_class",
+    "confidence", "edema_prediction", "probabilities", "latency_ms", "cached"
+)
+
+def create_usage_ledger_table() -> bool:
+    """Create the usage and prediction ledger table if it does not exist"""
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS bbt_usage_ledger_doctorai (
+                    id BIGSERIAL PRIMARY KEY,
+                    created_at TIMESTAMPTZ NOT NULL,
+                    email TEXT NOT NULL,
+                    premium BOOLEAN NOT NULL DEFAULT FALSE,
+                    is_xray BOOLEAN,
+                    predicted_class TEXT,
+                    confidence REAL,
+                    edema_prediction REAL,
+                    probabilities JSONB,
+                    latency_ms REAL,
+                    cached BOOLEAN NOT NULL DEFAULT FALSE
+                )
+            """)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS bbt_usage_ledger_doctorai_email_idx
+                ON bbt_usage_ledger_doctorai (email, created_at)
+            """)
             conn.commit()
-            st.info(f"Created new user account for {email}")
             return True
-        
-        return True
-        
-    except Exception as e:
-        st.error(f"Database error: {str(e)}")
-        if conn:
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
             conn.rollback()
-        return False
-    finally:
-        if conn:
-            conn.close()
+            return False
 
-def increment_usage(user_email: Optional[str] = None) -> bool:
-    """Increment usage count in both session state and database"""
-    try:
-        if st.session_state.paid_user or st.session_state.get("premium_user", False):
-            st.session_state.premium_usage_count += 1
+def insert_usage_ledger_rows(rows: list) -> bool:
+    """
+    Append ledger rows with one multi-row INSERT.
+
+    Args:
+        rows (list): Tuples in USAGE_LEDGER_COLUMNS order
+    """
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            query = f"""
+                INSERT INTO bbt_usage_ledger_doctorai ({", ".join(USAGE_LEDGER_COLUMNS)})
+                VALUES %s
+            """
+            execute_values(cursor, query, rows, page_size=max(1, len(rows)))
+            conn.commit()
             return True
             
-        if not user_email:
-            user_email = st.session_state.get("user_email")
-        
-        if not user_email:
-            st.error("No user email found in session")
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
             return False
+
+def reconcile_usage_counts(subscription_days: int) -> Optional[int]:
+    """
+    Raise the users' counters to what the ledger recorded.
+
+    usage_count is compared with all free analyses in the ledger and
+    premium_usage_count with the premium analyses of the current subscription
+    (the subscription_days before subscription_expires_at). Counters are never
+    lowered, since usage from before the ledger existed is not in it.
+
+    Returns:
+        int: Number of users whose counters were corrected, or None on error
+    """
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            query = """
+                WITH ledger AS (
+                    SELECT u.email,
+                           COUNT(l.id) FILTER (WHERE NOT l.premium) AS free_count,
+                           COUNT(l.id) FILTER (
+                               WHERE l.premium
+                                 AND u.subscription_expires_at IS NOT NULL
+                                 AND l.created_at > to_timestamp(u.subscription_expires_at) - make_interval(days => %s)
+                           ) AS premium_count
+                    FROM bbt_user_doctorai u
+                    JOIN bbt_usage_ledger_doctorai l ON l.email = u.email
+                    GROUP BY u.email, u.subscription_expires_at
+                )
+                UPDATE bbt_user_doctorai u
+                SET usage_count = GREATEST(COALESCE(u.usage_count, 0), ledger.free_count),
+                    premium_usage_count = GREATEST(COALESCE(u.premium_usage_count, 0), ledger.premium_count)
+                FROM ledger
+                WHERE u.email = ledger.email
+                  AND (COALESCE(u.usage_count, 0) < ledger.free_count
+                       OR COALESCE(u.premium_usage_count, 0) < ledger.premium_count)
+            """
+            cursor.execute(query, (subscription_days,))
+            corrected = cursor.rowcount
+            conn.commit()
+            return corrected
             
-        current_db_count = get_user_usage_from_db(user_email)
-        new_count = current_db_count + 1
-        st.session_state.usage_count = new_count
-        
-        return update_user_usage_in_db(user_email, new_count)
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return None
+
+# Short-lived session and handoff records shared by all replicas (see state_utils)
+def create_state_table() -> bool:
+    """Create the shared session/handoff state table if it does not exist"""
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS bbt_state_doctorai (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value JSONB NOT NULL,
+                    expires_at TIMESTAMPTZ NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            conn.commit()
+            return True
             
-    except Exception as e:
-        st.error(f"Error in increment_usage: {str(e)}")
-        return False
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return False
 
-def get_user_status_from_db(email: str) -> dict:
-    """Get complete user status from database"""
-    conn = None
-    try:
-        conn = get_db_connection()
+def get_state_record(namespace: str, key: str) -> Optional[dict]:
+    """Return an unexpired state record, or None if missing, expired or on error"""
+    with db_connection() as conn:
         if not conn:
-            return {"usage_count": 0, "paid_user": False, "premium_usage_count": 0}
-            
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        query = """
-            SELECT usage_count, paid_user, premium_usage_count, subscription_expires_at
-            FROM bbt_user_doctorai 
-            WHERE email = %s
-        """
-        cursor.execute(query, (email,))
-        result = cursor.fetchone()
-        
-        if result:
-            return {
-                "usage_count": result['usage_count'] or 0,
-                "paid_user": bool(result['paid_user']),
-                "premium_usage_count": result['premium_usage_count'] or 0,
-                "subscription_expires_at": result['subscription_expires_at']
-            }
-        return {"usage_count": 0, "paid_user": False, "premium_usage_count": 0}
-        
-    except Exception as e:
-        st.error(f"Database error: {str(e)}")
-        return {"usage_count": 0, "paid_user": False, "premium_usage_count": 0}
-    finally:
-        if conn:
-            conn.close()
+            return None
+        try:
+            cursor = conn.cursor()
+            query = """
+                SELECT value FROM bbt_state_doctorai 
+                WHERE namespace = %s AND key = %s AND expires_at > NOW()
+            """
+            cursor.execute(query, (namespace, key))
+            result = cursor.fetchone()
+            return result[0] if result else None
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            return None
+
+def put_state_record(namespace: str, key: str, value: dict, ttl_seconds: float) -> bool:
+    """Insert or replace a state record that expires after ttl_seconds"""
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            query = """
+                INSERT INTO bbt_state_doctorai (namespace, key, value, expires_at)
+                VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))
+                ON CONFLICT (namespace, key) 
+                DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            """
+            cursor.execute(query, (namespace, key, json.dumps(value, default=str), ttl_seconds))
+            conn.commit()
+            return True
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return False
+
+def take_state_record(namespace: str, key: str) -> Optional[dict]:
+    """Delete an unexpired state record and return it, so only one caller ever gets it"""
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            query = """
+                DELETE FROM bbt_state_doctorai
+                WHERE namespace = %s AND key = %s
+                RETURNING value, expires_at > NOW()
+            """
+            cursor.execute(query, (namespace, key))
+            result = cursor.fetchone()
+            conn.commit()
+            return result[0] if result and result[1] else None
 
-def init_user_session(email: str):
-    """Initialize user session with database values"""
-    user_status = get_user_status_from_db(email)
-    st.session_state.usage_count = user_status["usage_count"]
-    st.session_state.paid_user = user_status["paid_user"]
-    st.session_state.premium_usage_count = user_status["premium_usage_count"]
-    st.session_state.subscription_expires_at = user_status["subscription_expires_at"]
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return None
+
+def delete_state_records(namespace: Optional[str] = None, key: Optional[str] = None, expired_only: bool = False) -> bool:
+    """Delete one record, a namespace, or (expired_only) every expired record"""
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            query = """
+                DELETE FROM bbt_state_doctorai 
+                WHERE (%s IS NULL OR namespace = %s) 
+                  AND (%s IS NULL OR key = %s)
+                  AND (NOT %s OR expires_at <= NOW())
+            """
+            cursor.execute(query, (namespace, namespace, key, key, expired_only))
+            conn.commit()
+            return True
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
+            conn.rollback()
+            return False
 
 def update_user_subscription(email: str, is_paid: bool = False, expires_at: Optional[datetime] = None):
     """Update user's subscription status in the database"""
-    conn = None
-    try:
-        conn = get_db_connection()
+    with db_connection() as conn:
         if not conn:
             return False
+        try:
+            cursor = conn.cursor()
             
-        cursor = conn.cursor()
-        
-        # Update subscription details
-        query = """
-            UPDATE bbt_user_doctorai 
-            SET paid_user = %s, 
-                subscription_expires_at = %s, 
-                premium_usage_count = 0
-            WHERE email = %s
-        """
-        cursor.execute(query, (is_paid, expires_at, email))
-        conn.commit()
-        return True
-        
-    except Exception as e:
-        st.error(f"Database error: {str(e)}")
-        if conn:
+            # Update subscription details
+            query = """
+                UPDATE bbt_user_doctorai 
+                SET paid_user = %s, 
+                    subscription_expires_at = %s, 
+                    premium_usage_count = 0
+                WHERE email = %s
+            """
+            cursor.execute(query, (is_paid, expires_at, email))
+            conn.commit()
+            return True
+            
+        except Exception as e:
+            increment("db_errors", kind="query")
+            report_error(f"Database error: {str(e)}")
             conn.rollback()
-        return False
-    finally:
-        if conn:
-            conn.close()
+            return False
@@ -0,0 +1,143 @@
+import os
+import numpy as np
+
+# Output size of the DICOM decoder; matches inference_utils.IMAGE_SIZE
+DICOM_OUTPUT_SIZE = (224, 224)
+# Apply Modality LUT rescale, VOI windowing and MONOCHROME1 inversion ("1"), or
+# only the original max-normalization of the stored values ("0")
+DICOM_WINDOWING = os.environ.get("DIAGNOAI_DICOM_WINDOWING", "1") == "1"
+
+# Modalities that are never plain radiographs; rejected from the header alone
+NON_RADIOGRAPH_MODALITIES = frozenset({
+    "CT", "MR", "US", "NM", "PT", "ES", "XC", "OP", "OPT", "SM", "ECG", "GM", "IVOCT", "IVUS"
+})
+
+def _bilinear_taps(in_size: int, out_size: int):
+    """
+    Source rows/columns and weights of tf.image.resize's bilinear sampling.
+
+    Uses the same half-pixel-centre mapping as TensorFlow (no antialiasing),
+    so each output pixel depends on exactly two source rows and two columns.
+    """
+    scale = np.float32(in_size) / np.float32(out_size)
+    position = (np.arange(out_size, dtype=np.float32) + np.float32(0.5)) * scale - np.float32(0.5)
+    floor = np.floor(position)
+    lower = np.maximum(floor, 0).astype(np.intp)
+    upper = np.minimum(np.ceil(position), in_size - 1).astype(np.intp)
+    return lower, upper, (position - floor).astype(np.float32)
+
+def _first_value(value):
+    """Window Center/Width may be multi-valued; use the first (default) window"""
+    if value is None:
+        return None
+    try:
+        return float(value[0])
+    except TypeError:
+        return float(value)
+
+class _Normalizer:
+    """Maps stored pixel values to uint8 display values, applied to sampled pixels only"""
+
+    def __init__(self, pixels: np.ndarray, ds, windowing: bool):
+        self.slope = float(getattr(ds, "RescaleSlope", 1) or 1) if windowing else 1.0
+        self.intercept = float(getattr(ds, "RescaleIntercept", 0) or 0) if windowing else 0.0
+        self.invert = windowing and getattr(ds, "PhotometricInterpretation", "") == "MONOCHROME1"
+        self.center = _first_value(getattr(ds, "WindowCenter", None)) if windowing else None
+        self.width = _first_value(getattr(ds, "WindowWidth", None)) if windowing else None
+        if self.center is None or not self.width or self.width < 1 or pixels.ndim == 3:
+            self.center = self.width = None
+            # Max of the rescaled image, from a reduction over the stored values (no full-size temporary)
+            stored = pixels.max() if self.slope >= 0 else pixels.min()
+            self.max_value = float(stored) * self.slope + self.intercept
+
+    def __call__(self, samples: np.ndarray) -> np.ndarray:
+        rescaled = samples.astype(np.float64) * self.slope + self.intercept
+        if self.center is None:
+            # Original normalization: clip negatives, scale by the image maximum
+            values = (np.maximum(rescaled, 0) / self.max_value) * 255.0
+        else:
+            # DICOM linear VOI LUT (PS3.3 C.11.2.1.2)
+            low = self.center - 0.5 - (self.width - 1) / 2
+            high = self.center - 0.5 + (self.width - 1) / 2
+            values = ((rescaled - (self.center - 0.5)) / (self.width - 1) + 0.5) * 255.0
+            values = np.where(rescaled <= low, 0.0, np.where(rescaled > high, 255.0, values))
+        output = np.uint8(values)
+        return 255 - output if self.invert else output
+
+def resize_sampled(pixels: np.ndarray, normalize, size=DICOM_OUTPUT_SIZE) -> np.ndarray:
+    """
+    Normalize and bilinearly resize a full-resolution frame, touching only the
+    source pixels the resize actually reads.
+
+    Args:
+        pixels (numpy.ndarray): (H, W) or (H, W, C) stored pixel values
+        normalize (callable): Maps sampled stored values to uint8
+        size (tuple): Output (height, width)
+
+    Returns:
+        numpy.ndarray: float32 (height, width[, C]) array in the 0-255 range
+    """
+    row_lo, row_hi, row_weight = _bilinear_taps(pixels.shape[0], size[0])
+    col_lo, col_hi, col_weight = _bilinear_taps(pixels.shape[1], size[1])
+    if pixels.ndim == 3:
+        col_weight = col_weight[:, np.newaxis]
+    row_weight = row_weight.reshape((-1,) + (1,) * (pixels.ndim - 1))
+
+    def sample(rows, cols):
+        return normalize(pixels[np.ix_(rows, cols)]).astype(np.float32)
+
+    top_left, top_right = sample(row_lo, col_lo), sample(row_lo, col_hi)
+    top = top_left + (top_right - top_left) * col_weight
+    bottom_left, bottom_right = sample(row_hi, col_lo), sample(row_hi, col_hi)
+    bottom = bottom_left + (bottom_right - bottom_left) * col_weight
+    return top + (bottom - top) * row_weight
+
+def _read_first_frame(fileobj):
+    """Decode only the first frame and the image pixel module tags of a DICOM file"""
+    from pydicom import Dataset
+    from pydicom.pixels import pixel_array
+
+    ds = Dataset()
+    # Compressed transfer syntaxes are decoded by pydicom's installed plugins
+    pixels = pixel_array(fileobj, ds_out=ds, index=0,
+                         specific_tags=[0x00281050, 0x00281051, 0x00281052, 0x00281053])
+    return pixels, ds
+
+def decode_dicom(fileobj, size=DICOM_OUTPUT_SIZE, windowing: bool = DICOM_WINDOWING) -> np.ndarray:
+    """
+    Decode a DICOM upload into a float32 (height, width, 3) array in the 0-255 range.
+
+    Reads straight from the upload's file object, decodes only the first frame
+    of multi-frame files, and samples the frame down to the output size before
+    any floating-point work or channel expansion, so temporaries stay at the
+    output size whatever the source resolution.
+
+    Args:
+        fileobj: Seekable binary file object positioned at the start of the file
+        size (tuple): Output (height, width)
+        windowing (bool): Apply rescale, VOI windowing and MONOCHROME1 inversion
+
+    Returns:
+        numpy.ndarray: Image array ready for is_xray_image and the models
+    """
+    pixels, ds = _read_first_frame(fileobj)
+    img = resize_sampled(pixels, _Normalizer(pixels, ds, windowing), size)
+    if img.ndim == 2:
+        img = np.repeat(img[..., np.newaxis], 3, axis=2)
+    return img
+
+def is_plausible_radiograph(fileobj) -> bool:
+    """
+    Header-only pre-screen: False if the DICOM Modality is one that is never a radiograph.
+
+    Reads only the Modality tag (no pixel data). Files without a Modality, or
+    with CR, DX, OT and the like, are left to the full X-ray check.
+    """
+    import pydicom
+    position = fileobj.tell()
+    try:
+        ds = pydicom.dcmread(fileobj, stop_before_pixels=True, specific_tags=[0x00080060])
+    finally:
+        fileobj.seek(position)
+    modality = str(getattr(ds, "Modality", "") or "").strip().upper()
+    return modality not in NON_RADIOGRAPH_MODALITIES
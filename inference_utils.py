@@ -0,0 +1,501 @@
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from contextlib import contextmanager
+from PIL import Image
+
+from ui_utils import is_xray_batch, prescreen_thumbnail
+from metrics_utils import span
+
+# Define the image size, class names and model files
+IMAGE_SIZE = (224, 224)
+MULTI_CLASS_NAMES = ['Edema', 'Normal', 'Pneumonia', 'Tuberculosis', 'Effusion']
+BINARY_CLASS_NAMES = ['NotEdema', 'Edema']
+MULTI_MODEL_PATH = 'disease_classifier_model.h5'
+EDEMA_MODEL_PATH = 'edema_classifier_model.h5'
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.dcm')
+# Longest side of the preview sent to the browser
+PREVIEW_MAX_SIZE = 800
+# Bumped whenever decoding changes what the models see, so cached predictions are invalidated
+PREPROCESSING_VERSION = "3"
+DEFAULT_BATCH_SIZE = 32
+# Longest side of the thumbnail used by the pre-screen
+THUMBNAIL_SIZE = 64
+
+# Serving options, overridable through the environment
+COMPILE_MODELS = os.environ.get("DIAGNOAI_COMPILE_MODELS", "1") == "1"
+XLA_JIT = os.environ.get("DIAGNOAI_XLA_JIT", "0") == "1"
+# "keras" or one of "tflite-float", "tflite-dynamic", "tflite-int8"
+INFERENCE_BACKEND = os.environ.get("DIAGNOAI_BACKEND", "keras")
+WARMUP_BATCH_SIZES = (1,)
+
+class ServingModel:
+    """
+    Fixed-signature compiled inference function around a Keras model.
+
+    Keras' predict() builds a data adapter and callback list on every call,
+    which dominates the cost of single-image inference. This wraps the model's
+    forward pass in a tf.function with a (None, 224, 224, 3) float32 signature
+    so it is traced once, optionally compiled with XLA, and called directly.
+    It exposes the same predict() signature used by predict_arrays.
+    """
+
+    def __init__(self, model, jit_compile: bool = XLA_JIT):
+        import tensorflow as tf
+        self.model = model
+        self.jit_compile = jit_compile
+        self._serve = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec(shape=(None, *IMAGE_SIZE, 3), dtype=tf.float32)],
+            jit_compile=jit_compile
+        )
+
+    def predict(self, x, batch_size=None, verbose=0) -> np.ndarray:
+        """Run the compiled forward pass and return a NumPy array"""
+        return self._serve(np.asarray(x, dtype=np.float32)).numpy()
+
+    def warmup(self, batch_sizes=WARMUP_BATCH_SIZES):
+        """Trace (and JIT compile) the serving function before the first real request"""
+        for batch_size in batch_sizes:
+            self.predict(np.zeros((batch_size, *IMAGE_SIZE, 3), dtype=np.float32))
+        return self
+
+def model_version(backend: str = INFERENCE_BACKEND, model_paths=(MULTI_MODEL_PATH, EDEMA_MODEL_PATH)) -> str:
+    """Identify the deployed models by backend, preprocessing and model file size/mtime, for cache keys"""
+    parts = [backend, f"preprocessing:{PREPROCESSING_VERSION}"]
+    for path in model_paths:
+        try:
+            stat = os.stat(path)
+            parts.append(f"{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}")
+        except OSError:
+            parts.append(f"{os.path.basename(path)}:missing")
+    return "|".join(parts)
+
+def load_model(model_path: str, compiled: bool = COMPILE_MODELS, jit_compile: bool = XLA_JIT,
+               backend: str = INFERENCE_BACKEND):
+    """
+    Load one model for the selected backend.
+
+    The "keras" backend returns a warmed-up ServingModel (the plain Keras model
+    when compiled is False); "tflite-<mode>" backends return a TFLiteModel.
+    TensorFlow is imported here rather than at module import time.
+    """
+    if backend.startswith("tflite-"):
+        from tflite_utils import load_tflite_model
+        return load_tflite_model(model_path, backend[len("tflite-"):])
+    if backend != "keras":
+        raise ValueError(f"Unknown inference backend {backend!r}")
+
+    import tensorflow as tf
+    model = tf.keras.models.load_model(model_path)
+    if compiled:
+        model = ServingModel(model, jit_compile=jit_compile).warmup()
+    return model
+
+def load_models(multi_model_path: str = MULTI_MODEL_PATH, edema_model_path: str = EDEMA_MODEL_PATH, **kwargs):
+    """Eagerly load the multi-class and Edema models (see load_model for options)"""
+    return load_model(multi_model_path, **kwargs), load_model(edema_model_path, **kwargs)
+
+class LazyModel:
+    """
+    Model proxy that loads on first predict() or in a background thread.
+
+    Lets the app start serving pages before TensorFlow is imported and the
+    .h5 files are read, and keeps rarely used models (the Edema cascade)
+    out of memory until they are needed.
+    """
+
+    def __init__(self, model_path: str, **load_kwargs):
+        self.model_path = model_path
+        self.load_kwargs = load_kwargs
+        self.load_seconds = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self):
+        """Load the model once, blocking concurrent callers until it is ready"""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    self._model = load_model(self.model_path, **self.load_kwargs)
+                    self.load_seconds = time.perf_counter() - start
+        return self._model
+
+    def load_in_background(self):
+        """Start loading in a daemon thread; predict() waits for it if still running"""
+        def _load():
+            try:
+                self.load()
+            except Exception as e:
+                # predict() retries the load and surfaces the error to the caller
+                print(f"Error loading model {self.model_path}: {str(e)}")
+
+        threading.Thread(target=_load, name=f"load-{os.path.basename(self.model_path)}", daemon=True).start()
+        return self
+
+    def predict(self, x, batch_size=None, verbose=0) -> np.ndarray:
+        return self.load().predict(x, batch_size=batch_size, verbose=verbose)
+
+def load_lazy_models(multi_model_path: str = MULTI_MODEL_PATH, edema_model_path: str = EDEMA_MODEL_PATH,
+                     background: bool = True, **kwargs):
+    """
+    Return LazyModels for both models without blocking.
+
+    The multi-class model starts loading in a background thread right away
+    (when background is True); the Edema model loads on its first prediction.
+    """
+    multi_model = LazyModel(multi_model_path, **kwargs)
+    if background:
+        multi_model.load_in_background()
+    return multi_model, LazyModel(edema_model_path, **kwargs)
+
+@contextmanager
+def _open_source(source):
+    """Yield (name, seekable binary file) for a file path, raw bytes or file-like object, without copying"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield None, io.BytesIO(source)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield os.fspath(source), f
+    else:
+        # File-like objects such as Streamlit's UploadedFile
+        source.seek(0)
+        yield getattr(source, 'name', None), source
+
+def _is_dicom(name, fileobj) -> bool:
+    """Detect DICOM by extension, falling back to the 'DICM' preamble marker"""
+    if name and name.lower().endswith('.dcm'):
+        return True
+    fileobj.seek(128)
+    marker = fileobj.read(4)
+    fileobj.seek(0)
+    return marker == b'DICM'
+
+def decode_image(source, name=None, preview_size: int = PREVIEW_MAX_SIZE) -> tuple:
+    """
+    Decode an image once into the model input and a downscaled display preview.
+
+    Large JPEGs are decoded with PIL's draft mode, which lets libjpeg decode
+    directly at 1/2, 1/4 or 1/8 scale, so the full-resolution raster is never
+    built. The model input always comes from the smallest draft scale that
+    still covers IMAGE_SIZE, so it is the same whether or not a preview is
+    requested; a preview of a drafted JPEG is decoded again at its own scale.
+
+    Args:
+        source: File path, raw bytes, file-like object (e.g. an UploadedFile),
+            or a PIL image already decoded by prescreen()
+        name (str, optional): File name used to detect DICOM uploads
+        preview_size (int, optional): Longest side of the preview; None skips it
+
+    Returns:
+        tuple: (float32 (224, 224, 3) array in the 0-255 range, RGB PIL preview or None)
+    """
+    if isinstance(source, Image.Image):
+        return _model_input_and_preview(source, preview_size)
+
+    with _open_source(source) as (source_name, fileobj):
+        name = name or source_name
+
+        # Handle DICOM files; the preview is the model-size image
+        if _is_dicom(name, fileobj):
+            from dicom_utils import decode_dicom
+            with span("decode_dicom"):
+                img_for_model = decode_dicom(fileobj, size=IMAGE_SIZE)
+            preview = Image.fromarray(np.uint8(img_for_model)) if preview_size else None
+            return img_for_model, preview
+
+        # Handle normal image files (JPG, PNG)
+        img = Image.open(fileobj)
+        if not _draft(img, max(IMAGE_SIZE)):
+            return _model_input_and_preview(img, preview_size)
+        img_for_model = _model_input(img)
+        preview = None
+        if preview_size:
+            fileobj.seek(0)
+            preview = Image.open(fileobj)
+            _draft(preview, preview_size)
+            preview = _preview(preview, preview_size)
+        return img_for_model, preview
+
+def decode_preview(source, name=None, preview_size: int = PREVIEW_MAX_SIZE):
+    """
+    Decode only the display preview of an image, for uploads whose prediction
+    is already cached and so need no model input.
+
+    JPEGs are decoded at the draft scale of the preview. DICOM previews are
+    the model-size image, as in decode_image.
+
+    Args:
+        source: File path, raw bytes, file-like object (e.g. an UploadedFile),
+            or a PIL image already decoded by prescreen()
+        name (str, optional): File name used to detect DICOM uploads
+        preview_size (int): Longest side of the preview
+
+    Returns:
+        RGB PIL image, the same preview decode_image returns
+    """
+    if isinstance(source, Image.Image):
+        return _preview(source, preview_size)
+
+    with _open_source(source) as (source_name, fileobj):
+        name = name or source_name
+        if _is_dicom(name, fileobj):
+            return decode_image(fileobj, name=name, preview_size=preview_size)[1]
+        img = Image.open(fileobj)
+        _draft(img, preview_size)
+        return _preview(img, preview_size)
+
+def _draft(img, target: int) -> bool:
+    """Have libjpeg decode a large JPEG at a reduced scale still at least target pixels a side"""
+    if img.format == 'JPEG' and min(img.size) >= 2 * target:
+        img.draft(None, (target, target))
+        return True
+    return False
+
+def _preview(img, preview_size: int):
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    preview = img.copy()
+    preview.thumbnail((preview_size, preview_size))
+    return preview
+
+def _model_input(img) -> np.ndarray:
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    # Same nearest-neighbour resize as keras' image.load_img, without importing TensorFlow
+    if img.size != IMAGE_SIZE[::-1]:
+        img = img.resize(IMAGE_SIZE[::-1], Image.NEAREST)
+    return np.asarray(img, dtype=np.float32)
+
+def _model_input_and_preview(img, preview_size) -> tuple:
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    preview = _preview(img, preview_size) if preview_size else None
+    return _model_input(img), preview
+
+def _thumbnail(img, size: int) -> np.ndarray:
+    """Area-averaged uint8 RGB thumbnail of a PIL image, at most size pixels on the long side"""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    thumb = img.reduce(max(1, max(img.size) // size))
+    thumb.thumbnail((size, size), Image.BOX)
+    return np.asarray(thumb)
+
+def prescreen(source, name=None, size: int = THUMBNAIL_SIZE, full_decode: bool = True) -> tuple:
+    """
+    Cheap early rejection of obvious non-X-rays, before usage is charged or
+    the image is decoded for the models.
+
+    DICOM files are screened on their Modality header alone. JPEGs are
+    decoded at 1/8 scale through PIL's draft mode and screened on a thumbnail
+    (see ui_utils.prescreen_thumbnail). Other formats (PNG) have no
+    reduced-size decode, so they are decoded in full once and the decoded
+    image is returned for decode_image to reuse; with full_decode False they
+    are left unscreened instead, for the caller to screen once it may afford
+    a full decode. Images that pass still go through the full X-ray check.
+
+    Args:
+        source: File path, raw bytes or file-like object (e.g. an UploadedFile)
+        name (str, optional): File name used to detect DICOM uploads
+        size (int): Longest side of the thumbnail
+        full_decode (bool): Screen formats that need a full decode
+
+    Returns:
+        tuple: (False if the image is certainly not a chest X-ray, None if it
+        was left unscreened, decoded PIL image to pass to decode_image, or None)
+    """
+    with _open_source(source) as (source_name, fileobj):
+        if _is_dicom(name or source_name, fileobj):
+            from dicom_utils import is_plausible_radiograph
+            return is_plausible_radiograph(fileobj), None
+
+        img = Image.open(fileobj)
+        if img.format == 'JPEG':
+            img.draft('RGB', (size, size))
+            return prescreen_thumbnail(_thumbnail(img, size)), None
+
+        if not full_decode:
+            return None, None
+        img.load()
+        return prescreen_thumbnail(_thumbnail(img, size)), img
+
+def load_image_for_model(source, name=None) -> np.ndarray:
+    """
+    Decode an image into a float32 (224, 224, 3) array in the 0-255 range.
+
+    Args:
+        source: File path, raw bytes or file-like object (e.g. an UploadedFile)
+        name (str, optional): File name used to detect DICOM uploads
+
+    Returns:
+        numpy.ndarray: Image array ready for is_xray_image and the models
+    """
+    return decode_image(source, name=name, preview_size=None)[0]
+
+def predict_arrays(images: np.ndarray, multi_model, edema_model) -> list:
+    """
+    Run the multi-class model and the Edema cascade over a stack of images.
+
+    The multi-class model runs once over the whole batch; only the rows predicted
+    as Edema are sent to the Edema model, again as a single batch.
+
+    Args:
+        images (numpy.ndarray): (N, 224, 224, 3) array in the 0-255 range
+        multi_model: Multi-class Keras model
+        edema_model: Binary Edema Keras model
+
+    Returns:
+        list: One result dict per row with predicted_class, confidence,
+        probabilities and edema_prediction (None unless the cascade ran)
+    """
+    if len(images) == 0:
+        return []
+
+    img_array = np.asarray(images, dtype=np.float32) / 255.0
+    with span("multi_model"):
+        multi_prediction = multi_model.predict(img_array, batch_size=len(img_array), verbose=0)
+    predicted_indices = np.argmax(multi_prediction, axis=1)
+
+    # Use the Binary Classifier for Edema rows only
+    edema_predictions = {}
+    edema_rows = np.flatnonzero(predicted_indices == MULTI_CLASS_NAMES.index('Edema'))
+    if len(edema_rows):
+        edema_batch = img_array[edema_rows]
+        with span("edema_model"):
+            edema_output = edema_model.predict(edema_batch, batch_size=len(edema_batch), verbose=0)
+        edema_predictions = dict(zip(edema_rows.tolist(), edema_output[:, 0].tolist()))
+
+    results = []
+    for row, class_index in enumerate(predicted_indices):
+        results.append({
+            "predicted_class": MULTI_CLASS_NAMES[class_index],
+            "confidence": float(multi_prediction[row][class_index]),
+            "probabilities": multi_prediction[row].tolist(),
+            "edema_prediction": edema_predictions.get(row)
+        })
+    return results
+
+def predict_batch(paths_or_bytes, multi_model=None, edema_model=None, batch_size: int = DEFAULT_BATCH_SIZE,
+                  workers: int = 1) -> list:
+    """
+    Classify a collection of images in batches.
+
+    Args:
+        paths_or_bytes (list): File paths, raw bytes or file-like objects
+        multi_model: Multi-class model (loaded from disk if omitted)
+        edema_model: Edema model (loaded from disk if omitted)
+        batch_size (int): Number of images stacked into each model call
+        workers (int): Preprocessing processes; above 1, decoding and the X-ray
+            check run in a process pool overlapped with inference
+            (see pipeline_utils.PreprocessPipeline)
+
+    Returns:
+        list: One result dict per input, in input order. Inputs that fail to
+        decode carry an "error"; inputs rejected by the pre-screen or the
+        X-ray check have is_xray False and no prediction.
+    """
+    if multi_model is None or edema_model is None:
+        multi_model, edema_model = load_models()
+
+    if workers > 1:
+        from pipeline_utils import PreprocessPipeline, model_predictor
+        with PreprocessPipeline(workers=workers) as pipeline:
+            return list(pipeline.run(paths_or_bytes, model_predictor(multi_model, edema_model), batch_size))
+
+    sources = list(paths_or_bytes)
+    results = []
+    for start in range(0, len(sources), batch_size):
+        chunk = sources[start:start + batch_size]
+        chunk_results = []
+        decoded_rows, decoded_images = [], []
+
+        for source in chunk:
+            label = os.fspath(source) if isinstance(source, (str, os.PathLike)) else getattr(source, 'name', None)
+            result = {"source": label, "is_xray": False, "predicted_class": None,
+                      "confidence": None, "probabilities": None, "edema_prediction": None}
+            try:
+                plausible, decoded = prescreen(source, name=getattr(source, 'name', None))
+                if plausible:
+                    decoded_images.append(load_image_for_model(decoded if decoded is not None else source))
+                    decoded_rows.append(len(chunk_results))
+            except Exception as e:
+                result["error"] = str(e)
+            chunk_results.append(result)
+
+        if decoded_images:
+            # Check which images are X-rays in one vectorized pass
+            decoded_images = np.stack(decoded_images)
+            is_xray = is_xray_batch(decoded_images)
+            accepted_rows = [row for row, accepted in zip(decoded_rows, is_xray) if accepted]
+            predictions = predict_arrays(decoded_images[is_xray], multi_model, edema_model)
+            for row, prediction in zip(accepted_rows, predictions):
+                chunk_results[row].update(is_xray=True, **prediction)
+
+        results.extend(chunk_results)
+    return results
+
+def collect_image_paths(paths) -> list:
+    """Expand directories into the supported image files they contain"""
+    collected = []
+    for path in paths:
+        if os.path.isdir(path):
+            for entry in sorted(os.listdir(path)):
+                if entry.lower().endswith(SUPPORTED_EXTENSIONS):
+                    collected.append(os.path.join(path, entry))
+        else:
+            collected.append(path)
+    return collected
+
+def cli(argv=None):
+    """Command line entry point for headless batch classification"""
+    parser = argparse.ArgumentParser(
+        prog="diagnoai-batch",
+        description="Classify chest X-ray images (JPG, JPEG, PNG, or DICOM) without the web UI."
+    )
+    parser.add_argument("paths", nargs="+", help="Image files or directories of images")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of images per model call")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Preprocessing processes (default: DIAGNOAI_PREPROCESS_WORKERS or the CPU count)")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    parser.add_argument("--profile", action="store_true",
+                        help="Write a cProfile dump and TensorFlow trace of the run to DIAGNOAI_PROFILE_DIR")
+    args = parser.parse_args(argv)
+    if args.workers is None:
+        from pipeline_utils import PREPROCESS_WORKERS
+        args.workers = PREPROCESS_WORKERS
+
+    paths = collect_image_paths(args.paths)
+    if not paths:
+        parser.error("no supported images found")
+
+    from profile_utils import profile_request
+    with profile_request("batch", enabled=args.profile):
+        results = predict_batch(paths, batch_size=args.batch_size, workers=args.workers)
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        elif result.get("error"):
+            print(f"{result['source']}: error: {result['error']}")
+        elif not result["is_xray"]:
+            print(f"{result['source']}: not an X-ray image")
+        else:
+            line = f"{result['source']}: {result['predicted_class']} ({result['confidence']*100:.2f}%)"
+            if result["edema_prediction"] is not None:
+                line += f", Edema specialist {result['edema_prediction']*100:.2f}%"
+            print(line)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,172 @@
+import os
+import sys
+import json
+import queue
+import time
+import atexit
+import argparse
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+from db_utils import create_usage_ledger_table, insert_usage_ledger_rows, reconcile_usage_counts
+
+# Ledger write-behind settings, overridable through the environment
+LEDGER_BATCH_SIZE = int(os.environ.get("DIAGNOAI_LEDGER_BATCH_SIZE", "100"))
+# Seconds a recorded entry may wait before a partial batch is flushed
+LEDGER_FLUSH_INTERVAL = float(os.environ.get("DIAGNOAI_LEDGER_FLUSH_SECONDS", "2"))
+# Entries held in memory while the database is slow or unreachable; beyond
+# this, new entries are dropped (and counted) rather than blocking requests
+LEDGER_MAX_PENDING = int(os.environ.get("DIAGNOAI_LEDGER_MAX_PENDING", "10000"))
+
+def ledger_row(email: str, prediction: dict, premium: bool = False,
+               latency_ms: Optional[float] = None, cached: bool = False) -> tuple:
+    """Build a ledger row (db_utils.USAGE_LEDGER_COLUMNS order) from a prediction dict"""
+    probabilities = prediction.get("probabilities")
+    return (
+        datetime.now(timezone.utc),
+        email,
+        bool(premium),
+        prediction.get("is_xray"),
+        prediction.get("predicted_class"),
+        prediction.get("confidence"),
+        prediction.get("edema_prediction"),
+        json.dumps(probabilities) if probabilities is not None else None,
+        latency_ms,
+        bool(cached)
+    )
+
+class UsageLedger:
+    """
+    Write-behind, append-only ledger of analyses.
+
+    record() only enqueues, so requests never wait on the database. A
+    background thread writes the queue in batches with one multi-row INSERT
+    per batch, once LEDGER_BATCH_SIZE entries are waiting or the oldest has
+    waited LEDGER_FLUSH_INTERVAL seconds. Failed batches are retried on the
+    next flush, and the queue is drained when the process exits. Only the
+    background thread touches the pending batch, including for that final drain.
+    """
+
+    def __init__(self, batch_size: int = LEDGER_BATCH_SIZE, flush_interval: float = LEDGER_FLUSH_INTERVAL,
+                 max_pending: int = LEDGER_MAX_PENDING, writer=insert_usage_ledger_rows):
+        """
+        Args:
+            batch_size (int): Maximum rows per INSERT
+            flush_interval (float): Maximum seconds before a partial batch is written
+            max_pending (int): Maximum rows held in memory
+            writer (callable): Writes a list of rows, returning True on success
+        """
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.writer = writer
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._pending = []
+        self._table_ready = False
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def record(self, row: tuple) -> bool:
+        """Queue one ledger row; returns False if it had to be dropped"""
+        if self._closed.is_set():
+            return False
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                print(f"Usage ledger full, dropped {self.dropped} entries")
+            return False
+
+    def _take(self, timeout: float) -> bool:
+        """Move one queued row into the pending batch, waiting up to timeout seconds"""
+        try:
+            if timeout > 0:
+                self._pending.append(self._queue.get(timeout=timeout))
+            else:
+                self._pending.append(self._queue.get_nowait())
+            return True
+        except queue.Empty:
+            return False
+
+    def _flush(self) -> bool:
+        """Write the pending batch; on failure it is kept for the next attempt"""
+        if not self._pending:
+            return True
+        if self.writer is insert_usage_ledger_rows and not self._table_ready:
+            self._table_ready = create_usage_ledger_table()
+            if not self._table_ready:
+                return False
+        try:
+            written = self.writer(self._pending)
+        except Exception as e:
+            print(f"Error writing usage ledger: {str(e)}")
+            written = False
+        if written:
+            self.written += len(self._pending)
+            self._pending = []
+        return bool(written)
+
+    def _run(self):
+        while not self._closed.is_set():
+            # Block for the first row of a batch, then collect until it is full or due
+            if not self._pending and not self._take(timeout=self.flush_interval):
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._pending) < self.batch_size and not self._closed.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._take(timeout=min(remaining, 0.1))
+            if not self._flush():
+                # Back off so an unreachable database is not retried in a tight loop
+                self._closed.wait(self.flush_interval)
+        self._drain()
+
+    def _drain(self):
+        """Write everything still queued, stopping at the first batch that fails"""
+        while True:
+            while len(self._pending) < self.batch_size and self._take(timeout=0):
+                pass
+            if not self._pending or not self._flush():
+                break
+
+    def close(self, timeout: float = 10.0):
+        """Stop accepting rows and wait up to timeout seconds for everything queued to be written"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            print(f"Usage ledger still writing after {timeout:g}s; "
+                  f"{self._queue.qsize()} queued entries may not be written")
+        elif self._pending or not self._queue.empty():
+            print(f"Usage ledger closed with {len(self._pending) + self._queue.qsize()} unwritten entries")
+
+def cli(argv=None):
+    """Raise the users' usage counters to the totals recorded in the ledger"""
+    from auth_utils import SUBSCRIPTION_DURATION_DAYS
+
+    parser = argparse.ArgumentParser(
+        prog="diagnoai-reconcile-usage",
+        description="Reconcile the DiagnoAI usage counters with the usage ledger. "
+                    "Counters are only ever raised; run it periodically, e.g. from cron."
+    )
+    parser.add_argument("--subscription-days", type=int, default=SUBSCRIPTION_DURATION_DAYS,
+                        help="Length of a premium subscription, to count its premium analyses")
+    args = parser.parse_args(argv)
+
+    corrected = reconcile_usage_counts(args.subscription_days)
+    if corrected is None:
+        print("Reconciliation failed")
+        return 1
+    print(f"Corrected the usage counters of {corrected} users")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
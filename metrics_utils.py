@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import bisect
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Metrics settings, overridable through the environment. Collection is off
+# unless DIAGNOAI_METRICS=1; when off, span() returns a shared no-op and
+# increment() returns immediately.
+METRICS_ENABLED = os.environ.get("DIAGNOAI_METRICS", "0") == "1"
+# Port of the Prometheus text endpoint (GET /metrics); 0 disables it
+METRICS_PORT = int(os.environ.get("DIAGNOAI_METRICS_PORT", "9108"))
+METRICS_HOST = os.environ.get("DIAGNOAI_METRICS_HOST", "127.0.0.1")
+# Also print one JSON line per completed span and counter increment
+METRICS_JSON_LOG = os.environ.get("DIAGNOAI_METRICS_JSON_LOG", "0") == "1"
+
+METRICS_PREFIX = "diagnoai"
+# Upper bounds (seconds) of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# HELP text of the counters the app increments; others get a generic line
+COUNTER_HELP = {
+    "requests": "Uploads received, by mode (single or batch)",
+    "rejections": "Uploads refused, by reason. Counts every refusal, fresh or repeated: a re-upload "
+                  "rejected as not_xray is counted again although its result is replayed from the "
+                  "prediction cache (see cache_hits), and prescreen rejections are never cached, so "
+                  "repeats are screened and counted again",
+    "cache_hits": "Uploads answered from the prediction cache, including replayed rejections",
+    "cache_misses": "Uploads not in the prediction cache",
+    "db_errors": "Failed database operations, by kind (connect or query)",
+    "inference_timeouts": "Charged uploads whose analysis was stopped after DIAGNOAI_INFERENCE_TIMEOUT seconds",
+    "stage_errors": "Request path stages that raised, by stage"
+}
+
+class Histogram:
+    """Cumulative-bucket latency histogram for one stage"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+class MetricsRegistry:
+    """
+    Process-wide per-stage latency histograms and event counters.
+
+    Stages are named after the request path step they time (e.g. "decode",
+    "multi_model"); counters are named events with optional labels (e.g.
+    rejections with reason="prescreen").
+    """
+
+    def __init__(self, json_log: bool = METRICS_JSON_LOG):
+        self.json_log = json_log
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, error: bool = False):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+        if error:
+            self.increment("stage_errors", stage=stage)
+        if self.json_log:
+            _log_json({"metric": "stage_seconds", "stage": stage, "seconds": round(seconds, 6), "error": error})
+
+    def increment(self, name: str, amount: int = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        if self.json_log:
+            _log_json({"metric": name, "amount": amount, **labels})
+
+    def snapshot(self) -> dict:
+        """Stage histograms and counters as plain dicts (e.g. for benchmarks)"""
+        with self._lock:
+            return {
+                "stages": {
+                    stage: {"count": h.count, "sum": h.sum, "buckets": dict(zip(h.buckets + (float("inf"),), h.counts))}
+                    for stage, h in self._histograms.items()
+                },
+                "counters": {
+                    name + _format_labels(labels): value for (name, labels), value in self._counters.items()
+                }
+            }
+
+    def render_prometheus(self) -> str:
+        """Everything collected so far in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            if self._histograms:
+                metric = f"{METRICS_PREFIX}_stage_seconds"
+                lines.append(f"# HELP {metric} Latency of each request path stage")
+                lines.append(f"# TYPE {metric} histogram")
+                for stage, h in sorted(self._histograms.items()):
+                    label = _escape_label_value(stage)
+                    cumulative = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_bucket{{stage="{label}",le="+Inf"}} {h.count}')
+                    lines.append(f'{metric}_sum{{stage="{label}"}} {h.sum}')
+                    lines.append(f'{metric}_count{{stage="{label}"}} {h.count}')
+
+            names = sorted({name for name, _ in self._counters})
+            for name in names:
+                metric = f"{METRICS_PREFIX}_{name}_total"
+                help_text = COUNTER_HELP.get(name, f"Count of {name} events")
+                lines.append(f"# HELP {metric} {_escape_help(help_text)}")
+                lines.append(f"# TYPE {metric} counter")
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels) + "}"
+
+def _escape_label_value(value) -> str:
+    """Escape a label value for the text exposition format (backslash, double quote, newline)"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _escape_help(text: str) -> str:
+    """Escape HELP text for the text exposition format (backslash, newline)"""
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+def _log_json(record: dict):
+    print(json.dumps({"ts": datetime.now(timezone.utc).isoformat(), **record}), flush=True)
+
+registry = MetricsRegistry()
+
+class _Span:
+    """Times one stage and records it in the registry on exit"""
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        registry.observe(self.stage, time.perf_counter() - self.start, error=exc_type is not None)
+        return False
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(stage: str):
+    """
+    Context manager that records the duration of a request path stage.
+
+    Example:
+        with span("decode"):
+            img_for_model, preview = decode_image(uploaded_file)
+    """
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return _Span(stage)
+
+def increment(name: str, amount: int = 1, **labels):
+    """Count an event (requests, rejections, cache_hits, db_errors, ...)"""
+    if METRICS_ENABLED:
+        registry.increment(name, amount, **labels)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log
+        pass
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """
+    Serve GET /metrics from a daemon thread, once per process.
+
+    Does nothing when metrics are disabled or port is 0. If the port is taken
+    (e.g. by another worker on the same host) the error is reported once and
+    the process keeps collecting without an endpoint.
+    """
+    global _metrics_server
+    if not METRICS_ENABLED or not port:
+        return None
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                print(f"Could not start metrics endpoint on {host}:{port}: {str(e)}")
+                _metrics_server = False
+                return None
+            _metrics_server.daemon_threads = True
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _metrics_server or None
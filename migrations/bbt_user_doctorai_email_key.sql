@@ -0,0 +1,22 @@
+-- One-off migration: a unique index on bbt_user_doctorai.email, which lets
+-- db_utils.bootstrap_user log users in with a single statement (a read, plus an
+-- ON CONFLICT insert for new users only, so logins by existing users draw no
+-- id sequence values). Until it exists the app falls back to a
+-- check-then-insert at login.
+--
+-- Run with psql outside a transaction block (CREATE INDEX CONCURRENTLY cannot
+-- run inside one); the build does not block writes to the table:
+--
+--   psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f migrations/bbt_user_doctorai_email_key.sql
+
+-- 1. Duplicate emails make the build fail. List them and merge or remove the
+--    extra rows first; this query must return no rows.
+SELECT email, COUNT(*) AS copies
+FROM bbt_user_doctorai
+GROUP BY email
+HAVING COUNT(*) > 1;
+
+-- 2. Build the index (a no-op if it already exists). If the build fails, it
+--    leaves an invalid index behind, which the app ignores; drop it with
+--    DROP INDEX CONCURRENTLY bbt_user_doctorai_email_key; before re-running.
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS bbt_user_doctorai_email_key ON bbt_user_doctorai (email);
@@ -0,0 +1,299 @@
+import os
+import sys
+import time
+import queue
+import atexit
+import argparse
+import threading
+import numpy as np
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+
+from inference_utils import IMAGE_SIZE, MULTI_CLASS_NAMES, MULTI_MODEL_PATH, EDEMA_MODEL_PATH, load_models
+from scheduler_utils import InferenceScheduler, MAX_BATCH_SIZE
+from metrics_utils import METRICS_PORT, start_metrics_server
+
+# Model server settings, overridable through the environment. When
+# DIAGNOAI_MODEL_SERVER is set, the app sends inference to the server at that
+# address (a Unix socket path, or host:port) instead of loading the models.
+MODEL_SERVER_ADDRESS = os.environ.get("DIAGNOAI_MODEL_SERVER", "")
+DEFAULT_MODEL_SERVER_ADDRESS = "/tmp/diagnoai-model-server.sock"
+# Shared secret for the connection handshake. Required: connections carry
+# pickled messages, so an unauthenticated peer could run code in the server
+MODEL_SERVER_AUTHKEY = os.environ.get("DIAGNOAI_MODEL_SERVER_AUTHKEY") or None
+# Connections (each with its own shared memory block) a worker process keeps open
+MODEL_SERVER_CONNECTIONS = int(os.environ.get("DIAGNOAI_MODEL_SERVER_CONNECTIONS", "4"))
+# Images a connection's shared memory block holds; larger requests are split
+MODEL_SERVER_CHANNEL_IMAGES = int(os.environ.get("DIAGNOAI_MODEL_SERVER_CHANNEL_IMAGES", str(MAX_BATCH_SIZE)))
+
+INPUT_SHAPE = IMAGE_SIZE + (3,)
+
+def parse_address(address: str):
+    """Return a Unix socket path unchanged, or ("host", port) for host:port"""
+    if address.startswith("/") or ":" not in address:
+        return address
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+def _authkey(authkey) -> bytes:
+    if not authkey:
+        raise ValueError("The model server needs an authkey; set DIAGNOAI_MODEL_SERVER_AUTHKEY")
+    return authkey.encode("utf-8") if isinstance(authkey, str) else authkey
+
+def _remaining(deadline):
+    """Seconds left until deadline (None for no deadline); TimeoutError once it has passed"""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Model server request timed out")
+    return remaining
+
+class SharedBatch:
+    """
+    Views of one shared memory block laid out as the model input and outputs.
+
+    The block holds capacity float32 images of INPUT_SHAPE, followed by the
+    multi-class probabilities (capacity, num_classes) and the Edema scores
+    (capacity,), NaN where the Edema cascade did not run.
+    """
+
+    def __init__(self, shm: SharedMemory, capacity: int, num_classes: int):
+        self.shm = shm
+        self.capacity = capacity
+        image_bytes = capacity * int(np.prod(INPUT_SHAPE)) * 4
+        self.images = np.ndarray((capacity,) + INPUT_SHAPE, dtype=np.float32, buffer=shm.buf)
+        self.probabilities = np.ndarray((capacity, num_classes), dtype=np.float32,
+                                        buffer=shm.buf, offset=image_bytes)
+        self.edema = np.ndarray((capacity,), dtype=np.float32, buffer=shm.buf,
+                                offset=image_bytes + capacity * num_classes * 4)
+
+    @staticmethod
+    def nbytes(capacity: int, num_classes: int) -> int:
+        return capacity * (int(np.prod(INPUT_SHAPE)) + num_classes + 1) * 4
+
+    def close(self):
+        # The views must go before the mapping can be closed
+        self.images = self.probabilities = self.edema = None
+        self.shm.close()
+
+class ModelServer:
+    """
+    Owns the models for every Streamlit worker process on a node.
+
+    Workers connect over a multiprocessing connection, register a shared
+    memory block once, and then send only ("predict", n) messages; the images
+    are read from and the results written to shared memory, so no arrays are
+    pickled. Requests from all connections feed one InferenceScheduler, so
+    images from different workers are micro-batched together.
+    """
+
+    def __init__(self, multi_model, edema_model, address: str = DEFAULT_MODEL_SERVER_ADDRESS,
+                 authkey=MODEL_SERVER_AUTHKEY):
+        self.address = parse_address(address)
+        authkey = _authkey(authkey)
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                # Stale socket left behind by a previous server
+                os.unlink(self.address)
+            # Create the socket owner-only from the start, rather than chmod it after
+            # it is already listening
+            umask = os.umask(0o177)
+            try:
+                self.listener = Listener(self.address, authkey=authkey)
+            finally:
+                os.umask(umask)
+        else:
+            self.listener = Listener(self.address, authkey=authkey)
+        self.scheduler = InferenceScheduler(multi_model, edema_model)
+
+    def serve_forever(self):
+        """Accept worker connections until the listener is closed"""
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return
+            except Exception as e:
+                # Failed handshakes (wrong authkey) should not stop the server
+                print(f"Model server rejected a connection: {str(e)}")
+                continue
+            threading.Thread(target=self._handle, args=(conn,), name="model-server-conn", daemon=True).start()
+
+    def _handle(self, conn):
+        """Serve one worker connection until it closes"""
+        batch = None
+        try:
+            _, shm_name, capacity, num_classes = conn.recv()
+            shm = SharedMemory(name=shm_name)
+            # The worker owns the block; stop this process's tracker from unlinking it
+            resource_tracker.unregister(shm._name, "shared_memory")
+            batch = SharedBatch(shm, capacity, num_classes)
+            conn.send(("ok",))
+
+            while True:
+                _, count = conn.recv()
+                try:
+                    futures = [self.scheduler.submit(batch.images[row]) for row in range(count)]
+                    for row, future in enumerate(futures):
+                        prediction = future.result()
+                        batch.probabilities[row] = prediction["probabilities"]
+                        edema_prediction = prediction["edema_prediction"]
+                        batch.edema[row] = np.nan if edema_prediction is None else edema_prediction
+                    conn.send(("ok",))
+                except Exception as e:
+                    conn.send(("error", str(e)))
+        except (EOFError, OSError):
+            pass
+        finally:
+            if batch is not None:
+                batch.close()
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+        self.scheduler.shutdown()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+class _Channel:
+    """One worker-side connection to the model server and the shared memory block it uses"""
+
+    def __init__(self, address, authkey, capacity: int):
+        shm = SharedMemory(create=True, size=SharedBatch.nbytes(capacity, len(MULTI_CLASS_NAMES)))
+        self.batch = SharedBatch(shm, capacity, len(MULTI_CLASS_NAMES))
+        try:
+            self.conn = Client(address, authkey=_authkey(authkey))
+            self.conn.send(("attach", shm.name, capacity, len(MULTI_CLASS_NAMES)))
+            self.conn.recv()
+        except Exception:
+            self.close()
+            raise
+
+    def predict(self, images: np.ndarray, deadline: float = None) -> list:
+        count = len(images)
+        self.batch.images[:count] = images
+        self.conn.send(("predict", count))
+        if not self.conn.poll(_remaining(deadline)):
+            raise TimeoutError("Model server request timed out")
+        reply = self.conn.recv()
+        if reply[0] != "ok":
+            raise RuntimeError(f"Model server error: {reply[1]}")
+
+        results = []
+        for row in range(count):
+            probabilities = self.batch.probabilities[row]
+            class_index = int(np.argmax(probabilities))
+            edema_prediction = float(self.batch.edema[row])
+            results.append({
+                "predicted_class": MULTI_CLASS_NAMES[class_index],
+                "confidence": float(probabilities[class_index]),
+                "probabilities": probabilities.tolist(),
+                "edema_prediction": None if np.isnan(edema_prediction) else edema_prediction
+            })
+        return results
+
+    def close(self):
+        conn = getattr(self, "conn", None)
+        if conn is not None:
+            conn.close()
+        shm = self.batch.shm
+        self.batch.close()
+        shm.unlink()
+
+class ModelServerClient:
+    """
+    Worker-side stand-in for InferenceScheduler that runs inference in the model server.
+
+    Keeps up to max_connections channels open and lends one to each request,
+    so concurrent sessions in this process do not share a connection or a
+    shared memory block. Results are the same dicts predict_arrays returns.
+    """
+
+    def __init__(self, address: str = MODEL_SERVER_ADDRESS or DEFAULT_MODEL_SERVER_ADDRESS,
+                 authkey=MODEL_SERVER_AUTHKEY, max_connections: int = MODEL_SERVER_CONNECTIONS,
+                 capacity: int = MODEL_SERVER_CHANNEL_IMAGES):
+        self.address = parse_address(address)
+        self.authkey = _authkey(authkey)
+        self.capacity = max(1, capacity)
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, max_connections))
+        atexit.register(self.shutdown)
+
+    def _run(self, images: np.ndarray, deadline: float = None) -> list:
+        if not self._slots.acquire(timeout=_remaining(deadline)):
+            raise TimeoutError("Model server request timed out")
+        try:
+            try:
+                channel = self._idle.get_nowait()
+            except queue.Empty:
+                channel = _Channel(self.address, self.authkey, self.capacity)
+            try:
+                results = channel.predict(images, deadline)
+            except (EOFError, OSError, TimeoutError):
+                # The server went away, or its reply is still due and would be read by
+                # the next request; drop the channel so the next request reconnects
+                channel.close()
+                raise
+            except Exception:
+                self._idle.put(channel)
+                raise
+            self._idle.put(channel)
+            return results
+        finally:
+            self._slots.release()
+
+    def predict_many(self, images: np.ndarray, timeout: float = None) -> list:
+        """
+        Predict a (N, 224, 224, 3) stack of images; same result dicts as InferenceScheduler.predict_many.
+
+        Raises TimeoutError if the results are not back within timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        images = np.asarray(images, dtype=np.float32)
+        results = []
+        for start in range(0, len(images), self.capacity):
+            results.extend(self._run(images[start:start + self.capacity], deadline))
+        return results
+
+    def predict(self, img_for_model: np.ndarray, timeout: float = None) -> dict:
+        """Predict one (224, 224, 3) image; same result dict as InferenceScheduler.predict"""
+        return self.predict_many(np.asarray(img_for_model)[np.newaxis], timeout=timeout)[0]
+
+    def shutdown(self, wait: bool = True):
+        """Close every idle connection and free its shared memory"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+def cli(argv=None):
+    """Command line entry point for the per-node model server"""
+    parser = argparse.ArgumentParser(
+        prog="diagnoai-model-server",
+        description="Load the models once and serve inference to the Streamlit workers on this node."
+    )
+    parser.add_argument("--address", default=MODEL_SERVER_ADDRESS or DEFAULT_MODEL_SERVER_ADDRESS,
+                        help="Unix socket path, or host:port")
+    parser.add_argument("--multi-model", default=MULTI_MODEL_PATH, help="Multi-class model file")
+    parser.add_argument("--edema-model", default=EDEMA_MODEL_PATH, help="Edema model file")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT + 1 if METRICS_PORT else 0,
+                        help="Port of the /metrics endpoint when DIAGNOAI_METRICS=1 (0 disables it)")
+    args = parser.parse_args(argv)
+
+    multi_model, edema_model = load_models(args.multi_model, args.edema_model)
+    server = ModelServer(multi_model, edema_model, args.address)
+    start_metrics_server(args.metrics_port)
+    print(f"DiagnoAI model server listening on {args.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
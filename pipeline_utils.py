@@ -0,0 +1,195 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from inference_utils import DEFAULT_BATCH_SIZE, decode_image, predict_arrays, prescreen
+from ui_utils import is_xray_batch
+
+# Preprocessing pipeline defaults, overridable through the environment
+PREPROCESS_WORKERS = int(os.environ.get("DIAGNOAI_PREPROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Batches decoded ahead of the inference stage; bounds memory and applies backpressure
+PIPELINE_DEPTH = int(os.environ.get("DIAGNOAI_PIPELINE_DEPTH", "2"))
+# Worker start method; spawn keeps workers free of the parent's TensorFlow threads.
+# "thread" decodes in a thread pool instead of worker processes
+PIPELINE_START_METHOD = os.environ.get("DIAGNOAI_PIPELINE_START_METHOD", "spawn")
+
+def source_label(source):
+    """Display name of a file path, raw bytes or file-like source"""
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    return getattr(source, 'name', None)
+
+def _picklable(source):
+    """Replace file-like objects (e.g. UploadedFile) with (bytes, name) for the worker processes"""
+    if isinstance(source, (str, os.PathLike, bytes, bytearray, Image.Image)):
+        return source, None
+    if isinstance(source, memoryview):
+        return bytes(source), None
+    data = source.getvalue() if hasattr(source, 'getvalue') else source.read()
+    return data, getattr(source, 'name', None)
+
+def screen(source, name=None) -> tuple:
+    """
+    Pre-screen one image with inference_utils.prescreen (the first stage,
+    when it runs ahead of metering).
+
+    Returns:
+        tuple: (plausible, PIL image prescreen already decoded or None, error message or None)
+    """
+    try:
+        plausible, decoded = prescreen(source, name=name)
+    except Exception as e:
+        return False, None, str(e)
+    return plausible, decoded, None
+
+def preprocess(source, name=None, screened: bool = False) -> tuple:
+    """
+    Pre-screen, decode and X-ray-check one image (the per-worker pipeline stage).
+
+    Obvious non-X-rays are rejected by inference_utils.prescreen without
+    being decoded for the models. With screened True the pre-screen already
+    ran (see screen) and source may be the PIL image it decoded.
+
+    Returns:
+        tuple: (float32 (224, 224, 3) array or None, is_xray, error message or None)
+    """
+    if not screened:
+        plausible, decoded, error = screen(source, name=name)
+        if error is not None or not plausible:
+            return None, False, error
+        source = decoded if decoded is not None else source
+    try:
+        img = decode_image(source, name=name, preview_size=None)[0]
+    except Exception as e:
+        return None, False, str(e)
+    return img, bool(is_xray_batch(img[np.newaxis])[0]), None
+
+class PreprocessPipeline:
+    """
+    Two-stage batch classification pipeline.
+
+    Decoding, resizing and the X-ray check run in a pool of worker processes,
+    outside the GIL of the serving process, or in a pool of threads (PIL
+    and numpy release the GIL while decoding and resizing) where starting
+    processes is unsafe. Up to depth batches are decoded
+    ahead, so while the calling thread runs inference on batch k the workers
+    are already decoding batch k+1. The in-flight window is bounded, so a slow
+    inference stage stalls decoding instead of buffering the whole input.
+    """
+
+    def __init__(self, workers: int = PREPROCESS_WORKERS, depth: int = PIPELINE_DEPTH,
+                 start_method: str = PIPELINE_START_METHOD):
+        """
+        Args:
+            workers (int): Workers; 1 or fewer decodes inline, with no pool
+            depth (int): Batches decoded ahead of the inference stage
+            start_method (str): multiprocessing start method for the workers,
+                or "thread" for a thread pool
+        """
+        self.workers = max(1, workers)
+        self.depth = max(1, depth)
+        self._executor = None
+        if self.workers > 1 and start_method == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="preprocess")
+        elif self.workers > 1:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context(start_method)
+            )
+
+    def _submit(self, fn, source, *args):
+        source, name = _picklable(source)
+        return self._executor.submit(fn, source, name, *args)
+
+    def prescreen(self, sources) -> list:
+        """
+        Pre-screen sources in the pool, so callers can meter only the plausible
+        ones before anything is decoded for the models.
+
+        Returns:
+            list: screen() results in input order; pass the decoded images
+            (or the original sources) of the plausible ones to run(..., screened=True)
+        """
+        if self._executor is None:
+            return [screen(source) for source in sources]
+        return [future.result() for future in [self._submit(screen, source) for source in sources]]
+
+    def _decoded(self, sources, batch_size: int, screened: bool = False):
+        """Yield (source, (img, is_xray, error)) in input order, keeping the window full"""
+        if self._executor is None:
+            for source in sources:
+                yield source, preprocess(source, screened=screened)
+            return
+
+        window = batch_size * (self.depth + 1)
+        pending = deque()
+        for source in sources:
+            pending.append((source, self._submit(preprocess, source, screened)))
+            if len(pending) >= window:
+                source, future = pending.popleft()
+                yield source, future.result()
+        while pending:
+            source, future = pending.popleft()
+            yield source, future.result()
+
+    def run(self, sources, predictor, batch_size: int = DEFAULT_BATCH_SIZE, screened: bool = False):
+        """
+        Classify sources, yielding one result dict per source in input order.
+
+        Results are yielded a batch at a time, as soon as that batch's inference
+        finishes, so callers can stream them.
+
+        Args:
+            sources (iterable): File paths, raw bytes or file-like objects
+            predictor (callable): Maps a (N, 224, 224, 3) array to N prediction
+                dicts, e.g. predict_arrays bound to the models
+            batch_size (int): Images per inference call
+            screened (bool): The sources already passed prescreen(), and are
+                the images it decoded where it returned one
+
+        Yields:
+            dict: Same fields as inference_utils.predict_batch results
+        """
+        chunk = []
+        for source, decoded in self._decoded(sources, batch_size, screened):
+            chunk.append((source, decoded))
+            if len(chunk) == batch_size:
+                yield from self._predict_chunk(chunk, predictor)
+                chunk = []
+        if chunk:
+            yield from self._predict_chunk(chunk, predictor)
+
+    def _predict_chunk(self, chunk, predictor) -> list:
+        results, accepted_rows, accepted_images = [], [], []
+        for source, (img, is_xray, error) in chunk:
+            result = {"source": source_label(source), "is_xray": False, "predicted_class": None,
+                      "confidence": None, "probabilities": None, "edema_prediction": None}
+            if error is not None:
+                result["error"] = error
+            elif is_xray:
+                accepted_rows.append(len(results))
+                accepted_images.append(img)
+            results.append(result)
+
+        if accepted_images:
+            predictions = predictor(np.stack(accepted_images))
+            for row, prediction in zip(accepted_rows, predictions):
+                results[row].update(is_xray=True, **prediction)
+        return results
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def model_predictor(multi_model, edema_model):
+    """Inference stage that calls the models directly"""
+    return lambda images: predict_arrays(images, multi_model, edema_model)
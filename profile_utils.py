@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import random
+import cProfile
+import itertools
+import threading
+from contextlib import contextmanager
+
+# Profiling settings, overridable through the environment. Profiling is off
+# unless DIAGNOAI_PROFILE_SAMPLE_RATE is above 0, or an admin listed in
+# DIAGNOAI_PROFILE_ADMINS opens the app with ?profile=1.
+PROFILE_DIR = os.environ.get("DIAGNOAI_PROFILE_DIR", "profiles")
+# Fraction of script runs profiled, e.g. 0.001 to keep it on in production
+PROFILE_SAMPLE_RATE = float(os.environ.get("DIAGNOAI_PROFILE_SAMPLE_RATE", "0"))
+# Comma-separated user emails allowed to force a profile with ?profile=1
+PROFILE_ADMINS = frozenset(
+    email.strip().lower() for email in os.environ.get("DIAGNOAI_PROFILE_ADMINS", "").split(",") if email.strip()
+)
+# Also record a TensorFlow profiler trace of the model calls
+PROFILE_TF_TRACE = os.environ.get("DIAGNOAI_PROFILE_TF_TRACE", "1") == "1"
+
+PROFILE_QUERY_PARAM = "profile"
+
+# cProfile and the TensorFlow profiler are process-wide; one profile at a time
+_profile_lock = threading.Lock()
+_profile_sequence = itertools.count()
+
+def should_profile(user_email=None, requested: bool = False) -> bool:
+    """
+    Decide whether to profile this run.
+
+    Args:
+        user_email (str, optional): Signed-in user
+        requested (bool): Whether the profile query parameter was set; only
+            honoured for PROFILE_ADMINS
+
+    Returns:
+        bool: True if the run should be profiled
+    """
+    if requested and user_email and user_email.lower() in PROFILE_ADMINS:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def _start_tf_trace(logdir: str) -> bool:
+    """Start a TensorFlow profiler trace if TensorFlow is already loaded in this process"""
+    tf = sys.modules.get("tensorflow")
+    if tf is None:
+        # The models run elsewhere (model server) or have not loaded yet
+        return False
+    try:
+        tf.profiler.experimental.start(logdir)
+        return True
+    except Exception as e:
+        print(f"Could not start TensorFlow profiler: {str(e)}")
+        return False
+
+def _stop_tf_trace():
+    try:
+        sys.modules["tensorflow"].profiler.experimental.stop()
+    except Exception as e:
+        print(f"Could not stop TensorFlow profiler: {str(e)}")
+
+@contextmanager
+def profile_request(label: str = "request", enabled: bool = True, profile_dir: str = PROFILE_DIR):
+    """
+    Profile the enclosed code into profile_dir.
+
+    Writes <stem>.prof (cProfile stats of the calling thread; open with
+    pstats or snakeviz) and, when TensorFlow is loaded, a TensorFlow
+    profiler trace of every thread's model calls under <stem>-tf/ (open
+    with TensorBoard's profile plugin). If another profile is already
+    running in this process, the code runs unprofiled.
+
+    Yields:
+        str: The file stem of the profile, or None if not profiling
+    """
+    if not enabled or not _profile_lock.acquire(blocking=False):
+        yield None
+        return
+
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        stem = os.path.join(profile_dir, f"{stamp}-{os.getpid()}-{next(_profile_sequence)}-{label}")
+        tf_trace = PROFILE_TF_TRACE and _start_tf_trace(stem + "-tf")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield stem
+        finally:
+            profiler.disable()
+            if tf_trace:
+                _stop_tf_trace()
+            profiler.dump_stats(stem + ".prof")
+            print(f"Profile written to {stem}.prof")
+    finally:
+        _profile_lock.release()
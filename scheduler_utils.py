@@ -0,0 +1,121 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from inference_utils import predict_arrays
+
+# Micro-batching defaults, overridable through the environment
+MAX_BATCH_SIZE = int(os.environ.get("DIAGNOAI_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.environ.get("DIAGNOAI_MAX_WAIT_MS", "10"))
+
+class InferenceScheduler:
+    """
+    Process-wide micro-batching scheduler for model inference.
+
+    Sessions submit single preprocessed images and get a Future back. A single
+    background worker collects pending images until either max_batch_size is
+    reached or max_wait_ms has passed since the first image of the batch
+    arrived, then runs the models once for the whole batch.
+    """
+
+    def __init__(self, multi_model, edema_model, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_wait_ms: float = MAX_WAIT_MS):
+        """
+        Args:
+            multi_model: Multi-class Keras model
+            edema_model: Binary Edema Keras model
+            max_batch_size (int): Largest number of images per model call
+            max_wait_ms (float): Longest time the first queued image waits for company
+        """
+        self.multi_model = multi_model
+        self.edema_model = edema_model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="diagnoai-inference", daemon=True)
+        self._worker.start()
+
+    def submit(self, img_for_model: np.ndarray) -> Future:
+        """Queue one (224, 224, 3) image and return a Future for its result dict"""
+        if self._stopped.is_set():
+            raise RuntimeError("Inference scheduler has been shut down")
+        future = Future()
+        self._queue.put((img_for_model, future))
+        return future
+
+    def predict(self, img_for_model: np.ndarray, timeout: float = None) -> dict:
+        """Submit one image and block until its prediction is available; TimeoutError after timeout seconds"""
+        return self._results([self.submit(img_for_model)], timeout)[0]
+
+    def predict_many(self, images: np.ndarray, timeout: float = None) -> list:
+        """
+        Submit a stack of images and block until all of their predictions are
+        available. Raises TimeoutError if they are not all back within timeout seconds.
+        """
+        return self._results([self.submit(img) for img in images], timeout)
+
+    def _results(self, futures: list, timeout: float = None) -> list:
+        """Wait for futures under one deadline; on timeout, drop the ones not yet batched"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            return [future.result(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+                    for future in futures]
+        except FutureTimeoutError:
+            for future in futures:
+                future.cancel()
+            raise TimeoutError("Inference timed out") from None
+
+    def shutdown(self, wait: bool = True):
+        """Stop the worker after it drains the images already queued"""
+        self._stopped.set()
+        self._queue.put(None)
+        if wait:
+            self._worker.join()
+
+    def _collect_batch(self, first) -> list:
+        """Gather queued requests behind the first one until the batch is full or the wait expires"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Keep the shutdown marker for the outer loop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        """Worker loop: batch pending requests and resolve their futures"""
+        while True:
+            first = self._queue.get()
+            if first is None:
+                if self._queue.empty():
+                    return
+                # Requeue the marker behind the work submitted before shutdown
+                self._queue.put(None)
+                continue
+
+            batch = [item for item in self._collect_batch(first)
+                     if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                images = np.stack([img for img, _ in batch])
+                predictions = predict_arrays(images, self.multi_model, self.edema_model)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
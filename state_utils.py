@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import secrets
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from db_utils import create_state_table, get_state_record, put_state_record, take_state_record, delete_state_records
+
+# State store selection, overridable through the environment:
+#   postgres - the application database (default; shared by all replicas)
+#   sqlite   - a local SQLite file (DIAGNOAI_STATE_SQLITE_PATH), for tests and single hosts
+#   memory   - in-process only, for tests
+STATE_BACKEND = os.environ.get("DIAGNOAI_STATE_BACKEND", "postgres")
+STATE_SQLITE_PATH = os.environ.get("DIAGNOAI_STATE_SQLITE_PATH", "diagnoai_state.db")
+# Longest lifetime of session records; a record never outlives its login token
+SESSION_TTL = float(os.environ.get("DIAGNOAI_SESSION_TTL", str(24 * 3600)))
+# Longest lifetime of the one-time handoff in the URL that lets a reconnecting
+# browser resume its session; by default it lives as long as the session
+HANDOFF_TTL = float(os.environ.get("DIAGNOAI_HANDOFF_TTL", str(SESSION_TTL)))
+# Seconds a record read from the store is served from the per-process cache
+STATE_CACHE_TTL = float(os.environ.get("DIAGNOAI_STATE_CACHE_TTL", "5"))
+
+SESSION_NAMESPACE = "session"
+HANDOFF_NAMESPACE = "handoff"
+# Session-state fields restored from a session record. The login token is not
+# stored: the record is only reachable through a one-time handoff
+SESSION_FIELDS = ("user_name", "user_email", "authenticated", "session_expires_at")
+# Session-state fields loaded from a user's database record on login and resume
+QUOTA_FIELDS = ("usage_count", "paid_user", "premium_usage_count", "subscription_expires_at")
+
+class MemoryStateStore:
+    """In-process state store; records are not shared between processes"""
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        with self._lock:
+            record = self._records.get((namespace, key))
+            if record is None:
+                return None
+            if record[0] <= time.time():
+                del self._records[(namespace, key)]
+                return None
+            return json.loads(record[1])
+
+    def put(self, namespace: str, key: str, value: dict, ttl: float) -> bool:
+        with self._lock:
+            self._records[(namespace, key)] = (time.time() + ttl, json.dumps(value, default=str))
+        return True
+
+    def take(self, namespace: str, key: str) -> Optional[dict]:
+        with self._lock:
+            record = self._records.pop((namespace, key), None)
+        if record is None or record[0] <= time.time():
+            return None
+        return json.loads(record[1])
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._lock:
+            self._records.pop((namespace, key), None)
+        return True
+
+    def purge_expired(self) -> bool:
+        now = time.time()
+        with self._lock:
+            for record_key in [k for k, record in self._records.items() if record[0] <= now]:
+                del self._records[record_key]
+        return True
+
+class SqliteStateStore:
+    """State store in a local SQLite file, shared by processes on the same host"""
+
+    def __init__(self, path: str = STATE_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS state (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread; sqlite3 connections are not shared across threads"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace: str, key: str, value: dict, ttl: float) -> bool:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, default=str), time.time() + ttl)
+            )
+        return True
+
+    def take(self, namespace: str, key: str) -> Optional[dict]:
+        conn = self._connection()
+        with conn:
+            # Take the write lock before reading, so only one process gets the record
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value, expires_at > ? FROM state WHERE namespace = ? AND key = ?",
+                (time.time(), namespace, key)
+            ).fetchone()
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+        return json.loads(row[0]) if row and row[1] else None
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+        return True
+
+    def purge_expired(self) -> bool:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+        return True
+
+class PostgresStateStore:
+    """State store in the application database, shared by every replica"""
+
+    def __init__(self):
+        self._table_ready = False
+
+    def _ensure_table(self) -> bool:
+        if not self._table_ready:
+            self._table_ready = create_state_table()
+        return self._table_ready
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        if not self._ensure_table():
+            return None
+        return get_state_record(namespace, key)
+
+    def put(self, namespace: str, key: str, value: dict, ttl: float) -> bool:
+        if not self._ensure_table():
+            return False
+        return put_state_record(namespace, key, value, ttl)
+
+    def take(self, namespace: str, key: str) -> Optional[dict]:
+        if not self._ensure_table():
+            return None
+        return take_state_record(namespace, key)
+
+    def delete(self, namespace: str, key: str) -> bool:
+        return delete_state_records(namespace, key)
+
+    def purge_expired(self) -> bool:
+        return delete_state_records(expired_only=True)
+
+STATE_BACKENDS = {
+    "postgres": PostgresStateStore,
+    "sqlite": SqliteStateStore,
+    "memory": MemoryStateStore
+}
+
+class CachedStateStore:
+    """
+    Small per-process read-through cache in front of a state store.
+
+    Reads are served from memory for up to ttl seconds; writes and deletes go
+    straight to the store and update this process's copy, so a replica always
+    sees its own writes and other replicas' writes within ttl seconds.
+    Misses are not cached. Expired records are purged from the store every
+    purge_every writes.
+    """
+
+    def __init__(self, store, ttl: float = STATE_CACHE_TTL, max_entries: int = 4096, purge_every: int = 1000):
+        self.store = store
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.purge_every = purge_every
+        self._entries = OrderedDict()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+        value = self.store.get(namespace, key)
+        if value is not None:
+            self._remember(namespace, key, value)
+        return value
+
+    def _remember(self, namespace: str, key: str, value: dict):
+        with self._lock:
+            self._entries[(namespace, key)] = (time.monotonic(), value)
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, namespace: str, key: str, value: dict, ttl: float) -> bool:
+        stored = self.store.put(namespace, key, value, ttl)
+        if stored:
+            self._remember(namespace, key, value)
+        else:
+            self.invalidate(namespace, key)
+        with self._lock:
+            self._writes += 1
+            purge = self.purge_every and self._writes % self.purge_every == 0
+        if purge:
+            self.store.purge_expired()
+        return stored
+
+    def take(self, namespace: str, key: str) -> Optional[dict]:
+        """Remove a record and return it; bypasses the cache, so each record is taken once"""
+        self.invalidate(namespace, key)
+        return self.store.take(namespace, key)
+
+    def delete(self, namespace: str, key: str) -> bool:
+        self.invalidate(namespace, key)
+        return self.store.delete(namespace, key)
+
+    def invalidate(self, namespace: str, key: str):
+        """Drop this process's cached copy so the next get() reads the store"""
+        with self._lock:
+            self._entries.pop((namespace, key), None)
+
+_state_store = None
+_state_store_lock = threading.Lock()
+
+def get_state_store() -> CachedStateStore:
+    """Return the process-wide (cached) state store for the configured backend"""
+    global _state_store
+    if _state_store is None:
+        with _state_store_lock:
+            if _state_store is None:
+                if STATE_BACKEND not in STATE_BACKENDS:
+                    raise ValueError(f"Unknown state backend {STATE_BACKEND!r}")
+                _state_store = CachedStateStore(STATE_BACKENDS[STATE_BACKEND]())
+    return _state_store
+
+def session_ttl(expires_at: Optional[float]) -> float:
+    """Seconds a session record may live: SESSION_TTL, capped at the login token's expiry"""
+    if expires_at is None:
+        return SESSION_TTL
+    return min(SESSION_TTL, float(expires_at) - time.time())
+
+def save_session(session_id: str, state) -> bool:
+    """Store the identity fields of a session so any replica can restore it"""
+    record = {field: state.get(field) for field in SESSION_FIELDS}
+    ttl = session_ttl(record["session_expires_at"])
+    if ttl <= 0:
+        return False
+    return get_state_store().put(SESSION_NAMESPACE, session_id, record, ttl)
+
+def load_session(session_id: str) -> Optional[dict]:
+    """Return the stored identity fields of a session, or None if unknown or expired"""
+    return get_state_store().get(SESSION_NAMESPACE, session_id)
+
+def delete_session(session_id: str) -> bool:
+    return get_state_store().delete(SESSION_NAMESPACE, session_id)
+
+def issue_handoff(session_id: str, expires_at: Optional[float] = None) -> Optional[str]:
+    """
+    Create a one-time handoff for a session, to be put in the URL instead of
+    the session id. It expires after HANDOFF_TTL (or with the session) and
+    is consumed by take_handoff().
+
+    Returns:
+        str: The handoff, or None if it could not be stored
+    """
+    ttl = min(HANDOFF_TTL, session_ttl(expires_at))
+    if ttl <= 0:
+        return None
+    handoff = secrets.token_urlsafe(32)
+    if not get_state_store().put(HANDOFF_NAMESPACE, handoff, {"session_id": session_id}, ttl):
+        return None
+    return handoff
+
+def take_handoff(handoff: str) -> Optional[str]:
+    """Consume a handoff and return its session id, or None if unknown, used or expired"""
+    record = get_state_store().take(HANDOFF_NAMESPACE, handoff)
+    return record["session_id"] if record else None
+
+def delete_handoff(handoff: str) -> bool:
+    return get_state_store().delete(HANDOFF_NAMESPACE, handoff)
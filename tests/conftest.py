@@ -0,0 +1,130 @@
+"""
+Shared set-up: the tests run offline, against the stand-ins in
+benchmarks/offline.py (environment secrets, in-memory session state, an
+in-memory users table and stand-in models). offline.install() has to run before auth_utils,
+ledger_utils or app are imported, so it runs here, before any test module.
+
+Tests of db_utils' own statements use the connection fixture, which records
+them, or the postgres fixture, which runs them on a real database when
+DIAGNOAI_TEST_DATABASE_URL is set.
+"""
+import os
+import sys
+import uuid
+from contextlib import contextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import offline
+
+USERS = offline.install()
+# No test needs the real models; the AppTests that reach inference use the stand-ins
+offline.use_stand_in_models()
+
+@pytest.fixture
+def users():
+    """The in-memory users table behind db_utils' request-path functions"""
+    return USERS
+
+# bbt_user_doctorai as the app uses it; the production table is not created by the app
+USERS_TABLE = """
+    CREATE TABLE bbt_user_doctorai (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL,
+        name TEXT,
+        password_hash TEXT,
+        usage_count INTEGER DEFAULT 0,
+        premium_usage_count INTEGER DEFAULT 0,
+        paid_user INTEGER DEFAULT 0,
+        -- Epoch seconds, as auth_utils and reconcile_usage_counts read it
+        subscription_expires_at BIGINT
+    )
+"""
+
+class FakeConnection:
+    """Records the statements a db_utils function issues and returns the given rows"""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self, cursor_factory=None):
+        return self
+
+    def execute(self, query, params=None):
+        self.statements.append((" ".join(query.split()), params))
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+def use_real_db_utils(monkeypatch, db_connection):
+    """Restore the db_utils functions offline.install() replaced, over the given connections"""
+    import db_utils
+    monkeypatch.setattr(db_utils, "db_connection", db_connection)
+    for name, function in offline.REAL_DB_FUNCTIONS.items():
+        monkeypatch.setattr(db_utils, name, function)
+    monkeypatch.setattr(db_utils, "_user_email_unique", None)
+    monkeypatch.setattr(db_utils, "_user_email_unique_checked_at", 0.0)
+
+@pytest.fixture
+def connection(monkeypatch):
+    """A FakeConnection behind db_utils' real functions"""
+    conn = FakeConnection()
+
+    @contextmanager
+    def db_connection():
+        yield conn
+
+    use_real_db_utils(monkeypatch, db_connection)
+    return conn
+
+@pytest.fixture
+def postgres(monkeypatch):
+    """
+    db_utils' real functions on the Postgres database named by
+    DIAGNOAI_TEST_DATABASE_URL (skipped when unset), each test in a scratch
+    schema holding an empty bbt_user_doctorai. Yields an autocommit
+    connection to the schema; every db_connection() opens a new one.
+    """
+    url = os.environ.get("DIAGNOAI_TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("DIAGNOAI_TEST_DATABASE_URL is not set")
+    import psycopg2
+
+    schema = f"diagnoai_test_{uuid.uuid4().hex[:12]}"
+
+    def connect():
+        return psycopg2.connect(url, options=f"-c search_path={schema}")
+
+    admin = connect()
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA {schema}")
+        cursor.execute(USERS_TABLE)
+
+    @contextmanager
+    def db_connection():
+        conn = connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    use_real_db_utils(monkeypatch, db_connection)
+    try:
+        yield admin
+    finally:
+        with admin.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {schema} CASCADE")
+        admin.close()
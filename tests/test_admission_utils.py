@@ -0,0 +1,62 @@
+import time
+import threading
+
+from admission_utils import AdmissionController
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for condition"
+        time.sleep(0.001)
+
+def test_admits_up_to_max_inflight_then_sheds_when_queue_is_full():
+    controller = AdmissionController(max_inflight=2, max_queued=0, timeout=1)
+    assert controller.acquire("a")
+    assert controller.acquire("b")
+    assert not controller.acquire("c")
+    controller.release()
+    assert controller.acquire("c")
+    assert controller.stats() == {"inflight": 2, "queued": 0, "admitted": 3, "shed": 1}
+
+def test_sheds_after_timeout_and_leaves_the_queue():
+    controller = AdmissionController(max_inflight=1, max_queued=4, timeout=0.05)
+    assert controller.acquire("a")
+    start = time.monotonic()
+    assert not controller.acquire("b")
+    assert time.monotonic() - start >= 0.05
+    assert controller.stats()["queued"] == 0
+    controller.release()
+    assert controller.stats()["inflight"] == 0
+
+def test_caps_waiters_per_user():
+    controller = AdmissionController(max_inflight=1, max_queued=8, max_queued_per_user=1, timeout=5)
+    assert controller.acquire("holder")
+    waiter = threading.Thread(target=lambda: controller.acquire("a") and controller.release())
+    waiter.start()
+    wait_for(lambda: controller.stats()["queued"] == 1)
+    # "a" already has a waiter, so a second one is shed without waiting
+    assert not controller.acquire("a", timeout=5)
+    controller.release()
+    waiter.join()
+
+def test_grants_freed_slots_to_users_in_round_robin_order():
+    controller = AdmissionController(max_inflight=1, max_queued=8, max_queued_per_user=4, timeout=5)
+    assert controller.acquire("holder")
+    order = []
+
+    def analyze(user, index):
+        assert controller.acquire(user)
+        order.append((user, index))
+        controller.release()
+
+    threads = []
+    # One user queues a whole batch before another user's single upload
+    for user, index in (("batch", 1), ("batch", 2), ("batch", 3), ("single", 1)):
+        thread = threading.Thread(target=analyze, args=(user, index))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: controller.stats()["queued"] == len(threads))
+    controller.release()
+    for thread in threads:
+        thread.join()
+    assert order == [("batch", 1), ("single", 1), ("batch", 2), ("batch", 3)]
@@ -0,0 +1,153 @@
+"""
+Smoke tests of app.py's main() under Streamlit's AppTest harness, with the
+offline stand-in models in place of the Keras models.
+"""
+import io
+import os
+import subprocess
+import sys
+import uuid
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import offline
+from tests.conftest import ROOT
+
+TIMEOUT = 60
+
+# Run in a fresh interpreter, so no other test has imported TensorFlow yet
+ANALYSIS_WITHOUT_TENSORFLOW = """
+import sys
+
+from tests.conftest import ROOT, USERS
+from tests.test_app_smoke import TIMEOUT, sign_in, xray_upload
+import offline
+from streamlit.testing.v1 import AppTest
+
+app = AppTest.from_file(ROOT + "/app.py", default_timeout=TIMEOUT)
+sign_in(app, "lazy@example.com")
+offline.set_uploads("lazy@example.com", [xray_upload("lazy-1")])
+app.run()
+assert not app.exception and not app.error, [error.value for error in app.error]
+assert USERS.users["lazy@example.com"]["usage_count"] == 1
+assert "tensorflow" not in sys.modules, "TensorFlow was imported"
+"""
+
+@pytest.fixture
+def app():
+    from streamlit.testing.v1 import AppTest
+    return AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=TIMEOUT)
+
+def colorful_image(image_format: str = "JPEG") -> bytes:
+    """A random, saturated image that no pre-screen would take for an X-ray"""
+    rng = np.random.default_rng(0)
+    # Colour blocks rather than per-pixel noise, which averages out to grey in a thumbnail
+    blocks = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+    pixels = np.kron(blocks, np.ones((32, 32, 1), dtype=np.uint8))
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+def xray_upload(file_id: str) -> "offline.OfflineUpload":
+    """A sample chest X-ray that passes both X-ray checks, with trailing bytes so it misses the prediction cache"""
+    from inference_utils import decode_image, prescreen
+    from ui_utils import is_xray_image
+
+    for name in sorted(os.listdir(os.path.join(ROOT, "Images"))):
+        path = os.path.join(ROOT, "Images", name)
+        if name.lower().endswith((".jpg", ".jpeg")) and prescreen(path)[0] and is_xray_image(decode_image(path)[0]):
+            with open(path, "rb") as f:
+                return offline.OfflineUpload(f.read() + uuid.uuid4().bytes, name, file_id)
+    raise AssertionError("no sample X-ray passes the X-ray checks")
+
+def sign_in(app, email: str):
+    from auth_utils import generate_token
+
+    app.query_params["token"] = generate_token(email, email.split("@")[0], offline.BENCH_SECRET_KEY)
+    app.run()
+    assert app.session_state.authenticated
+
+def test_unauthenticated_visit_is_refused(app):
+    app.run()
+    assert not app.exception
+    assert any("Unauthorized" in error.value for error in app.error)
+
+# PNGs are pre-screened only after taking an analysis slot, JPEGs before
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+def test_non_xray_is_rejected_without_charging_usage(app, users, image_format):
+    from auth_utils import generate_token
+
+    email = "smoke@example.com"
+    app.query_params["token"] = generate_token(email, "Smoke", offline.BENCH_SECRET_KEY)
+    app.run()
+    assert not app.exception
+    assert app.session_state.authenticated
+    assert "token" not in app.query_params
+
+    name = f"photo.{image_format.lower()}"
+    offline.set_uploads(email, [offline.OfflineUpload(colorful_image(image_format), name, "smoke-1")])
+    try:
+        app.run()
+    finally:
+        offline.set_uploads(email, None)
+    assert not app.exception
+    assert any("does not appear to be an X-ray" in error.value for error in app.error)
+    assert users.users[email]["usage_count"] == 0
+
+def test_new_browser_session_resumes_through_the_handoff(app, users):
+    from streamlit.testing.v1 import AppTest
+    from auth_utils import generate_token
+
+    app.query_params["token"] = generate_token("resume@example.com", "Resume", offline.BENCH_SECRET_KEY)
+    app.run()
+    handoff = app.query_params["sid"]
+
+    reconnected = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=TIMEOUT)
+    reconnected.query_params["sid"] = handoff
+    reconnected.run()
+    assert not reconnected.exception
+    assert reconnected.session_state.authenticated
+    assert reconnected.session_state.user_email == "resume@example.com"
+    # The handoff is one-time; the URL now carries a fresh one
+    assert reconnected.query_params["sid"] not in ("", handoff)
+
+def test_timed_out_analysis_is_charged_once(app, users, monkeypatch):
+    # Nothing finishes within a zero timeout
+    monkeypatch.setenv("DIAGNOAI_INFERENCE_TIMEOUT", "0")
+    email = "timeout@example.com"
+    sign_in(app, email)
+
+    offline.set_uploads(email, [xray_upload("timeout-1")])
+    try:
+        for _ in range(3):
+            app.run()
+            assert not app.exception
+            assert any("took too long" in error.value for error in app.error)
+    finally:
+        offline.set_uploads(email, None)
+    assert users.users[email]["usage_count"] == 1
+
+def test_analysis_with_stand_in_models_never_imports_tensorflow():
+    result = subprocess.run([sys.executable, "-c", ANALYSIS_WITHOUT_TENSORFLOW], cwd=ROOT,
+                            capture_output=True, text=True, timeout=TIMEOUT * 2)
+    assert result.returncode == 0, result.stderr
+
+def test_rerun_with_the_same_upload_redraws_the_result_without_charging_again(app, users):
+    email = "rerun@example.com"
+    sign_in(app, email)
+
+    offline.set_uploads(email, [xray_upload("rerun-1")])
+    drawn = []
+    try:
+        for _ in range(3):
+            app.run()
+            assert not app.exception
+            assert any(markdown.value == "### Prediction" for markdown in app.markdown)
+            drawn.append([element.value for element in [*app.success, *app.error]
+                          if element.value.startswith("The model predicts")])
+    finally:
+        offline.set_uploads(email, None)
+    assert len(drawn[0]) == 1 and drawn[1:] == [drawn[0]] * 2
+    assert users.users[email]["usage_count"] == 1
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from aws_secrets_utils import SecretsCache
+
+class FakeBackend:
+    """Returns a new version of the secret on every fetch, or raises while failing is set; fetches wait for gate"""
+
+    def __init__(self):
+        self.fetches = 0
+        self.failing = False
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def fetch(self, secret_name, region_name):
+        self.gate.wait(5)
+        if self.failing:
+            raise ConnectionError("secrets backend unavailable")
+        self.fetches += 1
+        return {"version": self.fetches}
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def backend():
+    return FakeBackend()
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+@pytest.fixture
+def cache(backend, clock):
+    return SecretsCache(backend, ttl=100, refresh_after=80, clock=clock)
+
+def settle(cache):
+    """Wait for the cache's background refreshes to finish"""
+    deadline = time.monotonic() + 5
+    while cache._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not cache._refreshing
+
+def test_fresh_entries_are_served_from_memory_until_they_expire(cache, backend, clock):
+    assert cache.get("app", "region") == {"version": 1}
+    clock.now = 79
+    assert cache.get("app", "region") == {"version": 1}
+    assert backend.fetches == 1
+
+    # Past the TTL the secret is fetched before it is served
+    clock.now = 100
+    assert cache.get("app", "region") == {"version": 2}
+    assert backend.fetches == 2
+
+def test_ageing_entries_are_served_while_one_background_refresh_runs(cache, backend, clock):
+    cache.get("app", "region")
+    backend.gate.clear()
+    clock.now = 80
+    assert cache.get("app", "region") == {"version": 1}
+    assert cache.get("app", "region") == {"version": 1}
+    backend.gate.set()
+    settle(cache)
+
+    assert backend.fetches == 2
+    assert cache.get("app", "region") == {"version": 2}
+    # The refreshed entry is aged from the refresh
+    clock.now = 159
+    assert cache.get("app", "region") == {"version": 2}
+    assert backend.fetches == 2
+
+def test_failed_refresh_keeps_serving_the_cached_value_until_it_expires(cache, backend, clock):
+    cache.get("app", "region")
+    backend.failing = True
+    clock.now = 80
+    assert cache.get("app", "region") == {"version": 1}
+    settle(cache)
+
+    clock.now = 99
+    assert cache.get("app", "region") == {"version": 1}
+    settle(cache)
+    clock.now = 100
+    with pytest.raises(ConnectionError):
+        cache.get("app", "region")
+
+    backend.failing = False
+    assert cache.get("app", "region") == {"version": 2}
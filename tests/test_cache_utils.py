@@ -0,0 +1,49 @@
+import threading
+
+from cache_utils import PredictionCache, prediction_cache_key
+
+PREDICTION = {"is_xray": True, "predicted_class": "Normal", "confidence": 0.9,
+              "probabilities": [0.025, 0.9, 0.025, 0.025, 0.025], "edema_prediction": None}
+
+def test_key_depends_on_bytes_and_model_version():
+    key = prediction_cache_key(b"image", "v1")
+    assert key == prediction_cache_key(b"image", "v1")
+    assert key != prediction_cache_key(b"image", "v2")
+    assert key != prediction_cache_key(b"other", "v1")
+    assert key == prediction_cache_key(memoryview(b"image"), "v1")
+
+def test_evicts_least_recently_used_entry():
+    cache = PredictionCache(max_entries=2, disk_dir=None)
+    cache.put("a", PREDICTION)
+    cache.put("b", PREDICTION)
+    assert cache.get("a") == PREDICTION
+    cache.put("c", PREDICTION)
+    assert cache.get("b") is None
+    assert cache.get("a") == PREDICTION
+    assert cache.get("c") == PREDICTION
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    PredictionCache(disk_dir=str(tmp_path)).put("a", PREDICTION)
+    cache = PredictionCache(disk_dir=str(tmp_path))
+    assert cache.get("a") == PREDICTION
+    assert cache.disk_hits == 1
+    assert cache.get("missing") is None
+
+def test_concurrent_puts_and_gets_stay_within_bounds():
+    cache = PredictionCache(max_entries=50, disk_dir=None)
+
+    def worker(offset):
+        for i in range(500):
+            key = f"{offset}-{i % 80}"
+            cache.put(key, PREDICTION)
+            cache.get(key)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats["entries"] == 50
+    assert stats["hits"] + stats["misses"] == 8 * 500
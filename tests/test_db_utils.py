@@ -0,0 +1,169 @@
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool
+
+import db_utils
+from ledger_utils import ledger_row
+
+USER_ROW = {"usage_count": 2, "paid_user": 0, "premium_usage_count": 0, "subscription_expires_at": None}
+
+def test_login_never_runs_ddl_when_the_index_is_missing(connection):
+    # No unique index, no user row yet, then the inserted row
+    connection.rows = [None, None, USER_ROW]
+    status = db_utils.bootstrap_user("a@example.com", "A")
+    assert status == {**USER_ROW, "paid_user": False, "created": True}
+    queries = [query for query, _ in connection.statements]
+    assert not any(query.startswith(("CREATE", "ALTER", "DROP")) for query in queries)
+    assert "ON CONFLICT" not in " ".join(queries)
+    assert queries[2].startswith("INSERT INTO bbt_user_doctorai")
+
+def test_existing_users_are_only_read_without_the_index(postgres):
+    first = db_utils.bootstrap_user("a@example.com", "A")
+    second = db_utils.bootstrap_user("a@example.com", "A")
+    assert first["created"] and not second["created"]
+    assert db_utils._user_email_unique is False
+    with postgres.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM bbt_user_doctorai")
+        assert cursor.fetchone()[0] == 1
+        cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE tablename = 'bbt_user_doctorai'")
+        # Only the primary key: the app creates no index of its own
+        assert cursor.fetchone()[0] == 1
+
+def test_upserts_once_the_migration_has_run(postgres, monkeypatch):
+    monkeypatch.setattr(db_utils, "USER_EMAIL_INDEX_RECHECK_SECONDS", 0.0)
+    assert db_utils.bootstrap_user("a@example.com", "A")["created"]
+    with postgres.cursor() as cursor:
+        cursor.execute("CREATE UNIQUE INDEX CONCURRENTLY bbt_user_doctorai_email_key ON bbt_user_doctorai (email)")
+    assert not db_utils.bootstrap_user("a@example.com", "A")["created"]
+    assert db_utils._user_email_unique is True
+    assert db_utils.bootstrap_user("b@example.com", "B")["created"]
+
+def test_logins_by_existing_users_draw_no_sequence_values(postgres, monkeypatch):
+    monkeypatch.setattr(db_utils, "USER_EMAIL_INDEX_RECHECK_SECONDS", 0.0)
+    with postgres.cursor() as cursor:
+        cursor.execute("CREATE UNIQUE INDEX CONCURRENTLY bbt_user_doctorai_email_key ON bbt_user_doctorai (email)")
+    assert db_utils.bootstrap_user("a@example.com", "A")["created"]
+    for _ in range(3):
+        assert not db_utils.bootstrap_user("a@example.com", "A")["created"]
+    assert db_utils.bootstrap_user("b@example.com", "B")["created"]
+    with postgres.cursor() as cursor:
+        cursor.execute("SELECT id FROM bbt_user_doctorai ORDER BY id")
+        assert [row[0] for row in cursor.fetchall()] == [1, 2]
+
+def test_reconcile_raises_counters_to_the_ledger(postgres):
+    with postgres.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO bbt_user_doctorai (email, usage_count, premium_usage_count, paid_user, subscription_expires_at)
+            VALUES ('a@example.com', 1, 0, 1, %s), ('b@example.com', 5, 0, 0, NULL)
+        """, (int(time.time() + 12 * 3600),))
+    assert db_utils.create_usage_ledger_table()
+    before_subscription = (datetime.now(timezone.utc) - timedelta(days=2),)
+    rows = (
+        [ledger_row("a@example.com", {"is_xray": True}) for _ in range(3)] +
+        [ledger_row("a@example.com", {"is_xray": True}, premium=True) for _ in range(2)] +
+        # A premium analysis from an earlier subscription does not count against this one
+        [before_subscription + ledger_row("a@example.com", {"is_xray": True}, premium=True)[1:]] +
+        # Counters are never lowered to the ledger
+        [ledger_row("b@example.com", {"is_xray": True}) for _ in range(2)]
+    )
+    assert db_utils.insert_usage_ledger_rows(rows)
+
+    assert db_utils.reconcile_usage_counts(subscription_days=1) == 1
+    with postgres.cursor() as cursor:
+        cursor.execute("SELECT email, usage_count, premium_usage_count FROM bbt_user_doctorai ORDER BY email")
+        assert cursor.fetchall() == [("a@example.com", 3, 2), ("b@example.com", 5, 0)]
+    assert db_utils.reconcile_usage_counts(subscription_days=1) == 0
+
+class PooledConnection:
+    """A psycopg2 connection as the pool and db_utils' health check see it; alive=False drops the server"""
+
+    def __init__(self):
+        self.closed = 0
+        self.alive = True
+        self.info = SimpleNamespace(transaction_status=TRANSACTION_STATUS_IDLE)
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        if not self.alive:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def rollback(self):
+        self.execute("ROLLBACK")
+
+    def close(self):
+        self.closed = 1
+
+@pytest.fixture
+def pooled(monkeypatch):
+    """db_utils' pool, one connection wide, over PooledConnections; returns every connection it opened"""
+    connections = []
+
+    def connect(*args, **kwargs):
+        connections.append(PooledConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, "connect", connect)
+    monkeypatch.setattr(db_utils, "_db_pool", ThreadedConnectionPool(1, 1))
+    monkeypatch.setattr(db_utils, "_db_pool_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(db_utils, "_connection_last_used", {})
+    monkeypatch.setattr(db_utils, "DB_POOL_TIMEOUT", 0.2)
+    return connections
+
+def test_exhausted_pool_gives_up_after_the_timeout(pooled):
+    with db_utils.db_connection() as conn:
+        assert conn is pooled[0]
+        started = time.monotonic()
+        with db_utils.db_connection() as waited:
+            assert waited is None
+        assert time.monotonic() - started >= 0.2
+
+def test_exhausted_pool_hands_a_released_connection_to_the_waiter(pooled, monkeypatch):
+    monkeypatch.setattr(db_utils, "DB_POOL_TIMEOUT", 10)
+    borrowed = []
+
+    def borrow():
+        with db_utils.db_connection() as conn:
+            borrowed.append(conn)
+
+    with ExitStack() as stack:
+        stack.enter_context(db_utils.db_connection())
+        waiter = threading.Thread(target=borrow)
+        waiter.start()
+        waiter.join(0.1)
+        assert waiter.is_alive()
+    waiter.join(5)
+    assert borrowed == [pooled[0]]
+
+def test_connection_that_broke_while_borrowed_is_discarded(pooled):
+    with db_utils.db_connection() as conn:
+        conn.alive = False
+    assert conn.closed and conn not in db_utils._db_pool._pool
+
+    with db_utils.db_connection() as conn:
+        assert conn is pooled[1]
+
+def test_idle_connection_that_fails_the_ping_is_replaced(pooled, monkeypatch):
+    monkeypatch.setattr(db_utils, "DB_HEALTHCHECK_IDLE_SECONDS", 0.0)
+    with db_utils.db_connection() as conn:
+        pass
+    assert db_utils._db_pool._pool == [conn]
+    conn.alive = False
+
+    with db_utils.db_connection() as replacement:
+        assert replacement is pooled[1]
+    assert conn.closed and db_utils._db_pool._pool == [replacement]
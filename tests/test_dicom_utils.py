@@ -0,0 +1,31 @@
+import io
+
+import numpy as np
+import pydicom
+import pytest
+
+from bench_dicom import synthetic_dicom
+from dicom_utils import decode_dicom
+
+SIZE = 448
+
+def reference(data: bytes) -> np.ndarray:
+    """Full-frame VOI windowing, then a 2x downscale (bilinear with half-pixel centres is a 2x2 mean)"""
+    ds = pydicom.dcmread(io.BytesIO(data))
+    frame = ds.pixel_array[0] if int(getattr(ds, "NumberOfFrames", 1) or 1) > 1 else ds.pixel_array
+    center, width = float(ds.WindowCenter), float(ds.WindowWidth)
+    windowed = ((frame - (center - 0.5)) / (width - 1) + 0.5) * 255.0
+    display = np.uint8(np.clip(windowed, 0, 255)).astype(np.float32)
+    return display.reshape(SIZE // 2, 2, SIZE // 2, 2).mean(axis=(1, 3))
+
+@pytest.mark.parametrize("frames,compressed", [(3, False), (1, True), (3, True)],
+                         ids=["multi-frame", "rle", "multi-frame-rle"])
+def test_decodes_the_windowed_first_frame_at_model_size(frames, compressed):
+    data = synthetic_dicom(SIZE, frames=frames, window=True, compressed=compressed)
+    img = decode_dicom(io.BytesIO(data), size=(SIZE // 2, SIZE // 2))
+
+    assert img.shape == (SIZE // 2, SIZE // 2, 3) and img.dtype == np.float32
+    assert np.array_equal(img[..., 0], img[..., 1]) and np.array_equal(img[..., 0], img[..., 2])
+    np.testing.assert_allclose(img[..., 0], reference(data), atol=1e-3)
+    # The window clips: the body saturates and the background is black
+    assert img.min() == 0 and img.max() == 255
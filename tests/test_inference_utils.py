@@ -0,0 +1,60 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import inference_utils
+from inference_utils import MULTI_CLASS_NAMES, decode_image, decode_preview, load_lazy_models, prescreen
+from offline import StandInModel
+from tests.conftest import ROOT
+
+SAMPLE_IMAGES = sorted(os.path.join(ROOT, "Images", name) for name in os.listdir(os.path.join(ROOT, "Images")))
+
+@pytest.mark.parametrize("path", SAMPLE_IMAGES, ids=os.path.basename)
+def test_preview_alone_matches_the_preview_of_a_full_decode(path):
+    _, preview = decode_image(path)
+    alone = decode_preview(path)
+    assert alone.size == preview.size
+    assert np.array_equal(np.asarray(alone), np.asarray(preview))
+
+def test_prescreen_can_leave_full_decodes_to_the_caller():
+    png = next(path for path in SAMPLE_IMAGES if path.lower().endswith(".png"))
+    jpeg = next(path for path in SAMPLE_IMAGES if path.lower().endswith((".jpg", ".jpeg")))
+    assert prescreen(png, full_decode=False) == (None, None)
+    plausible, decoded = prescreen(png)
+    assert plausible is not None and decoded is not None
+    assert prescreen(jpeg, full_decode=False) == prescreen(jpeg)
+
+def test_lazy_model_loads_once_on_first_use_under_concurrent_calls(monkeypatch):
+    loads = []
+
+    def load_model(model_path, **kwargs):
+        loads.append(model_path)
+        # Slow enough that every caller arrives while the first load is running
+        time.sleep(0.2)
+        return StandInModel(len(MULTI_CLASS_NAMES))
+
+    monkeypatch.setattr(inference_utils, "load_model", load_model)
+    multi_model, edema_model = load_lazy_models("multi.h5", "edema.h5", background=False)
+    assert not multi_model.loaded and not edema_model.loaded and loads == []
+
+    image = np.zeros((1, 224, 224, 3), dtype=np.float32)
+    start = threading.Barrier(8)
+    results = []
+
+    def predict():
+        start.wait()
+        results.append(multi_model.predict(image))
+
+    threads = [threading.Thread(target=predict) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == ["multi.h5"]
+    assert len(results) == 8 and multi_model.loaded
+    # The Edema model waits for its own first prediction
+    assert not edema_model.loaded
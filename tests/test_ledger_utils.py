@@ -0,0 +1,76 @@
+import time
+import threading
+
+from ledger_utils import UsageLedger, ledger_row
+
+class RecordingWriter:
+    """Ledger writer that keeps the batches it is given, failing the first fail_first calls"""
+
+    def __init__(self, fail_first: int = 0, delay: float = 0.0):
+        self.batches = []
+        self.fail_first = fail_first
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, rows: list) -> bool:
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls += 1
+            if self.calls <= self.fail_first:
+                return False
+            self.batches.append(list(rows))
+            return True
+
+    @property
+    def rows(self) -> list:
+        return [row for batch in self.batches for row in batch]
+
+def test_writes_in_batches_and_drains_on_close():
+    writer = RecordingWriter(delay=0.01)
+    ledger = UsageLedger(batch_size=5, flush_interval=0.05, writer=writer)
+    for i in range(23):
+        assert ledger.record(i)
+    ledger.close(timeout=5)
+    assert writer.rows == list(range(23))
+    assert all(len(batch) <= 5 for batch in writer.batches)
+    assert ledger.written == 23
+    assert not ledger.record(23)
+
+def test_failed_batches_are_retried():
+    writer = RecordingWriter(fail_first=2)
+    ledger = UsageLedger(batch_size=10, flush_interval=0.01, writer=writer)
+    for i in range(3):
+        ledger.record(i)
+    deadline = time.monotonic() + 5
+    while not writer.rows and time.monotonic() < deadline:
+        time.sleep(0.01)
+    ledger.close(timeout=5)
+    assert writer.rows == [0, 1, 2]
+    assert writer.calls == 3
+
+def test_drops_rows_beyond_max_pending():
+    writer = RecordingWriter(delay=0.5)
+    ledger = UsageLedger(batch_size=1, flush_interval=0.01, max_pending=2, writer=writer)
+    recorded = [ledger.record(i) for i in range(10)]
+    assert not all(recorded)
+    assert ledger.dropped == recorded.count(False)
+    ledger.close(timeout=10)
+    assert len(writer.rows) == recorded.count(True)
+
+def test_concurrent_records_are_all_written():
+    writer = RecordingWriter()
+    ledger = UsageLedger(batch_size=50, flush_interval=0.02, writer=writer)
+    threads = [threading.Thread(target=lambda n=n: [ledger.record((n, i)) for i in range(200)]) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ledger.close(timeout=5)
+    assert sorted(writer.rows) == sorted((n, i) for n in range(4) for i in range(200))
+
+def test_ledger_row_serializes_probabilities():
+    row = ledger_row("a@example.com", {"is_xray": True, "predicted_class": "Normal", "confidence": 0.9,
+                                       "probabilities": [0.1, 0.9], "edema_prediction": None},
+                     premium=True, latency_ms=12.5, cached=True)
+    assert row[1:] == ("a@example.com", True, True, "Normal", 0.9, None, "[0.1, 0.9]", 12.5, True)
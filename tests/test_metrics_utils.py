@@ -0,0 +1,22 @@
+from metrics_utils import MetricsRegistry
+
+def test_counters_have_help_and_type_lines():
+    registry = MetricsRegistry(json_log=False)
+    registry.increment("rejections", reason="not_xray")
+    registry.increment("custom_events")
+    lines = registry.render_prometheus().splitlines()
+    assert lines.index("# TYPE diagnoai_rejections_total counter") == 1 + next(
+        index for index, line in enumerate(lines) if line.startswith("# HELP diagnoai_rejections_total "))
+    assert "prediction cache" in next(line for line in lines if line.startswith("# HELP diagnoai_rejections_total"))
+    assert "# HELP diagnoai_custom_events_total Count of custom_events events" in lines
+    assert 'diagnoai_rejections_total{reason="not_xray"} 1' in lines
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry(json_log=False)
+    registry.increment("db_errors", kind='say "hi"\\now\nthen')
+    registry.observe('odd"stage', 0.01)
+    text = registry.render_prometheus()
+    assert 'diagnoai_db_errors_total{kind="say \\"hi\\"\\\\now\\nthen"} 1' in text
+    assert 'diagnoai_stage_seconds_count{stage="odd\\"stage"} 1' in text
+    # Every sample stays on one line
+    assert all(line.startswith(("#", "diagnoai_")) for line in text.splitlines())
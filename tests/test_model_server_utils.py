@@ -0,0 +1,65 @@
+import threading
+from multiprocessing import AuthenticationError
+
+import numpy as np
+import pytest
+
+from inference_utils import MULTI_CLASS_NAMES, predict_arrays
+from model_server_utils import ModelServer, ModelServerClient
+from offline import StandInModel
+
+AUTHKEY = "test-authkey"
+
+def images(count: int) -> np.ndarray:
+    return np.stack([np.full((224, 224, 3), i * 37 % 256, dtype=np.float32) for i in range(count)])
+
+def start_server(tmp_path, multi_model) -> ModelServer:
+    server = ModelServer(multi_model, StandInModel(1), str(tmp_path / "server.sock"), authkey=AUTHKEY)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@pytest.fixture
+def server(tmp_path):
+    server = start_server(tmp_path, StandInModel(len(MULTI_CLASS_NAMES)))
+    yield server
+    server.close()
+
+@pytest.fixture
+def client(server):
+    client = ModelServerClient(server.address, authkey=AUTHKEY, max_connections=2, capacity=4)
+    yield client
+    client.shutdown()
+
+def test_predictions_round_trip_through_shared_memory(client):
+    batch = images(6)
+    expected = predict_arrays(batch, StandInModel(len(MULTI_CLASS_NAMES)), StandInModel(1))
+
+    # Six images through a four-image channel: the request is split in two
+    results = client.predict_many(batch, timeout=10)
+
+    assert [r["predicted_class"] for r in results] == [e["predicted_class"] for e in expected]
+    assert [r["edema_prediction"] for r in results] == pytest.approx([e["edema_prediction"] for e in expected])
+    np.testing.assert_allclose([r["probabilities"] for r in results], [e["probabilities"] for e in expected])
+    assert client.predict(batch[0], timeout=10) == results[0]
+
+def test_timed_out_request_drops_its_channel(tmp_path):
+    server = start_server(tmp_path, StandInModel(len(MULTI_CLASS_NAMES), latency_ms=200))
+    client = ModelServerClient(server.address, authkey=AUTHKEY, max_connections=1)
+    try:
+        with pytest.raises(TimeoutError):
+            client.predict(images(1)[0], timeout=0.05)
+        # The late reply would be read by the next request on that channel, so it is gone
+        assert client._idle.empty()
+
+        assert client.predict(images(1)[0], timeout=10)["predicted_class"] in MULTI_CLASS_NAMES
+        assert client._idle.qsize() == 1
+    finally:
+        client.shutdown()
+        server.close()
+
+def test_wrong_authkey_is_rejected_and_the_server_keeps_serving(server, client):
+    intruder = ModelServerClient(server.address, authkey="wrong-authkey")
+    with pytest.raises(AuthenticationError):
+        intruder.predict(images(1)[0], timeout=10)
+
+    assert client.predict(images(1)[0], timeout=10)["predicted_class"] in MULTI_CLASS_NAMES
@@ -0,0 +1,37 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from pipeline_utils import PreprocessPipeline
+from tests.conftest import ROOT
+
+SAMPLE_IMAGES = sorted(os.path.join(ROOT, "Images", name) for name in os.listdir(os.path.join(ROOT, "Images")))
+
+def png(img: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def predictor(images):
+    return [{"predicted_class": "Normal", "confidence": 1.0, "probabilities": None, "edema_prediction": None}
+            for _ in images]
+
+@pytest.fixture(params=[1, 2], ids=["inline", "threads"])
+def pipeline(request):
+    with PreprocessPipeline(workers=request.param, start_method="thread") as pipeline:
+        yield pipeline
+
+def test_screened_run_matches_a_run_that_screens(pipeline):
+    sources = SAMPLE_IMAGES[:3] + [png(Image.new("RGB", (256, 256), (255, 0, 0))), b"not an image"]
+    screened = pipeline.prescreen(sources)
+
+    assert [plausible for plausible, _, _ in screened] == [True, True, True, False, False]
+    assert screened[-1][2] is not None
+
+    plausible = [decoded if decoded is not None else source
+                 for source, (ok, decoded, _) in zip(sources, screened) if ok]
+    results = list(pipeline.run(plausible, predictor, batch_size=2, screened=True))
+    unscreened = list(pipeline.run(sources[:3], predictor, batch_size=2))
+    assert [result["is_xray"] for result in results] == [result["is_xray"] for result in unscreened]
@@ -0,0 +1,80 @@
+import threading
+
+import numpy as np
+import pytest
+
+from inference_utils import MULTI_CLASS_NAMES, predict_arrays
+from offline import StandInModel
+from scheduler_utils import InferenceScheduler
+
+class CountingModel(StandInModel):
+    """The offline stand-in model, recording the size of every batch it is given"""
+
+    def __init__(self, outputs: int):
+        super().__init__(outputs)
+        self.batch_sizes = []
+
+    def predict(self, x, batch_size=None, verbose=0):
+        self.batch_sizes.append(len(x))
+        return super().predict(x, batch_size=batch_size, verbose=verbose)
+
+def images(count: int) -> np.ndarray:
+    return np.stack([np.full((224, 224, 3), i * 37 % 256, dtype=np.float32) for i in range(count)])
+
+def expected_predictions(batch: np.ndarray) -> list:
+    return predict_arrays(batch, CountingModel(len(MULTI_CLASS_NAMES)), CountingModel(1))
+
+def test_concurrent_requests_are_batched_and_get_their_own_results():
+    multi_model, edema_model = CountingModel(len(MULTI_CLASS_NAMES)), CountingModel(1)
+    scheduler = InferenceScheduler(multi_model, edema_model, max_batch_size=8, max_wait_ms=50)
+    batch = images(24)
+    results = [None] * len(batch)
+
+    def request(index):
+        results[index] = scheduler.predict(batch[index], timeout=10)
+
+    threads = [threading.Thread(target=request, args=(index,)) for index in range(len(batch))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    scheduler.shutdown()
+
+    assert results == expected_predictions(batch)
+    assert max(multi_model.batch_sizes) > 1
+    assert all(size <= 8 for size in multi_model.batch_sizes)
+    assert sum(multi_model.batch_sizes) == len(batch)
+
+def test_predict_many_keeps_input_order():
+    scheduler = InferenceScheduler(CountingModel(len(MULTI_CLASS_NAMES)), CountingModel(1), max_batch_size=4)
+    batch = images(10)
+    assert scheduler.predict_many(batch, timeout=10) == expected_predictions(batch)
+    scheduler.shutdown()
+
+def test_model_errors_reach_every_caller():
+    class FailingModel:
+        def predict(self, x, batch_size=None, verbose=0):
+            raise ValueError("model failed")
+
+    scheduler = InferenceScheduler(FailingModel(), CountingModel(1), max_batch_size=4)
+    futures = [scheduler.submit(image) for image in images(3)]
+    for future in futures:
+        assert isinstance(future.exception(timeout=10), ValueError)
+    scheduler.shutdown()
+
+def test_timeout_raises_and_drops_the_images_not_yet_batched():
+    release = threading.Event()
+
+    class BlockingModel(CountingModel):
+        def predict(self, x, batch_size=None, verbose=0):
+            release.wait(10)
+            return super().predict(x, batch_size=batch_size, verbose=verbose)
+
+    multi_model = BlockingModel(len(MULTI_CLASS_NAMES))
+    scheduler = InferenceScheduler(multi_model, CountingModel(1), max_batch_size=1, max_wait_ms=0)
+    with pytest.raises(TimeoutError):
+        scheduler.predict_many(images(3), timeout=0.2)
+    release.set()
+    scheduler.shutdown()
+    # Only the image already running reached the model
+    assert multi_model.batch_sizes == [1]
@@ -0,0 +1,65 @@
+import time
+import threading
+
+import pytest
+
+import state_utils
+from state_utils import CachedStateStore, MemoryStateStore, SqliteStateStore
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateStore()
+    return SqliteStateStore(str(tmp_path / "state.db"))
+
+@pytest.fixture
+def shared_store(monkeypatch):
+    """Point the module-level session and handoff helpers at an in-memory store"""
+    monkeypatch.setattr(state_utils, "_state_store", CachedStateStore(MemoryStateStore()))
+
+def test_records_expire(store):
+    store.put("session", "a", {"user_email": "a@example.com"}, ttl=0.05)
+    assert store.get("session", "a") == {"user_email": "a@example.com"}
+    time.sleep(0.1)
+    assert store.get("session", "a") is None
+
+def test_take_returns_a_record_once(store):
+    store.put("handoff", "h", {"session_id": "s"}, ttl=10)
+    assert store.take("handoff", "h") == {"session_id": "s"}
+    assert store.take("handoff", "h") is None
+    assert store.get("handoff", "h") is None
+
+def test_concurrent_takes_get_the_record_once(store):
+    store.put("handoff", "h", {"session_id": "s"}, ttl=10)
+    taken = []
+    threads = [threading.Thread(target=lambda: taken.append(store.take("handoff", "h"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [record for record in taken if record] == [{"session_id": "s"}]
+
+def test_cache_serves_reads_and_sees_its_own_writes():
+    backing = MemoryStateStore()
+    cached = CachedStateStore(backing, ttl=60)
+    cached.put("session", "a", {"user_name": "A"}, ttl=60)
+    backing.put("session", "a", {"user_name": "B"}, ttl=60)
+    # Another replica's write is not seen until the cached copy expires...
+    assert cached.get("session", "a") == {"user_name": "A"}
+    # ...but this process's writes are seen at once
+    cached.put("session", "a", {"user_name": "C"}, ttl=60)
+    assert cached.get("session", "a") == {"user_name": "C"}
+    cached.delete("session", "a")
+    assert cached.get("session", "a") is None
+
+def test_handoff_resolves_to_its_session_once(shared_store):
+    handoff = state_utils.issue_handoff("session-1")
+    assert state_utils.take_handoff(handoff) == "session-1"
+    assert state_utils.take_handoff(handoff) is None
+
+def test_session_records_do_not_outlive_the_token(shared_store):
+    expired = {"user_name": "A", "user_email": "a@example.com", "authenticated": True,
+               "session_expires_at": time.time() - 1}
+    assert not state_utils.save_session("session-2", expired)
+    assert state_utils.issue_handoff("session-2", expired["session_expires_at"]) is None
+    assert state_utils.session_ttl(time.time() + 60) <= 60
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import tflite_utils
+from tflite_utils import TFLiteModel, convert_and_save_model, convert_model
+
+def keras_model(outputs: int = 5):
+    """A small model with the app's input shape"""
+    inputs = tf.keras.Input(shape=(224, 224, 3))
+    x = tf.keras.layers.Conv2D(4, 8, strides=8, activation="relu")(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    return tf.keras.Model(inputs, tf.keras.layers.Dense(outputs, activation="softmax")(x))
+
+def images(count: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).random((count, 224, 224, 3), dtype=np.float32)
+
+@pytest.fixture(scope="module")
+def model():
+    tf.keras.utils.set_random_seed(0)
+    return keras_model()
+
+@pytest.fixture(scope="module")
+def int8_content(model):
+    return convert_model(model, "int8", images(8))
+
+@pytest.fixture
+def int8_model(int8_content):
+    return TFLiteModel(model_content=int8_content, num_threads=1)
+
+def test_int8_model_takes_and_returns_float32(model, int8_model):
+    _, input_details, output_details = int8_model._interpreter(1)
+    assert input_details["dtype"] == np.int8 and output_details["dtype"] == np.int8
+
+    batch = images(4, seed=1)
+    predicted = int8_model.predict(batch)
+    assert predicted.dtype == np.float32
+    # Within a few quantization steps of the float model
+    np.testing.assert_allclose(predicted, model.predict(batch, verbose=0),
+                               atol=4 * output_details["quantization"][0])
+
+def test_int8_inputs_outside_the_calibrated_range_saturate(int8_model):
+    _, input_details, _ = int8_model._interpreter(1)
+    scale, zero_point = input_details["quantization"]
+    largest = (127 - zero_point) * scale
+    # Rounded without clipping, these would wrap around to negative int8 values
+    np.testing.assert_array_equal(int8_model.predict(np.full((1, 224, 224, 3), 10 * largest, np.float32)),
+                                  int8_model.predict(np.full((1, 224, 224, 3), largest, np.float32)))
+
+def test_each_batch_size_keeps_its_interpreter(int8_model):
+    batch = images(3, seed=2)
+    single = [int8_model.predict(image[np.newaxis])[0] for image in batch]
+    triple = int8_model._interpreter(3)[0]
+
+    for _ in range(2):
+        np.testing.assert_array_equal(int8_model.predict(batch), single)
+        np.testing.assert_array_equal(int8_model.predict(batch[:1])[0], single[0])
+    assert int8_model._interpreter(3)[0] is triple
+    assert sorted(int8_model._interpreters) == [1, 3]
+
+def test_conversion_replaces_the_tflite_file_atomically(model, tmp_path, monkeypatch):
+    model_path = str(tmp_path / "model.h5")
+    model.save(model_path)
+    output_path = convert_and_save_model(model_path, "float")
+    converted = open(output_path, "rb").read()
+    np.testing.assert_allclose(TFLiteModel(output_path).predict(images(1)), model.predict(images(1), verbose=0),
+                               atol=1e-5)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("conversion failed")
+
+    monkeypatch.setattr(tflite_utils, "convert_model", fail)
+    with pytest.raises(RuntimeError):
+        convert_and_save_model(model_path, "float")
+    # The earlier file is untouched and no partial file is left behind
+    assert open(output_path, "rb").read() == converted
+    assert sorted(os.listdir(tmp_path)) == ["model.float.tflite", "model.h5"]
@@ -0,0 +1,74 @@
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from bench_xray import legacy_is_xray_image
+from inference_utils import decode_image, prescreen
+from tests.conftest import ROOT
+from ui_utils import XRAY_HIST_BINS, XRAY_INTENSITY_RANGE, is_xray_batch, is_xray_image
+
+SAMPLE_IMAGES = sorted(os.path.join(ROOT, "Images", name) for name in os.listdir(os.path.join(ROOT, "Images")))
+
+def variants(pixels: np.ndarray, rng):
+    """The image plus rescaled, contrast-stretched, gamma-adjusted and noisy versions of it"""
+    pixels = pixels.astype(np.float32)
+    yield pixels
+    for factor in (0.6, 1.4, 1.6):
+        yield pixels * factor
+    yield (pixels - pixels.mean()) * 1.6 + pixels.mean()
+    yield 255 * (pixels / 255) ** 1.6
+    for sigma in (10, 20):
+        yield pixels + rng.normal(0, sigma, pixels.shape)
+
+def encode(pixels: np.ndarray, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    # Uncompressed PNGs: the test is about the pixels, and zlib would dominate its run time
+    options = {"compress_level": 0} if image_format == "PNG" else {}
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("path", SAMPLE_IMAGES, ids=os.path.basename)
+def test_prescreen_never_rejects_what_the_full_check_accepts(path):
+    rng = np.random.default_rng(0)
+    img = Image.open(path)
+    pixels = np.asarray(img if img.mode == "L" else img.convert("RGB"))
+    false_rejects = []
+    for index, variant in enumerate(variants(pixels, rng)):
+        for image_format in ("PNG", "JPEG"):
+            data = encode(variant, image_format)
+            plausible, _ = prescreen(data)
+            if not plausible and is_xray_image(decode_image(data, preview_size=None)[0]):
+                false_rejects.append((index, image_format))
+    assert false_rejects == []
+
+def edge_cases():
+    """Synthetic images at the corners of the histogram and of the thresholds"""
+    yield "black", np.zeros((224, 224, 3), dtype=np.float32)
+    for level in (XRAY_INTENSITY_RANGE[0], 127.5, XRAY_INTENSITY_RANGE[1], 255):
+        yield f"constant-{level}", np.full((224, 224, 3), level, dtype=np.float32)
+    # A smooth vertical gradient whose every value lies exactly on a histogram bin edge
+    edges = np.histogram_bin_edges([], bins=XRAY_HIST_BINS, range=XRAY_INTENSITY_RANGE)
+    rows = edges[np.linspace(0, len(edges) - 1, 224).round().astype(int)]
+    gradient = np.repeat(rows[:, np.newaxis], 224, axis=1)
+    yield "bin-edges", np.repeat(gradient[..., np.newaxis], 3, axis=2).astype(np.float32)
+    yield "bin-edges-float64-gray", gradient
+    # Two flat tissue densities, on the left and right edges of the range
+    halves = np.where(np.arange(224) < 112, XRAY_INTENSITY_RANGE[0], XRAY_INTENSITY_RANGE[1])
+    yield "two-levels", np.repeat(np.tile(halves, (224, 1))[..., np.newaxis], 3, axis=2).astype(np.float32)
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")  # np.corrcoef of a flat histogram, in both versions
+@pytest.mark.parametrize("name,image", list(edge_cases()), ids=lambda value: value if isinstance(value, str) else "")
+def test_edge_case_decisions_match_the_original_check(name, image):
+    assert is_xray_image(image) == legacy_is_xray_image(image)
+
+def test_batch_decisions_match_the_original_check():
+    images = np.stack([decode_image(path, preview_size=None)[0] for path in SAMPLE_IMAGES])
+    expected = [legacy_is_xray_image(image) for image in images]
+    assert is_xray_batch(images).tolist() == expected
+    assert [is_xray_image(image) for image in images] == expected
+    # Grayscale input goes through the same features without the color check
+    gray = images.mean(axis=3)
+    assert is_xray_batch(gray).tolist() == [legacy_is_xray_image(image) for image in gray]
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+import streamlit as st
+
+import auth_utils
+import db_utils
+from auth_utils import FREE_USAGE_LIMIT, consume_usage
+
+@pytest.fixture
+def signed_in(monkeypatch):
+    """A free user signed in to the (bare-mode) session state, over a limit-respecting stand-in table"""
+    counters = {"usage_count": 0, "premium_usage_count": 0}
+
+    def consume_usage_in_db(email, premium=False, limit=None, count=1):
+        if email != "a@example.com":
+            return None
+        column = "premium_usage_count" if premium else "usage_count"
+        admitted = count if limit is None else min(count, max(limit - counters[column], 0))
+        if not admitted:
+            return {"admitted": False, "admitted_count": 0, "usage_count": None, "premium_usage_count": None}
+        counters[column] += admitted
+        return {"admitted": True, "admitted_count": admitted, **counters}
+
+    monkeypatch.setattr(auth_utils, "consume_usage_in_db", consume_usage_in_db)
+    st.session_state.user_email = "a@example.com"
+    st.session_state.paid_user = False
+    st.session_state.premium_user = False
+    st.session_state.subscription_expires_at = None
+    st.session_state.usage_count = 0
+    st.session_state.premium_usage_count = 0
+    return counters
+
+def test_admits_what_fits_under_the_limit_in_one_locked_update(connection):
+    connection.rows = [{"admitted_count": 2, "usage_count": 5, "premium_usage_count": 0}]
+    result = db_utils.consume_usage_in_db("a@example.com", limit=5, count=4)
+    assert result == {"admitted": True, "admitted_count": 2, "usage_count": 5, "premium_usage_count": 0}
+    (query, params), = connection.statements
+    assert query.startswith("UPDATE bbt_user_doctorai u SET usage_count = COALESCE(u.usage_count, 0) + allowed.n")
+    assert "LEAST(%(count)s, GREATEST(%(limit)s - COALESCE(usage_count, 0), 0))" in query
+    assert "WHERE email = %(email)s FOR UPDATE" in query
+    assert "WHERE u.email = allowed.email AND allowed.n > 0" in query
+    assert params == {"email": "a@example.com", "limit": 5, "count": 4}
+    assert connection.commits == 1
+
+def test_premium_analyses_use_the_premium_counter(connection):
+    connection.rows = [{"admitted_count": 1, "usage_count": 5, "premium_usage_count": 1}]
+    db_utils.consume_usage_in_db("a@example.com", premium=True, limit=None)
+    (query, params), = connection.statements
+    assert "SET premium_usage_count = COALESCE(u.premium_usage_count, 0) + allowed.n" in query
+    assert params == {"email": "a@example.com", "limit": None, "count": 1}
+
+def test_no_returned_row_means_the_limit_is_reached(connection):
+    connection.rows = [None, {"?column?": 1}]
+    assert db_utils.consume_usage_in_db("a@example.com", limit=5) == {
+        "admitted": False, "admitted_count": 0, "usage_count": None, "premium_usage_count": None}
+    assert connection.statements[1] == ("SELECT 1 FROM bbt_user_doctorai WHERE email = %s", ("a@example.com",))
+
+def test_missing_user_is_an_error_not_the_limit(connection):
+    assert db_utils.consume_usage_in_db("nobody@example.com", limit=5) is None
+    assert connection.commits == 0
+
+def test_admits_until_the_free_limit(signed_in):
+    admitted = [consume_usage() for _ in range(FREE_USAGE_LIMIT + 2)]
+    assert admitted == [1] * FREE_USAGE_LIMIT + [0, 0]
+    assert st.session_state.usage_count == FREE_USAGE_LIMIT
+
+def test_batch_is_admitted_up_to_the_limit(signed_in):
+    assert consume_usage(FREE_USAGE_LIMIT - 2) == FREE_USAGE_LIMIT - 2
+    assert consume_usage(5) == 2
+    assert consume_usage(1) == 0
+    assert signed_in["usage_count"] == FREE_USAGE_LIMIT
+
+def test_tracking_errors_are_not_reported_as_the_limit(signed_in):
+    st.session_state.user_email = "nobody@example.com"
+    assert consume_usage() is None
+
+def test_concurrent_requests_cannot_overshoot(postgres):
+    with postgres.cursor() as cursor:
+        cursor.execute("INSERT INTO bbt_user_doctorai (email, usage_count) VALUES ('a@example.com', 0)")
+    barrier = threading.Barrier(8)
+    admitted = []
+
+    def request():
+        barrier.wait()
+        for _ in range(FREE_USAGE_LIMIT):
+            admitted.append(db_utils.consume_usage_in_db("a@example.com", limit=FREE_USAGE_LIMIT, count=2)["admitted_count"])
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(admitted) == FREE_USAGE_LIMIT
+    with postgres.cursor() as cursor:
+        cursor.execute("SELECT usage_count FROM bbt_user_doctorai WHERE email = 'a@example.com'")
+        assert cursor.fetchone()[0] == FREE_USAGE_LIMIT
+
+def test_missing_user_is_reported_by_the_real_statement(postgres):
+    assert db_utils.consume_usage_in_db("nobody@example.com", limit=FREE_USAGE_LIMIT) is None
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import numpy as np
+import tensorflow as tf
+
+from inference_utils import (
+    IMAGE_SIZE,
+    MULTI_MODEL_PATH,
+    EDEMA_MODEL_PATH,
+    collect_image_paths,
+    load_image_for_model,
+    predict_arrays
+)
+
+# Quantization modes: plain float32, dynamic-range (int8 weights) and full int8
+TFLITE_MODES = ("float", "dynamic", "int8")
+TFLITE_THREADS = int(os.environ.get("DIAGNOAI_TFLITE_THREADS", str(os.cpu_count() or 1)))
+REPRESENTATIVE_IMAGES_DIR = os.environ.get("DIAGNOAI_CALIBRATION_IMAGES", "Images")
+
+def tflite_path(model_path: str, mode: str) -> str:
+    """Path of the converted model next to the .h5 file, e.g. model.int8.tflite"""
+    return f"{os.path.splitext(model_path)[0]}.{mode}.tflite"
+
+def load_calibration_images(images_dir: str = REPRESENTATIVE_IMAGES_DIR) -> np.ndarray:
+    """Decode the representative set into a (N, 224, 224, 3) array scaled to 0-1"""
+    images = [load_image_for_model(path) for path in collect_image_paths([images_dir])]
+    if not images:
+        raise ValueError(f"No calibration images found in {images_dir}")
+    return np.stack(images).astype(np.float32) / 255.0
+
+def convert_model(keras_model, mode: str = "dynamic", calibration_images: np.ndarray = None) -> bytes:
+    """
+    Convert a Keras model to a TFLite flatbuffer.
+
+    Args:
+        keras_model: Loaded Keras model
+        mode (str): "float", "dynamic" (int8 weights, float activations) or
+            "int8" (weights and activations, int8 input/output)
+        calibration_images (numpy.ndarray, optional): 0-1 scaled images used
+            to calibrate activation ranges; required for "int8"
+
+    Returns:
+        bytes: Serialized TFLite model
+    """
+    if mode not in TFLITE_MODES:
+        raise ValueError(f"Unknown TFLite mode {mode!r}, expected one of {TFLITE_MODES}")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if mode in ("dynamic", "int8"):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "int8":
+        if calibration_images is None or len(calibration_images) == 0:
+            raise ValueError("Full int8 conversion needs calibration images")
+
+        def representative_dataset():
+            for img in calibration_images:
+                yield [np.expand_dims(img, axis=0).astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    return converter.convert()
+
+class TFLiteModel:
+    """
+    TFLite interpreter exposing the predict() signature used by predict_arrays.
+
+    Quantized inputs and outputs are converted using the tensor's scale and
+    zero point, so callers always pass and receive float32 arrays. Each batch
+    size gets its own interpreter, allocated on first use: resizing a single
+    interpreter would reallocate its tensors whenever the batch size changed.
+    The scheduler caps batches at MAX_BATCH_SIZE, which bounds how many are kept.
+    """
+
+    def __init__(self, model_path: str = None, model_content: bytes = None, num_threads: int = TFLITE_THREADS):
+        self._model_path = model_path
+        self._model_content = model_content
+        self._num_threads = num_threads
+        self._interpreters = {}
+        # An interpreter is not thread-safe
+        self._lock = threading.Lock()
+        # Single images are the common case; loading one up front also surfaces a bad model here
+        self._interpreter(1)
+
+    def _interpreter(self, batch_size: int) -> tuple:
+        """(interpreter, input details, output details) for batch_size, created on first use"""
+        if batch_size not in self._interpreters:
+            interpreter = tf.lite.Interpreter(
+                model_path=self._model_path,
+                model_content=self._model_content,
+                num_threads=self._num_threads
+            )
+            input_details = interpreter.get_input_details()[0]
+            if int(input_details["shape"][0]) != batch_size:
+                interpreter.resize_tensor_input(input_details["index"], [batch_size, *IMAGE_SIZE, 3])
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = (interpreter, interpreter.get_input_details()[0],
+                                              interpreter.get_output_details()[0])
+        return self._interpreters[batch_size]
+
+    def predict(self, x, batch_size=None, verbose=0) -> np.ndarray:
+        """Run the interpreter over a float32 batch and return float32 outputs"""
+        x = np.asarray(x, dtype=np.float32)
+        with self._lock:
+            interpreter, input_details, output_details = self._interpreter(len(x))
+            scale, zero_point = input_details["quantization"]
+            if input_details["dtype"] != np.float32 and scale:
+                x = np.clip(np.round(x / scale + zero_point),
+                            np.iinfo(input_details["dtype"]).min,
+                            np.iinfo(input_details["dtype"]).max)
+            interpreter.set_tensor(input_details["index"], x.astype(input_details["dtype"]))
+            interpreter.invoke()
+            output = interpreter.get_tensor(output_details["index"])
+            scale, zero_point = output_details["quantization"]
+            if output_details["dtype"] != np.float32 and scale:
+                return (output.astype(np.float32) - zero_point) * scale
+            return output.astype(np.float32)
+
+def convert_and_save_model(model_path: str, mode: str, calibration_images: np.ndarray = None) -> str:
+    """Convert one .h5 model for the given mode and write the .tflite file next to it"""
+    keras_model = tf.keras.models.load_model(model_path)
+    output_path = tflite_path(model_path, mode)
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(convert_model(keras_model, mode, calibration_images))
+        # Atomic, so a worker loading the model never reads a partly written file
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+def convert_and_save(mode: str, multi_model_path: str = MULTI_MODEL_PATH,
+                     edema_model_path: str = EDEMA_MODEL_PATH, calibration_dir: str = REPRESENTATIVE_IMAGES_DIR) -> tuple:
+    """Convert both .h5 models for the given mode and write the .tflite files next to them"""
+    calibration_images = load_calibration_images(calibration_dir) if mode == "int8" else None
+    return tuple(convert_and_save_model(model_path, mode, calibration_images)
+                 for model_path in (multi_model_path, edema_model_path))
+
+def load_tflite_model(model_path: str, mode: str = "dynamic", num_threads: int = TFLITE_THREADS) -> "TFLiteModel":
+    """Load one model as a TFLiteModel, converting from the .h5 file on first use"""
+    output_path = tflite_path(model_path, mode)
+    if not os.path.exists(output_path):
+        calibration_images = load_calibration_images() if mode == "int8" else None
+        convert_and_save_model(model_path, mode, calibration_images)
+    return TFLiteModel(output_path, num_threads=num_threads)
+
+def load_tflite_models(mode: str = "dynamic", num_threads: int = TFLITE_THREADS,
+                       multi_model_path: str = MULTI_MODEL_PATH, edema_model_path: str = EDEMA_MODEL_PATH):
+    """Load both models as TFLiteModels, converting from the .h5 files on first use"""
+    return (load_tflite_model(multi_model_path, mode, num_threads),
+            load_tflite_model(edema_model_path, mode, num_threads))
+
+def parity_report(images: np.ndarray, reference_models: tuple, candidate_models: tuple) -> dict:
+    """
+    Compare a candidate backend against the reference Keras models.
+
+    Args:
+        images (numpy.ndarray): (N, 224, 224, 3) array in the 0-255 range
+        reference_models (tuple): (multi_model, edema_model) used as ground truth
+        candidate_models (tuple): (multi_model, edema_model) under test
+
+    Returns:
+        dict: top-1 agreement, max probability deltas for the multi-class and
+        Edema outputs, and the indices of images whose diagnosis changed
+    """
+    reference = predict_arrays(images, *reference_models)
+    candidate = predict_arrays(images, *candidate_models)
+
+    # Run the Edema model on every image so its delta covers the whole set
+    scaled = np.asarray(images, dtype=np.float32) / 255.0
+    edema_reference = reference_models[1].predict(scaled, batch_size=len(scaled), verbose=0)[:, 0]
+    edema_candidate = candidate_models[1].predict(scaled, batch_size=len(scaled), verbose=0)[:, 0]
+
+    mismatches = [i for i, (ref, cand) in enumerate(zip(reference, candidate))
+                  if ref["predicted_class"] != cand["predicted_class"]]
+    probability_delta = max(
+        float(np.max(np.abs(np.array(ref["probabilities"]) - np.array(cand["probabilities"]))))
+        for ref, cand in zip(reference, candidate)
+    )
+    return {
+        "images": len(images),
+        "top1_agreement": 1.0 - len(mismatches) / len(images),
+        "max_probability_delta": probability_delta,
+        "max_edema_delta": float(np.max(np.abs(edema_reference - edema_candidate))),
+        "edema_decision_changes": int(np.sum((edema_reference >= 0.5) != (edema_candidate >= 0.5))),
+        "mismatched_images": mismatches
+    }
+
+def _mean_latency_ms(model, images: np.ndarray, repeats: int = 3) -> float:
+    """Mean single-image latency of a model's predict() in milliseconds"""
+    scaled = np.asarray(images, dtype=np.float32) / 255.0
+    model.predict(scaled[:1], verbose=0)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for img in scaled:
+            model.predict(img[None], verbose=0)
+    return (time.perf_counter() - start) * 1000.0 / (repeats * len(scaled))
+
+def cli(argv=None):
+    """Convert the models to TFLite and print a parity report against Keras"""
+    parser = argparse.ArgumentParser(
+        prog="diagnoai-tflite",
+        description="Convert the DiagnoAI models to TFLite and check parity with the Keras models."
+    )
+    parser.add_argument("--mode", choices=TFLITE_MODES, nargs="+", default=["dynamic", "int8"])
+    parser.add_argument("--images", default=REPRESENTATIVE_IMAGES_DIR, help="Images used for calibration and parity")
+    parser.add_argument("--threads", type=int, default=TFLITE_THREADS, help="TFLite interpreter threads")
+    args = parser.parse_args(argv)
+
+    images = np.stack([load_image_for_model(path) for path in collect_image_paths([args.images])])
+    reference_models = (tf.keras.models.load_model(MULTI_MODEL_PATH), tf.keras.models.load_model(EDEMA_MODEL_PATH))
+    keras_latency = _mean_latency_ms(reference_models[0], images)
+    print(f"keras    : {keras_latency:.2f} ms/image (multi-class)")
+
+    for mode in args.mode:
+        paths = convert_and_save(mode, calibration_dir=args.images)
+        candidate_models = tuple(TFLiteModel(path, num_threads=args.threads) for path in paths)
+        report = parity_report(images, reference_models, candidate_models)
+        size_mb = os.path.getsize(paths[0]) / 1e6
+        print(f"{mode:<9}: {_mean_latency_ms(candidate_models[0], images):.2f} ms/image, {size_mb:.1f} MB, "
+              f"top-1 agreement {report['top1_agreement']*100:.1f}% over {report['images']} images, "
+              f"max prob delta {report['max_probability_delta']:.4f}, "
+              f"max Edema delta {report['max_edema_delta']:.4f}, "
+              f"Edema decision changes {report['edema_decision_changes']}")
+        if report["mismatched_images"]:
+            print(f"           diagnosis changed for image indices {report['mismatched_images']}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -325,66 +325,217 @@ def blue_file_uploader(
         help=help
     )
 
-def is_xray_image(img_array):
+# X-ray plausibility thresholds
+XRAY_MAX_COLOR_VARIATION = 25
+XRAY_INTENSITY_RANGE = (20, 235)
+XRAY_STD_RANGE = (15, 80)
+XRAY_MAX_LOCAL_CONTRAST = 25
+XRAY_MIN_PEAK_SPREAD = 30
+XRAY_MIN_SYMMETRY = -0.3
+XRAY_MAX_SINGLE_INTENSITY_FRACTION = 0.3
+XRAY_MAX_EDGE_INTENSITY = 30
+XRAY_HIST_BINS = 256
+
+def _rolled_difference(flat, shift, out):
+    """Write np.roll(flat, shift) - flat into out without a rolled copy"""
+    n_pixels = flat.shape[0]
+    shift %= n_pixels
+    np.subtract(flat[n_pixels - shift:], flat[:shift], out=out[:shift])
+    np.subtract(flat[:n_pixels - shift], flat[shift:], out=out[shift:])
+    return out
+
+def _local_contrast_mean(flat, shifts):
     """
-    Check if the given image is likely to be an X-ray image.
-    
+    Mean over pixels of the std of the rolled differences.
+
+    Same two-pass arithmetic as np.std over the stacked differences, but the
+    differences are recomputed into one scratch buffer instead of stacking
+    every rolled copy, so only three pixel buffers are live at once.
+    """
+    scratch = np.empty_like(flat)
+    mean = _rolled_difference(flat, shifts[0], np.empty_like(flat))
+    for shift in shifts[1:]:
+        mean += _rolled_difference(flat, shift, scratch)
+    mean /= len(shifts)
+
+    variance = np.zeros_like(flat)
+    for shift in shifts:
+        _rolled_difference(flat, shift, scratch)
+        scratch -= mean
+        scratch *= scratch
+        variance += scratch
+    variance /= len(shifts)
+    np.sqrt(variance, out=variance)
+    return np.mean(variance)
+
+def _mean_abs_diff(gray, axis):
+    """Mean of |np.diff(gray, axis)|, reusing one buffer"""
+    diff = np.diff(gray, axis=axis)
+    np.abs(diff, out=diff)
+    return np.mean(diff)
+
+def xray_features(images):
+    """
+    Compute the X-ray plausibility features for a batch of images.
+
+    Images are measured one at a time: vectorizing the pixel work across the
+    batch multiplied the temporaries and was no faster per image.
+
     Args:
-        img_array (numpy.ndarray): Image array to check
-        
+        images (numpy.ndarray): (N, H, W, 3) color or (N, H, W) grayscale batch
+
     Returns:
-        bool: True if the image is likely an X-ray, False otherwise
+        dict: Arrays of length N for color_variation (None for grayscale input),
+        mean_intensity, std_intensity, local_contrast_mean, edge_intensity,
+        hist_peak_count, peak_spread, symmetry_score and max_hist_count, plus
+        the per-image pixel_count
     """
-    # Convert to grayscale if it's a color image
-    if len(img_array.shape) == 3:
-        # Check if the image has high color variation (typical of natural images)
-        color_variation = np.std(img_array - np.mean(img_array, axis=2, keepdims=True))
-        if color_variation > 25:  # High color variation indicates non-medical image
-            return False
-            
-        # Convert to grayscale by taking mean of RGB channels
-        gray_img = np.mean(img_array, axis=2)
+    images = np.asarray(images)
+    per_image = [_image_xray_features(image) for image in images]
+    features = {}
+    for name, value in per_image[0].items():
+        if value is None or name == "pixel_count":
+            features[name] = value
+        else:
+            features[name] = np.array([image[name] for image in per_image])
+    return features
+
+def _image_xray_features(image):
+    """xray_features for one (H, W, 3) or (H, W) image, as scalars"""
+    color_variation = None
+    if image.ndim == 3:
+        # Color variation (typical of natural images) and grayscale conversion
+        gray = np.mean(image, axis=2)
+        deviation = np.subtract(image, gray[..., np.newaxis])
+        color_variation = np.std(deviation)
+        del deviation
     else:
-        gray_img = img_array
-    
+        gray = image
+
+    height, width = gray.shape
+    flat = gray.ravel()
+
     # X-ray characteristics checks
-    mean_intensity = np.mean(gray_img)
-    std_intensity = np.std(gray_img)
-    
-    # Calculate local contrast variance (X-rays have smooth transitions)
-    local_contrast = np.std([np.roll(gray_img, i) - gray_img for i in [1, -1, gray_img.shape[1], -gray_img.shape[1]]], axis=0)
-    local_contrast_mean = np.mean(local_contrast)
-    
-    # Calculate histogram features
-    hist_range = (20, 235)
-    histogram = np.histogram(gray_img, bins=256, range=hist_range)[0]
+    mean_intensity = np.mean(flat)
+    std_intensity = np.std(flat)
+
+    # Local contrast variance over the 4-neighbourhood (X-rays have smooth transitions)
+    local_contrast_mean = _local_contrast_mean(flat, (1, -1, width, -width))
+
+    # Edge characteristics (X-rays have smoother edges)
+    edge_intensity = _mean_abs_diff(gray, 1) + _mean_abs_diff(gray, 0)
+
+    # Histogram features
+    histogram = np.histogram(flat, bins=XRAY_HIST_BINS, range=XRAY_INTENSITY_RANGE)[0]
     smoothed_hist = np.convolve(histogram, np.ones(5)/5, mode='valid')
-    
-    # Medical X-rays typically have specific histogram characteristics
     hist_peaks = np.where(smoothed_hist > np.mean(smoothed_hist) + 0.5 * np.std(smoothed_hist))[0]
     peak_spread = np.max(hist_peaks) - np.min(hist_peaks) if len(hist_peaks) > 1 else 0
-    
-    # Calculate symmetry - medical X-rays often have roughly symmetric intensity distribution
     hist_midpoint = len(smoothed_hist) // 2
     symmetry_score = np.corrcoef(smoothed_hist[:hist_midpoint], smoothed_hist[hist_midpoint:][::-1])[0,1]
+
+    return {
+        "color_variation": color_variation,
+        "mean_intensity": mean_intensity,
+        "std_intensity": std_intensity,
+        "local_contrast_mean": local_contrast_mean,
+        "edge_intensity": edge_intensity,
+        "hist_peak_count": len(hist_peaks),
+        "peak_spread": peak_spread,
+        "symmetry_score": symmetry_score,
+        "max_hist_count": np.max(histogram),
+        "pixel_count": height * width
+    }
+
+def is_xray_batch(images):
+    """
+    Check which images in a batch are likely to be X-ray images.
+
+    Args:
+        images (numpy.ndarray): (N, H, W, 3) color or (N, H, W) grayscale batch
+
+    Returns:
+        numpy.ndarray: Boolean array of length N
+    """
+    if len(images) == 0:
+        return np.zeros(0, dtype=bool)
+    features = xray_features(images)
+    accepted = (
+        (XRAY_INTENSITY_RANGE[0] < features["mean_intensity"]) &
+        (features["mean_intensity"] < XRAY_INTENSITY_RANGE[1]) &    # Typical X-ray intensity range
+        (XRAY_STD_RANGE[0] < features["std_intensity"]) &
+        (features["std_intensity"] < XRAY_STD_RANGE[1]) &           # Appropriate contrast range for medical images
+        (features["local_contrast_mean"] < XRAY_MAX_LOCAL_CONTRAST) &  # Smooth transitions characteristic of X-rays
+        (features["hist_peak_count"] >= 2) &                        # Multiple distinct tissue densities
+        (features["peak_spread"] > XRAY_MIN_PEAK_SPREAD) &          # Good separation between tissue densities
+        (features["symmetry_score"] > XRAY_MIN_SYMMETRY) &          # Some degree of histogram symmetry
+        (features["max_hist_count"] < features["pixel_count"] * XRAY_MAX_SINGLE_INTENSITY_FRACTION) &  # No overwhelming single intensity
+        ~(features["edge_intensity"] > XRAY_MAX_EDGE_INTENSITY)     # Too many sharp edges indicate non-medical image
+    )
+    if features["color_variation"] is not None:
+        # High color variation indicates non-medical image
+        accepted &= ~(features["color_variation"] > XRAY_MAX_COLOR_VARIATION)
+    return accepted
+
+def is_xray_image(img_array):
+    """
+    Check if the given image is likely to be an X-ray image.
     
-    # More sophisticated conditions for X-ray detection
-    conditions = [
-        20 < mean_intensity < 235,      # Typical X-ray intensity range
-        15 < std_intensity < 80,        # Appropriate contrast range for medical images
-        local_contrast_mean < 25,       # Smooth transitions characteristic of X-rays
-        len(hist_peaks) >= 2,           # Multiple distinct tissue densities
-        peak_spread > 30,               # Good separation between tissue densities
-        symmetry_score > -0.3,          # Some degree of histogram symmetry
-        np.max(histogram) < np.prod(gray_img.shape) * 0.3  # No overwhelming single intensity
-    ]
-    
-    # Check edge characteristics (X-rays have smoother edges)
-    edges_x = np.diff(gray_img, axis=1)
-    edges_y = np.diff(gray_img, axis=0)
-    edge_intensity = np.mean(np.abs(edges_x)) + np.mean(np.abs(edges_y))
-    if edge_intensity > 30:  # Too many sharp edges indicate non-medical image
+    Args:
+        img_array (numpy.ndarray): Image array to check
+        
+    Returns:
+        bool: True if the image is likely an X-ray, False otherwise
+    """
+    return bool(is_xray_batch(np.expand_dims(img_array, axis=0))[0])
+
+# Thumbnail pre-screen thresholds. Only checks that survive downscaling are
+# used, with margins, so that the pre-screen never rejects an image the full
+# check would accept. The full check measures a nearest-neighbour 224 px
+# resample, the pre-screen an area-averaged thumbnail, so their statistics
+# differ both ways: over Images/ with rescaled, contrast-stretched, gamma and
+# noisy variants, the thumbnail's mean was up to 3 levels and its std up to
+# 3.3 above the full check's. Colour variation and the histogram can only be
+# smoothed out or concentrated by averaging (dithered levels merge into one),
+# so the single-intensity bound only catches near-blank images
+PRESCREEN_INTENSITY_MARGIN = 10
+PRESCREEN_STD_MARGIN = 10
+PRESCREEN_COLOR_VARIATION_MARGIN = 5
+PRESCREEN_INTENSITY_RANGE = (XRAY_INTENSITY_RANGE[0] - PRESCREEN_INTENSITY_MARGIN,
+                             XRAY_INTENSITY_RANGE[1] + PRESCREEN_INTENSITY_MARGIN)
+PRESCREEN_MAX_COLOR_VARIATION = XRAY_MAX_COLOR_VARIATION + PRESCREEN_COLOR_VARIATION_MARGIN
+PRESCREEN_MAX_STD = XRAY_STD_RANGE[1] + PRESCREEN_STD_MARGIN
+PRESCREEN_MAX_SINGLE_INTENSITY_FRACTION = 0.8
+
+def prescreen_thumbnail(thumb):
+    """
+    Cheap pre-screen on a small thumbnail, before decoding the full image.
+
+    Rejects only obvious non-X-rays (colour photos, screenshots, blank or
+    saturated images); anything it passes still goes through is_xray_image.
+
+    Args:
+        thumb (numpy.ndarray): (H, W, 3) or (H, W) thumbnail, about 64 pixels on the long side
+
+    Returns:
+        bool: False if the image is certainly not an X-ray, True if it is plausible
+    """
+    thumb = np.asarray(thumb, dtype=np.float32)
+    if thumb.ndim == 3:
+        gray = thumb.mean(axis=2)
+        if np.std(thumb - gray[..., np.newaxis]) > PRESCREEN_MAX_COLOR_VARIATION:
+            return False
+    else:
+        gray = thumb
+
+    mean_intensity = gray.mean()
+    if not PRESCREEN_INTENSITY_RANGE[0] < mean_intensity < PRESCREEN_INTENSITY_RANGE[1]:
+        return False
+    if gray.std() >= PRESCREEN_MAX_STD:
         return False
-    
-    return all(conditions)
 
+    # Largest share of pixels at one intensity inside the histogram range of the full check
+    levels = np.rint(gray).astype(np.intp).ravel()
+    counts = np.bincount(levels[(levels >= XRAY_INTENSITY_RANGE[0]) & (levels <= XRAY_INTENSITY_RANGE[1])])
+    if counts.size and counts.max() >= gray.size * PRESCREEN_MAX_SINGLE_INTENSITY_FRACTION:
+        return False
+    return True